@@ -9,6 +9,9 @@ FRONTEND_DIR="$REPO_DIR/frontend"
 DEPLOY_DIR="$REPO_DIR/deploy"
 SERVICE_NAME="vigie-immo"
 SERVICE_FILE="$DEPLOY_DIR/vigie-immo.service"
+JOBS_SERVICE_NAME="vigie-immo-jobs"
+JOBS_SERVICE_FILE="$DEPLOY_DIR/vigie-immo-jobs.service"
+MAINTAIN_NAME="vigie-immo-maintain"
 NGINX_CONF="$DEPLOY_DIR/nginx-vigie-immo.conf"
 NGINX_ENABLED="/etc/nginx/sites-enabled/$SERVICE_NAME"
 NGINX_AVAILABLE="/etc/nginx/sites-available/$SERVICE_NAME"
@@ -55,8 +58,10 @@ if ! psql -lqt | cut -d'|' -f1 | grep -qw vigie_immo; then
 else
     ok "base vigie_immo existante"
 fi
-psql vigie_immo -f "$BACKEND_DIR/migrations/001_add_auth.sql" -q
-ok "migration appliquée (idempotente)"
+for migration in "$BACKEND_DIR"/migrations/*.sql; do
+    psql vigie_immo -v ON_ERROR_STOP=1 -f "$migration" -q
+done
+ok "migrations appliquées (idempotentes)"
 
 # ---------------------------------------------------------------------------
 # Étape 3 — Admin initial
@@ -74,12 +79,17 @@ fi
 # ---------------------------------------------------------------------------
 # Étape 4 — Systemd
 # ---------------------------------------------------------------------------
-info "4/6 — Service systemd $SERVICE_NAME"
+info "4/6 — Services systemd $SERVICE_NAME et $JOBS_SERVICE_NAME, timer $MAINTAIN_NAME"
 sudo cp "$SERVICE_FILE" "/etc/systemd/system/$SERVICE_NAME.service"
+sudo cp "$JOBS_SERVICE_FILE" "/etc/systemd/system/$JOBS_SERVICE_NAME.service"
+sudo cp "$DEPLOY_DIR/$MAINTAIN_NAME.service" "$DEPLOY_DIR/$MAINTAIN_NAME.timer" /etc/systemd/system/
 sudo systemctl daemon-reload
-sudo systemctl enable "$SERVICE_NAME"
-sudo systemctl restart "$SERVICE_NAME"
-ok "service démarré"
+sudo systemctl enable "$SERVICE_NAME" "$JOBS_SERVICE_NAME"
+sudo systemctl restart "$SERVICE_NAME" "$JOBS_SERVICE_NAME"
+sudo systemctl enable --now "$MAINTAIN_NAME.timer"
+# Partition du mois suivant dès le déploiement
+sudo systemctl start "$MAINTAIN_NAME.service"
+ok "services démarrés"
 
 # ---------------------------------------------------------------------------
 # Étape 5 — Frontend (build Vite)
@@ -119,3 +129,4 @@ echo ""
 echo "Vérifications :"
 echo "  curl http://localhost/api/health"
 echo "  journalctl -u $SERVICE_NAME -f"
+echo "  journalctl -u $JOBS_SERVICE_NAME -f"
@@ -1,6 +1,28 @@
+import os
+
 bind = "127.0.0.1:5002"
 workers = 4
+# gthread : une analyse lente (appels externes) n'occupe qu'un thread du worker ;
+# gevent (pip install gevent) : une greenlet par requête ; sync : un thread par worker
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))                         # gthread
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))  # gevent
 timeout = 120          # /api/analyze appelle plusieurs APIs externes (30-60 s)
 accesslog = "-"        # stdout → journald
 errorlog = "-"
 loglevel = "info"
+
+
+def post_fork(server, worker):
+    # Ouvrir le pool PostgreSQL du worker avant sa première requête
+    from db import get_pool
+    get_pool()
+    # Limites bcrypt de BCRYPT_CONCURRENCY / BCRYPT_MAX_PENDING réparties entre les workers
+    from auth import set_worker_count
+    set_worker_count(server.cfg.workers)
+
+
+def worker_exit(server, worker):
+    # Écrire l'historique encore en file avant la sortie du worker
+    from history import close_writer
+    close_writer()
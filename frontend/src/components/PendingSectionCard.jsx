@@ -0,0 +1,12 @@
+export default function PendingSectionCard({ title, section, fullWidth = false }) {
+  return (
+    <div className={fullWidth ? 'card full-width' : 'card'}>
+      <h2>{title}</h2>
+      <div className="data-quality-warning">
+        {'\u23F3'}{' '}
+        {section.message ||
+          "Données en cours de récupération, relancez l'analyse dans quelques instants"}
+      </div>
+    </div>
+  );
+}
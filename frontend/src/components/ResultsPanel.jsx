@@ -9,6 +9,10 @@ import DisasterHistoryCard from './DisasterHistoryCard';
 import PropertyCard from './PropertyCard';
 import CrimeCard from './CrimeCard';
 import RiskSummaryCard from './RiskSummaryCard';
+import PendingSectionCard from './PendingSectionCard';
+
+// Section not ready at the analysis deadline: {status: 'pending', message}
+const isPending = (section) => section?.status === 'pending';
 
 export default function ResultsPanel({ data }) {
   const flood = data.flood_zones || {};
@@ -22,18 +26,33 @@ export default function ResultsPanel({ data }) {
   const crime = data.crime || {};
   const assessment = data.risk_assessment || {};
 
+  // A pending section has none of the card's fields: show a placeholder instead
+  // of the card's "safe" or "N/A" defaults
+  const card = (section, title, render, fullWidth = false) =>
+    isPending(section) ? (
+      <PendingSectionCard title={title} section={section} fullWidth={fullWidth} />
+    ) : (
+      render()
+    );
+
   return (
     <div className="results">
-      <LocationCard address={data.address} flood={flood} />
-      <FloodZonesCard flood={flood} />
-      <ContaminationCard contamination={contamination} />
-      <ServicesCard services={services} />
-      <HydrantsCard hydrants={hydrants} />
-      <SeismicCard seismic={seismic} />
-      <AirQualityCard airQuality={airQuality} />
-      <DisasterHistoryCard disasterHistory={disasterHistory} />
-      <PropertyCard property={property} />
-      <CrimeCard crime={crime} />
+      <LocationCard address={data.address} flood={isPending(flood) ? {} : flood} />
+      {card(flood, '💧 Zones inondables', () => <FloodZonesCard flood={flood} />)}
+      {card(contamination, '⚠️ Terrains contaminés', () => (
+        <ContaminationCard contamination={contamination} />
+      ))}
+      {card(services, "🚒 Services d'urgence à proximité", () => (
+        <ServicesCard services={services} />
+      ), true)}
+      {card(hydrants, '🚿 Bornes fontaines', () => <HydrantsCard hydrants={hydrants} />)}
+      {card(seismic, '🌍 Données sismiques', () => <SeismicCard seismic={seismic} />)}
+      {card(airQuality, "💨 Qualité de l'air", () => <AirQualityCard airQuality={airQuality} />)}
+      {card(disasterHistory, '📜 Historique de sinistres', () => (
+        <DisasterHistoryCard disasterHistory={disasterHistory} />
+      ))}
+      {card(property, '🏠 Évaluation foncière', () => <PropertyCard property={property} />)}
+      {card(crime, '🔒 Criminalité', () => <CrimeCard crime={crime} />)}
       <RiskSummaryCard assessment={assessment} />
     </div>
   );
@@ -2,6 +2,7 @@ import RiskBadge from './RiskBadge';
 
 export default function RiskSummaryCard({ assessment }) {
   const factors = assessment.factors || [];
+  const pending = assessment.pending_sections || [];
 
   return (
     <div className="card full-width">
@@ -37,6 +38,13 @@ export default function RiskSummaryCard({ assessment }) {
           </div>
         </div>
       </div>
+      {pending.length > 0 && (
+        <div className="data-quality-warning">
+          {'\u2139'} Analyse partielle ({Math.round((assessment.completeness || 0) * 100)} %) —
+          sources en attente : {pending.join(', ')}. Relancez l'analyse dans quelques instants
+          pour un score complet.
+        </div>
+      )}
     </div>
   );
 }
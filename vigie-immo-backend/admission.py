@@ -0,0 +1,139 @@
+"""
+admission.py — Contrôle d'admission des analyses
+
+Une analyse interroge une dizaine de services externes (30-60 s). Sans
+limite, quelques analyses simultanées occupent tous les threads d'un worker
+et bloquent login, /api/health et /api/history. Par worker, au plus
+ANALYZE_MAX_CONCURRENT analyses s'exécutent ; ANALYZE_MAX_QUEUED autres
+attendent une place au plus ANALYZE_QUEUE_TIMEOUT secondes. Au-delà, la
+requête est refusée (AdmissionRejected → 503 + Retry-After) sans attendre.
+
+Avec le worker gthread (deploy/gunicorn.conf.py), garder
+ANALYZE_MAX_CONCURRENT + ANALYZE_MAX_QUEUED sous GUNICORN_THREADS laisse
+des threads libres pour les requêtes rapides.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+ANALYZE_MAX_CONCURRENT = int(os.environ.get('ANALYZE_MAX_CONCURRENT', 3))     # par worker
+ANALYZE_MAX_QUEUED = int(os.environ.get('ANALYZE_MAX_QUEUED', 3))             # par worker
+ANALYZE_QUEUE_TIMEOUT = float(os.environ.get('ANALYZE_QUEUE_TIMEOUT', 30))    # secondes
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """Trop de requêtes en cours et en attente ; réessayer après retry_after secondes."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Admission:
+    """
+    Limite de concurrence avec file d'attente bornée : au plus max_running
+    exécutions, max_queued en attente (au plus timeout secondes), refus
+    immédiat au-delà.
+    """
+
+    def __init__(self, name: str, max_running: int, max_queued: int, timeout: float):
+        self.name = name
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+        self._stats = {
+            'admitted': 0,
+            'queued': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'wait_seconds': 0.0,
+            'run_seconds': 0.0,
+            'completed': 0,
+        }
+
+    def _retry_after(self) -> int:
+        """Délai estimé avant qu'une place se libère (durée moyenne × rang), entre 1 et 60 s."""
+        completed = self._stats['completed']
+        if not completed:
+            return 5
+        avg_run = self._stats['run_seconds'] / completed
+        return min(60, max(1, math.ceil(avg_run * (self._waiting + 1) / self.max_running)))
+
+    def _acquire(self) -> None:
+        t0 = time.monotonic()
+        with self._cond:
+            if self._running >= self.max_running:
+                if self._waiting >= self.max_queued:
+                    self._stats['rejected'] += 1
+                    raise AdmissionRejected(f"{self.name} : {self._running} en cours, "
+                                            f"{self._waiting} en attente", self._retry_after())
+                self._waiting += 1
+                self._stats['queued'] += 1
+                try:
+                    while self._running >= self.max_running:
+                        remaining = t0 + self.timeout - time.monotonic()
+                        if remaining <= 0:
+                            self._stats['timeouts'] += 1
+                            raise AdmissionRejected(f"{self.name} : aucune place libérée après "
+                                                    f"{self.timeout:.0f}s", self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                self._stats['wait_seconds'] += time.monotonic() - t0
+            self._running += 1
+            self._stats['admitted'] += 1
+
+    def _release(self, started: float) -> None:
+        with self._cond:
+            self._running -= 1
+            self._stats['completed'] += 1
+            self._stats['run_seconds'] += time.monotonic() - started
+            self._cond.notify()
+
+    @contextmanager
+    def admitted(self):
+        """Bloc exécuté une fois admis (route dont une partie seulement interroge les sources)."""
+        self._acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(started)
+
+    def limit(self, f):
+        """Décorateur de route : la vue ne s'exécute qu'une fois admise."""
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with self.admitted():
+                return f(*args, **kwargs)
+        return decorated
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            running, waiting = self._running, self._waiting
+        completed, queued = stats['completed'], stats['queued']
+        return {
+            'max_running': self.max_running,
+            'max_queued': self.max_queued,
+            'running': running,
+            'waiting': waiting,
+            'admitted': stats['admitted'],
+            'queued': queued,
+            'rejected': stats['rejected'],
+            'timeouts': stats['timeouts'],
+            'avg_wait_ms': round(stats['wait_seconds'] / queued * 1000, 1) if queued else None,
+            'avg_run_ms': round(stats['run_seconds'] / completed * 1000, 1) if completed else None,
+        }
+
+
+analysis_admission = Admission('analyses', ANALYZE_MAX_CONCURRENT, ANALYZE_MAX_QUEUED, ANALYZE_QUEUE_TIMEOUT)
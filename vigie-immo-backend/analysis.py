@@ -0,0 +1,378 @@
+"""
+analysis.py — Pipeline d'analyse d'une adresse
+
+Géocodage puis interrogation des sources (zones inondables, terrains
+contaminés, services, bornes, sismicité, qualité de l'air, sinistres,
+évaluation foncière, criminalité) et calcul du risque. Utilisé par
+POST /api/analyze, par les jobs d'analyse (jobs.py) et par le
+rafraîchissement des rapports de l'historique.
+
+Les sections sont interrogées en parallèle (ANALYZE_SECTION_THREADS threads
+par processus) et conservées dans section_cache : fraîches pendant
+history.SECTION_MAX_AGE, puis servies périmées le temps d'être revalidées en
+arrière-plan. Une source en échec n'est plus interrogée pour l'emplacement
+pendant SECTION_CACHE_NEGATIVE_TTL : le repli (ou la dernière valeur valide)
+est servi aussitôt. Avec une échéance, analyze() répond à l'heure
+avec les sections obtenues : les autres sont marquées 'pending' et le
+risque est calculé sur les données disponibles. Les sources en retard
+terminent en arrière-plan et alimentent le cache pour l'analyse suivante.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import psycopg2
+
+import outbound
+
+from data_fetcher import (
+    geocode_address,
+    check_flood_zones,
+    get_contaminated_sites,
+    get_nearby_services,
+    get_fire_hydrants,
+    get_seismic_data,
+    get_air_quality,
+    get_disaster_history,
+    get_property_assessment,
+    get_crime_data,
+    calculate_risk_assessment,
+    track_fallbacks,
+)
+from db import get_pool
+from history import SECTION_MAX_AGE, compress_section
+
+ANALYZE_MAX_WAIT_MS = int(os.environ.get('ANALYZE_MAX_WAIT_MS', 20000))   # échéance par défaut de POST /api/analyze
+ANALYZE_MAX_WAIT_MS_LIMIT = 90000   # en deçà du timeout de gunicorn et nginx (120 s)
+ANALYZE_SECTION_THREADS = int(os.environ.get('ANALYZE_SECTION_THREADS', 16))   # par processus
+SECTION_CACHE_PRECISION = 4   # décimales des coordonnées (~10 m)
+# Entrée périmée servie (puis revalidée) jusqu'à SECTION_MAX_AGE × ce facteur
+SECTION_CACHE_STALE_FACTOR = float(os.environ.get('SECTION_CACHE_STALE_FACTOR', 4))
+# Source en échec non réinterrogée pour un emplacement pendant ce délai (s)
+SECTION_CACHE_NEGATIVE_TTL = int(os.environ.get('SECTION_CACHE_NEGATIVE_TTL', 120))
+
+PENDING_SECTION = {
+    'status': 'pending',
+    'message': "Source lente : données en cours de récupération, relancez l'analyse dans quelques instants",
+}
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisError(Exception):
+    """Analyse impossible (adresse introuvable, ...) : erreur et message pour le client, statut HTTP."""
+
+    def __init__(self, error: str, message: str, status: int):
+        super().__init__(message)
+        self.error = error
+        self.message = message
+        self.status = status
+
+
+# Calcul d'une section du rapport à partir de son bloc 'address'
+SECTION_FETCHERS = {
+    'flood_zones': lambda a: check_flood_zones(a['latitude'], a['longitude'], a.get('municipality', '')),
+    'contamination': lambda a: get_contaminated_sites(a['latitude'], a['longitude'], radius_m=500,
+                                                      municipality=a.get('municipality', '')),
+    'services': lambda a: get_nearby_services(a['latitude'], a['longitude'], radius_m=500,
+                                              municipality=a.get('municipality', '')),
+    'hydrants': lambda a: get_fire_hydrants(a['latitude'], a['longitude'], radius_m=500),
+    'seismic': lambda a: get_seismic_data(a['latitude'], a['longitude']),
+    'air_quality': lambda a: get_air_quality(a['latitude'], a['longitude']),
+    'disaster_history': lambda a: get_disaster_history(a['latitude'], a['longitude'], radius_km=25),
+    'property_assessment': lambda a: get_property_assessment(a['latitude'], a['longitude'],
+                                                             address=a.get('input', '')),
+    'crime': lambda a: get_crime_data(a['latitude'], a['longitude']),
+}
+
+
+def _pending(result: dict) -> list:
+    return [name for name in SECTION_FETCHERS if result.get(name) == PENDING_SECTION]
+
+
+def _risk_assessment(result: dict) -> dict:
+    """Risque calculé sur les sections disponibles, avec la part du rapport qu'elles représentent."""
+    pending = _pending(result)
+    result = {name: value for name, value in result.items() if name not in pending}
+    risk = calculate_risk_assessment(
+        result.get('flood_zones', {}), result.get('contamination', {}), result.get('services', {}),
+        hydrants_data=result.get('hydrants'),
+        seismic_data=result.get('seismic'),
+        air_quality_data=result.get('air_quality'),
+        disaster_data=result.get('disaster_history'),
+        crime_data=result.get('crime')
+    )
+    risk['completeness'] = round(1 - len(pending) / len(SECTION_FETCHERS), 2)
+    risk['pending_sections'] = pending
+    return risk
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.RLock()   # RLock : add_done_callback peut rappeler aussitôt
+_inflight = {}   # (section, emplacement, voie) → Future du calcul en cours
+_cache_counts = dict.fromkeys(('fresh', 'stale', 'failed', 'miss'), 0)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Threads de calcul des sections du processus courant (recréés après un fork)."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(ANALYZE_SECTION_THREADS, thread_name_prefix='section')
+            _executor_pid = os.getpid()
+            _inflight.clear()
+        return _executor
+
+
+def _cache_key(name: str, address: dict) -> str:
+    location = (f"{address['latitude']:.{SECTION_CACHE_PRECISION}f},"
+                f"{address['longitude']:.{SECTION_CACHE_PRECISION}f}")
+    if name == 'property_assessment':
+        # Le rôle foncier est recherché d'après l'adresse saisie
+        location += '|' + address.get('input', '').strip().lower()
+    return location
+
+
+def _cached_sections(address: dict) -> dict:
+    """
+    Entrées de section_cache utilisables pour cet emplacement : {section:
+    (valeur, état)}, état 'fresh', 'stale' (servie, à revalider) ou 'failed'
+    (source en échec depuis moins de SECTION_CACHE_NEGATIVE_TTL s : repli ou
+    dernière valeur valide, sans nouvel appel). {} si le cache est injoignable.
+    """
+    keys = {name: _cache_key(name, address) for name in SECTION_FETCHERS}
+    try:
+        with get_pool().connection() as conn, conn, conn.cursor() as cur:
+            cur.execute(
+                '''SELECT c.section, c.data, c.degraded,
+                          EXTRACT(EPOCH FROM NOW() - c.fetched_at),
+                          EXTRACT(EPOCH FROM NOW() - c.failed_at)
+                   FROM section_cache c
+                   JOIN unnest(%s::text[], %s::text[]) AS k(section, location) USING (section, location)''',
+                (list(keys), list(keys.values()))
+            )
+            rows = cur.fetchall()
+    except psycopg2.Error as e:
+        logger.warning(f"⚠️ Cache des sections indisponible: {e}")
+        return {}
+    cached = {}
+    for name, data, degraded, age, failed_age in rows:
+        max_age = SECTION_MAX_AGE.get(name, 0)
+        if failed_age is not None and failed_age < SECTION_CACHE_NEGATIVE_TTL:
+            state = 'failed'
+        elif degraded:
+            continue
+        elif age < max_age:
+            state = 'fresh'
+        elif age < max_age * SECTION_CACHE_STALE_FACTOR:
+            state = 'stale'
+        else:
+            continue
+        cached[name] = (json.loads(zlib.decompress(data)), state)
+    return cached
+
+
+def _store_section(name: str, address: dict, value, degraded: bool) -> None:
+    """
+    Met une section en cache. En repli (`degraded`), une entrée valide déjà
+    présente est conservée et seul l'échec est daté.
+    """
+    data = compress_section(value)
+    try:
+        with get_pool().connection() as conn, conn, conn.cursor() as cur:
+            if degraded:
+                cur.execute(
+                    '''INSERT INTO section_cache AS c (section, location, data, degraded, failed_at)
+                       VALUES (%s, %s, %s, TRUE, NOW())
+                       ON CONFLICT (section, location) DO UPDATE SET
+                           data = CASE WHEN c.degraded THEN EXCLUDED.data ELSE c.data END,
+                           fetched_at = CASE WHEN c.degraded THEN EXCLUDED.fetched_at ELSE c.fetched_at END,
+                           failed_at = EXCLUDED.failed_at''',
+                    (name, _cache_key(name, address), psycopg2.Binary(data))
+                )
+            else:
+                cur.execute(
+                    '''INSERT INTO section_cache (section, location, data) VALUES (%s, %s, %s)
+                       ON CONFLICT (section, location) DO UPDATE SET
+                           data = EXCLUDED.data, fetched_at = EXCLUDED.fetched_at,
+                           degraded = FALSE, failed_at = NULL''',
+                    (name, _cache_key(name, address), psycopg2.Binary(data))
+                )
+    except psycopg2.Error as e:
+        logger.warning(f"⚠️ Section {name} non mise en cache: {e}")
+
+
+def purge_section_cache(cur) -> int:
+    """Supprime les entrées de section_cache qui ne peuvent plus être servies ; retourne leur nombre."""
+    cur.execute(
+        '''DELETE FROM section_cache c
+           USING unnest(%s::text[], %s::int[]) AS k(section, max_age)
+           WHERE c.section = k.section
+             AND (c.failed_at IS NULL OR c.failed_at < NOW() - make_interval(secs => %s))
+             AND (c.degraded OR c.fetched_at < NOW() - make_interval(secs => k.max_age * %s))''',
+        (list(SECTION_FETCHERS), [SECTION_MAX_AGE.get(name, 0) for name in SECTION_FETCHERS],
+         SECTION_CACHE_NEGATIVE_TTL, SECTION_CACHE_STALE_FACTOR)
+    )
+    return cur.rowcount
+
+
+def _fetch_section(name: str, address: dict) -> tuple:
+    """
+    Calcule une section et la met en cache, comme repli si sa valeur en est
+    un ; retourne (valeur, repli).
+    """
+    try:
+        with track_fallbacks() as fallbacks:
+            value = SECTION_FETCHERS[name](address)
+    except Exception as e:
+        logger.error(f"💥 Section {name}: {e}", exc_info=True)
+        raise
+    if fallbacks:
+        logger.info(f"Section {name} en repli, source évitée {SECTION_CACHE_NEGATIVE_TTL}s: {fallbacks[0]}")
+    _store_section(name, address, value, degraded=bool(fallbacks))
+    return value, bool(fallbacks)
+
+
+def _revalidate_section(name: str, address: dict):
+    # Personne n'attend la nouvelle valeur : les analyses en cours passent avant
+    with outbound.lane('batch'):
+        return _fetch_section(name, address)
+
+
+def _submit_section(name: str, address: dict, revalidate: bool = False):
+    """
+    Calcul d'une section en arrière-plan (revalidation : voie batch) ; un
+    calcul déjà en cours pour le même emplacement dans la même voie est
+    partagé : une analyse interactive n'attend pas une revalidation.
+    """
+    lane_name = 'batch' if revalidate else outbound.current_lane()
+    fetch = _revalidate_section if revalidate else _fetch_section
+    key = (name, _cache_key(name, address), lane_name)
+    executor = _get_executor()
+    with _executor_lock:
+        future = _inflight.get(key)
+        if future is None:
+            # Contexte copié : les appels externes restent dans la voie de l'appelant (outbound.lane)
+            future = executor.submit(contextvars.copy_context().run, fetch, name, address)
+            _inflight[key] = future
+            future.add_done_callback(lambda _: _forget(key, future))
+    return future
+
+
+def _forget(key, future) -> None:
+    with _executor_lock:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+
+
+def _fetch_sections(address: dict, deadline) -> dict:
+    """
+    Toutes les sections : cache (les entrées périmées sont servies et
+    revalidées en arrière-plan), sinon sources en parallèle ; PENDING_SECTION
+    si l'échéance est passée.
+    """
+    cached = _cached_sections(address)
+    sections = {name: value for name, (value, _) in cached.items()}
+    for name, (_, state) in cached.items():
+        if state == 'stale':
+            _submit_section(name, address, revalidate=True)
+    futures = {name: _submit_section(name, address) for name in SECTION_FETCHERS if name not in sections}
+    with _executor_lock:
+        for _, state in cached.values():
+            _cache_counts[state] += 1
+        _cache_counts['miss'] += len(futures)
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    done, _ = wait(futures.values(), timeout=timeout)
+    for name, future in futures.items():
+        sections[name] = future.result()[0] if future in done else PENDING_SECTION
+    return sections
+
+
+def cache_stats() -> dict:
+    """Sections servies par état du cache depuis le démarrage du processus, calculs en cours."""
+    with _executor_lock:
+        return {**_cache_counts, 'in_flight': len(_inflight)}
+
+
+def analyze(address: str, deadline: float = None) -> dict:
+    """
+    Analyse d'une adresse ; AnalysisError si elle ne peut pas être localisée.
+    `deadline` (time.monotonic()) : les sections non obtenues à cette échéance
+    sont marquées PENDING_SECTION et listées dans risk_assessment.pending_sections.
+    """
+    logger.info(f"🔍 Début de l'analyse pour: {address}")
+
+    geocode_result = geocode_address(address)
+    if not geocode_result['success']:
+        raise AnalysisError('Géocodage échoué',
+                            geocode_result.get('error', 'Impossible de localiser cette adresse'), 404)
+
+    response = {
+        'success': True,
+        'address': {
+            'input': address,
+            'formatted': geocode_result['formatted_address'],
+            'latitude': geocode_result['latitude'],
+            'longitude': geocode_result['longitude'],
+            'municipality': geocode_result.get('municipality', ''),
+            'city': geocode_result.get('city', ''),
+            'region': geocode_result.get('region', ''),
+            'province': 'Québec'
+        },
+    }
+    sections = _fetch_sections(response['address'], deadline)
+    for name in SECTION_FETCHERS:
+        response[name] = sections[name]
+    response['risk_assessment'] = _risk_assessment(response)
+    pending = response['risk_assessment']['pending_sections']
+
+    if pending:
+        logger.info(f"⏱️ Analyse partielle pour {address}, en attente: {', '.join(pending)}")
+    else:
+        logger.info(f"✅ Analyse complétée pour {address}")
+    return response
+
+
+def risk_score_value(result: dict):
+    """Score global d'un rapport, tel que stocké dans analysis_history.risk_score."""
+    risk_score = result.get('risk_assessment')
+    if isinstance(risk_score, dict):
+        return risk_score.get('overall_score') or risk_score.get('score')
+    return None
+
+
+def refresh_sections(result: dict, names: list, deadline: float = None) -> list:
+    """
+    Recalcule `names` et les sections restées en attente, en parallèle
+    jusqu'à `deadline` (time.monotonic()), puis le risque ; retourne les
+    sections rafraîchies. Une section en repli, en échec ou non obtenue à
+    l'échéance garde sa version stockée.
+    """
+    futures = {name: _submit_section(name, result['address'])
+               for name in dict.fromkeys(list(names) + _pending(result)) if name in SECTION_FETCHERS}
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    done, _ = wait(futures.values(), timeout=timeout)
+    refreshed = []
+    for name, future in futures.items():
+        if future not in done:
+            logger.warning(f"⚠️ Section {name} non rafraîchie à l'échéance, version stockée conservée")
+            continue
+        try:
+            value, degraded = future.result()
+        except Exception as e:
+            logger.warning(f"⚠️ Section {name} non rafraîchie, version stockée conservée: {e}")
+            continue
+        if degraded:
+            logger.warning(f"⚠️ Section {name} en repli, version stockée conservée")
+            continue
+        result[name] = value
+        refreshed.append(name)
+    if refreshed and 'risk_assessment' in result:
+        result['risk_assessment'] = _risk_assessment(result)
+    return refreshed
@@ -1,7 +1,8 @@
 import os
-import json
 import logging
+import time
 from datetime import datetime, timezone
+from functools import wraps
 
 import psycopg2
 from flask import Flask, request, jsonify, g
@@ -9,27 +10,46 @@ from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
-from data_fetcher import (
-    geocode_address,
-    check_flood_zones,
-    get_contaminated_sites,
-    get_nearby_services,
-    get_fire_hydrants,
-    get_seismic_data,
-    get_air_quality,
-    get_disaster_history,
-    get_property_assessment,
-    get_crime_data,
-    calculate_risk_assessment,
+from analysis import (
+    ANALYZE_MAX_WAIT_MS,
+    ANALYZE_MAX_WAIT_MS_LIMIT,
+    AnalysisError,
+    analyze,
+    cache_stats as section_cache_stats,
+    refresh_sections,
+    risk_score_value,
 )
+from admission import AdmissionRejected, analysis_admission
+from db import DB_DSN, PoolTimeout, get_pool
+from history import (
+    HISTORY_PAGE_MAX,
+    HISTORY_PAGE_SIZE,
+    list_history,
+    load_result,
+    record_analysis,
+    result_etag,
+    save_refreshed_sections,
+    section_digests,
+    stale_sections,
+    writer_stats,
+)
+from jobs import JobQueueFull, get_job, submit_job
+from outbound import latency_stats as outbound_latency_stats, stats as outbound_stats
 from auth import (
+    PasswordHasherBusy,
     hash_password,
     verify_password,
+    password_needs_rehash,
+    password_pool_stats,
     create_access_token,
     create_refresh_token,
     decode_token,
     require_auth,
     require_admin,
+    invalidate_user,
+    get_user,
+    is_token_revoked,
+    revoke_token,
 )
 
 # ---------------------------------------------------------------------------
@@ -57,16 +77,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DB_DSN = os.environ.get('VIGIE_DB_DSN', 'dbname=vigie_immo')
-
 # ---------------------------------------------------------------------------
 # Database helpers
 # ---------------------------------------------------------------------------
 
 def get_db():
-    """Return a per-request cached psycopg2 connection."""
+    """Return the request's psycopg2 connection, borrowed from the worker's pool."""
     if 'db' not in g:
-        g.db = psycopg2.connect(DB_DSN)
+        g.db = get_pool().getconn()
         g.db.autocommit = False
     return g.db
 
@@ -75,11 +93,45 @@ def get_db():
 def close_db(exc):
     db = g.pop('db', None)
     if db is not None:
-        if exc is None:
-            db.commit()
-        else:
-            db.rollback()
-        db.close()
+        try:
+            if exc is None:
+                db.commit()
+            else:
+                db.rollback()
+        finally:
+            get_pool().putconn(db)
+
+
+def release_db(f):
+    """Route decorator: give the connection borrowed by auth back before a long wait (admission, sources)."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        close_db(None)
+        return f(*args, **kwargs)
+    return decorated
+
+
+@app.errorhandler(PoolTimeout)
+def db_pool_timeout(exc):
+    logger.warning(f"⚠️ {exc}")
+    response = jsonify({'success': False, 'error': 'Service momentanément surchargé, réessayez'})
+    response.headers['Retry-After'] = '2'
+    return response, 503
+
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(exc):
+    logger.warning(f"🚦 Analyse refusée ({exc})")
+    response = jsonify({'success': False, 'error': "Trop d'analyses en cours, réessayez dans un instant"})
+    response.headers['Retry-After'] = str(exc.retry_after)
+    return response, 503
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(exc):
+    response = jsonify({'success': False, 'error': 'Serveur occupé, réessayez dans un instant'})
+    response.headers['Retry-After'] = '1'
+    return response, 429
 
 
 # ---------------------------------------------------------------------------
@@ -114,6 +166,18 @@ def login():
     if status != 'active':
         return jsonify({'success': False, 'error': 'Compte suspendu'}), 403
 
+    # Facteur de coût modifié : re-hacher tant que le mot de passe est connu
+    if password_needs_rehash(row[3]):
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                'UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s',
+                (hash_password(password), user_id, row[3])
+            )
+            cur.close()
+        except PasswordHasherBusy:
+            pass  # au prochain login
+
     access_token = create_access_token(user_id)
     refresh_token = create_refresh_token(user_id)
 
@@ -149,22 +213,14 @@ def refresh():
     if payload.get('type') != 'refresh':
         return jsonify({'success': False, 'error': 'Type de token invalide'}), 401
 
-    jti = payload.get('jti', '')
-    conn = get_db()
-    cur = conn.cursor()
-
     # Vérifier si le token est blacklisté
-    cur.execute('SELECT 1 FROM token_blacklist WHERE token_jti = %s', (jti,))
-    if cur.fetchone():
-        cur.close()
+    if is_token_revoked(payload.get('jti', '')):
         return jsonify({'success': False, 'error': 'Token révoqué'}), 401
 
     user_id = payload['sub']
-    cur.execute('SELECT status FROM users WHERE id = %s', (user_id,))
-    user = cur.fetchone()
-    cur.close()
+    user = get_user(user_id)
 
-    if user is None or user[0] != 'active':
+    if user is None or user['status'] != 'active':
         return jsonify({'success': False, 'error': 'Compte inactif'}), 403
 
     return jsonify({
@@ -191,10 +247,7 @@ def logout():
 
             conn = get_db()
             cur = conn.cursor()
-            cur.execute(
-                'INSERT INTO token_blacklist (token_jti, expires_at) VALUES (%s, %s) ON CONFLICT DO NOTHING',
-                (jti, expires_at)
-            )
+            revoke_token(cur, jti, expires_at)
             cur.close()
         except Exception:
             pass  # Token déjà invalide, on ignore
@@ -238,6 +291,7 @@ def change_password():
 
     new_hash = hash_password(new_pw)
     cur.execute('UPDATE users SET password_hash = %s WHERE id = %s', (new_hash, g.user_id))
+    invalidate_user(cur, g.user_id)
     cur.close()
 
     return jsonify({'success': True, 'message': 'Mot de passe modifié'}), 200
@@ -246,19 +300,21 @@ def change_password():
 @app.route('/api/history', methods=['GET'])
 @require_auth
 def get_history():
-    """GET /api/history — analysis history for current user"""
+    """GET /api/history?limit=&cursor= — analysis history for current user, newest first"""
+    try:
+        limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Paramètre limit invalide'}), 400
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+
     conn = get_db()
     cur = conn.cursor()
-    cur.execute(
-        '''SELECT id, address, risk_score, created_at
-           FROM analysis_history
-           WHERE user_id = %s
-           ORDER BY created_at DESC
-           LIMIT 50''',
-        (g.user_id,)
-    )
-    rows = cur.fetchall()
-    cur.close()
+    try:
+        rows, next_cursor = list_history(cur, g.user_id, limit, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Curseur de pagination invalide'}), 400
+    finally:
+        cur.close()
 
     history = [
         {
@@ -269,7 +325,68 @@ def get_history():
         }
         for r in rows
     ]
-    return jsonify({'success': True, 'history': history}), 200
+    return jsonify({'success': True, 'history': history, 'next_cursor': next_cursor}), 200
+
+
+def _report_response(etag: str, result: dict = None):
+    """Stored report (200) or 304 Not Modified when result is None; revalidated on every use."""
+    response = jsonify(result) if result is not None else app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/api/history/<int:history_id>', methods=['GET'])
+@require_auth
+def get_history_entry(history_id):
+    """GET /api/history/<id>[?refresh=1] — stored report, with ETag / If-None-Match"""
+    refresh = request.args.get('refresh', '').lower() in ('1', 'true')
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            '''SELECT result_json, result_sections, created_at, sections_refreshed_at
+               FROM analysis_history
+               WHERE id = %s AND user_id = %s''',
+            (history_id, g.user_id)
+        )
+        row = cur.fetchone()
+        if row is None:
+            return jsonify({'success': False, 'error': 'Analyse introuvable'}), 404
+        result_json, result_sections, created_at, refreshed_at = row
+
+        names = result_sections or result_json or {}
+        now = datetime.now(timezone.utc)
+        stale = stale_sections(names, created_at, now, refreshed_at) if refresh else []
+        if not stale:
+            # The ETag comes from the stored digests: a 304 never reads the sections
+            etag = result_etag(result_sections if result_sections is not None
+                               else section_digests(result_json))
+            if request.if_none_match.contains(etag):
+                return _report_response(etag)
+        result = load_result(cur, result_json, result_sections)
+    finally:
+        cur.close()
+
+    if stale:
+        # Give the connection back while the sources are queried
+        close_db(None)
+        with analysis_admission.admitted():
+            refreshed = refresh_sections(result, stale, time.monotonic() + ANALYZE_MAX_WAIT_MS / 1000)
+        logger.info(f"🔄 Analyse {history_id}: sections rafraîchies {refreshed}")
+        if refreshed:
+            cur = get_db().cursor()
+            try:
+                result_sections = save_refreshed_sections(
+                    cur, history_id, created_at, result, refreshed, now)
+            finally:
+                cur.close()
+        else:
+            result_sections = section_digests(result)
+        etag = result_etag(result_sections)
+        if request.if_none_match.contains(etag):
+            return _report_response(etag)
+    return _report_response(etag, result)
 
 
 # ---------------------------------------------------------------------------
@@ -370,6 +487,7 @@ def admin_update_user(user_id):
 
     params.append(user_id)
     cur.execute(f'UPDATE users SET {", ".join(updates)} WHERE id = %s', params)
+    invalidate_user(cur, user_id)
     cur.close()
 
     return jsonify({'success': True, 'message': 'Utilisateur mis à jour'}), 200
@@ -386,6 +504,8 @@ def admin_delete_user(user_id):
     cur = conn.cursor()
     cur.execute('DELETE FROM users WHERE id = %s RETURNING id', (user_id,))
     deleted = cur.fetchone()
+    if deleted is not None:
+        invalidate_user(cur, user_id)
     cur.close()
 
     if deleted is None:
@@ -394,6 +514,25 @@ def admin_delete_user(user_id):
     return jsonify({'success': True, 'message': 'Utilisateur supprimé'}), 200
 
 
+@app.route('/api/admin/metrics', methods=['GET'])
+@require_admin
+def admin_metrics():
+    """GET /api/admin/metrics — internal metrics of this worker"""
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'metrics': {
+            'password_hashing': password_pool_stats(),
+            'db_pool': get_pool().stats(),
+            'history_writer': writer_stats(),
+            'analysis_admission': analysis_admission.stats(),
+            'outbound': outbound_stats(),
+            'outbound_latency': outbound_latency_stats(),
+            'section_cache': section_cache_stats(),
+        },
+    }), 200
+
+
 # ---------------------------------------------------------------------------
 # Main analyze route — protected
 # ---------------------------------------------------------------------------
@@ -401,6 +540,8 @@ def admin_delete_user(user_id):
 @app.route('/api/analyze', methods=['POST'])
 @require_auth
 @limiter.limit("20 per minute")
+@release_db
+@analysis_admission.limit
 def analyze_address():
     """POST /api/analyze — analyse une adresse (authentification requise)"""
     if g.user.get('status') != 'active':
@@ -417,85 +558,31 @@ def analyze_address():
                 'message': 'Le champ "address" est requis'
             }), 400
 
-        address = data['address']
-        logger.info(f"🔍 Début de l'analyse pour: {address}")
-
-        geocode_result = geocode_address(address)
-        if not geocode_result['success']:
+        try:
+            max_wait_ms = int(data.get('max_wait_ms', ANALYZE_MAX_WAIT_MS))
+        except (TypeError, ValueError):
             return jsonify({
                 'success': False,
-                'error': 'Géocodage échoué',
-                'message': geocode_result.get('error', 'Impossible de localiser cette adresse')
-            }), 404
-
-        lat = geocode_result['latitude']
-        lng = geocode_result['longitude']
-        formatted_address = geocode_result['formatted_address']
-
-        flood_data = check_flood_zones(lat, lng, geocode_result.get('municipality', ''))
-        contamination_data = get_contaminated_sites(lat, lng, radius_m=500,
-                                                    municipality=geocode_result.get('municipality', ''))
-        services_data = get_nearby_services(lat, lng, radius_m=500,
-                                            municipality=geocode_result.get('municipality', ''))
-        hydrants_data = get_fire_hydrants(lat, lng, radius_m=500)
-        seismic_data = get_seismic_data(lat, lng)
-        air_quality_data = get_air_quality(lat, lng)
-        disaster_data = get_disaster_history(lat, lng, radius_km=25)
-        property_data = get_property_assessment(lat, lng, address=address)
-        crime_data_result = get_crime_data(lat, lng)
-        risk_score = calculate_risk_assessment(
-            flood_data, contamination_data, services_data,
-            hydrants_data=hydrants_data,
-            seismic_data=seismic_data,
-            air_quality_data=air_quality_data,
-            disaster_data=disaster_data,
-            crime_data=crime_data_result
-        )
+                'error': 'Paramètre invalide',
+                'message': 'Le champ "max_wait_ms" doit être un entier'
+            }), 400
+        # Sections en retard à l'échéance : réponse partielle, la suite alimente le cache
+        deadline = time.monotonic() + min(max(max_wait_ms, 0), ANALYZE_MAX_WAIT_MS_LIMIT) / 1000
 
-        response = {
-            'success': True,
-            'address': {
-                'input': address,
-                'formatted': formatted_address,
-                'latitude': lat,
-                'longitude': lng,
-                'municipality': geocode_result.get('municipality', ''),
-                'city': geocode_result.get('city', ''),
-                'region': geocode_result.get('region', ''),
-                'province': 'Québec'
-            },
-            'flood_zones': flood_data,
-            'contamination': contamination_data,
-            'services': services_data,
-            'hydrants': hydrants_data,
-            'seismic': seismic_data,
-            'air_quality': air_quality_data,
-            'disaster_history': disaster_data,
-            'property_assessment': property_data,
-            'crime': crime_data_result,
-            'risk_assessment': risk_score
-        }
+        address = data['address']
+        response = analyze(address, deadline)
 
         # Sauvegarder dans l'historique
         try:
-            score_val = None
-            if isinstance(risk_score, dict):
-                score_val = risk_score.get('overall_score') or risk_score.get('score')
-
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute(
-                '''INSERT INTO analysis_history (user_id, address, risk_score, result_json)
-                   VALUES (%s, %s, %s, %s)''',
-                (g.user_id, formatted_address, score_val, json.dumps(response))
-            )
-            cur.close()
+            record_analysis(g.user_id, response['address']['formatted'], risk_score_value(response), response)
         except Exception as hist_err:
             logger.warning(f"⚠️ Impossible de sauvegarder l'historique: {hist_err}")
 
-        logger.info(f"✅ Analyse complétée pour {address}")
         return jsonify(response), 200
 
+    except AnalysisError as e:
+        return jsonify({'success': False, 'error': e.error, 'message': e.message}), e.status
+
     except Exception as e:
         logger.error(f"💥 ERREUR CRITIQUE: {str(e)}", exc_info=True)
         return jsonify({
@@ -505,6 +592,59 @@ def analyze_address():
         }), 500
 
 
+@app.route('/api/analyze/jobs', methods=['POST'])
+@require_auth
+@limiter.limit("20 per minute")
+def submit_analysis_job():
+    """POST /api/analyze/jobs — met une analyse en file, répond aussitôt avec l'id du job"""
+    if g.user.get('status') != 'active':
+        return jsonify({'success': False, 'error': 'Compte suspendu'}), 403
+
+    data = request.get_json(force=True, silent=True) or {}
+    address = (data.get('address') or '').strip()
+    if not address:
+        return jsonify({
+            'success': False,
+            'error': 'Adresse manquante',
+            'message': 'Le champ "address" est requis'
+        }), 400
+
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        job_id = submit_job(cur, g.user_id, address)
+    except JobQueueFull:
+        response = jsonify({'success': False, 'error': "Trop d'analyses en attente, réessayez plus tard"})
+        response.headers['Retry-After'] = '30'
+        return response, 429
+    finally:
+        cur.close()
+
+    logger.info(f"📥 Job {job_id} en file pour l'adresse: {address}")
+    response = jsonify({'success': True, 'job': {'id': job_id, 'status': 'queued'}})
+    response.headers['Location'] = f'/api/analyze/jobs/{job_id}'
+    return response, 202
+
+
+@app.route('/api/analyze/jobs/<int:job_id>', methods=['GET'])
+@require_auth
+def get_analysis_job(job_id):
+    """GET /api/analyze/jobs/<id> — état du job ; rapport (done) ou erreur (failed)"""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        job = get_job(cur, job_id, g.user_id)
+    finally:
+        cur.close()
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job introuvable'}), 404
+
+    response = jsonify({'success': True, 'job': job})
+    if job['status'] in ('queued', 'running'):
+        response.headers['Retry-After'] = '2'   # intervalle de relance suggéré
+    return response, 200
+
+
 # ---------------------------------------------------------------------------
 # Utility routes
 # ---------------------------------------------------------------------------
@@ -1,33 +1,179 @@
 """
 auth.py — JWT + bcrypt authentication helpers for Vigie-Immo
 """
+import logging
 import os
+import random
+import select
+import threading
+import time
 import uuid
 from datetime import datetime, timezone, timedelta
 from functools import wraps
 
 import bcrypt
 import jwt
+import psycopg2
 from flask import request, jsonify, g
 
+from db import DB_DSN
+
 JWT_SECRET = os.environ.get('JWT_SECRET', 'changeme-set-in-env')
 JWT_ACCESS_EXPIRE = int(os.environ.get('JWT_ACCESS_EXPIRE', 3600))       # 1h
 JWT_REFRESH_EXPIRE = int(os.environ.get('JWT_REFRESH_EXPIRE', 2592000))  # 30j
 ALGORITHM = 'HS256'
 
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))  # seconds, 0 = disabled
+USER_CACHE_CHANNEL = 'vigie_user_cache'
+REVOKED_TOKEN_CHANNEL = 'vigie_token_revoked'
+TOKEN_PURGE_INTERVAL = int(os.environ.get('TOKEN_PURGE_INTERVAL', 3600))  # seconds
+TOKEN_PURGE_BATCH = 10000
+_TOKEN_PURGE_LOCK = 0x5647_0001  # pg advisory lock key
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))             # cost factor
+BCRYPT_CONCURRENCY = int(os.environ.get('BCRYPT_CONCURRENCY', 4))    # whole server, 0 = unbounded
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', 16))   # whole server, running + waiting
+
+logger = logging.getLogger(__name__)
+
 
 # ---------------------------------------------------------------------------
 # Password helpers
 # ---------------------------------------------------------------------------
+#
+# bcrypt runs in the request thread (it releases the GIL) but at most
+# BCRYPT_CONCURRENCY hashes run at once across the server, so that a burst of
+# logins cannot take every core. At most BCRYPT_MAX_PENDING operations are
+# running or waiting; beyond that PasswordHasherBusy is raised at once (429 in
+# app.py) instead of queueing behind the burst. Both limits are split between
+# the gunicorn workers (set_worker_count, called from post_fork).
+
+class PasswordHasherBusy(Exception):
+    """This worker's share of BCRYPT_MAX_PENDING is already in use."""
+
+
+_bcrypt_lock = threading.Lock()
+_bcrypt_limits = {}
+_bcrypt_slots = None
+_bcrypt_stats = {
+    'pending': 0,
+    'peak_pending': 0,
+    'completed': 0,
+    'rejected': 0,
+    'wait_seconds': 0.0,
+    'run_seconds': 0.0,
+}
+
+
+def _gevent_threadpool():
+    """Return gevent's hub threadpool if gevent patched threading, else None."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('threading'):
+        return None
+    from gevent import get_hub
+    return get_hub().threadpool
+
+
+def set_worker_count(workers: int) -> None:
+    """Split the server-wide bcrypt limits between `workers` processes."""
+    global _bcrypt_slots
+    workers = max(int(workers), 1)
+    concurrency = -(-BCRYPT_CONCURRENCY // workers) if BCRYPT_CONCURRENCY > 0 else 0
+    with _bcrypt_lock:
+        _bcrypt_limits['workers'] = workers
+        _bcrypt_limits['concurrency'] = concurrency
+        _bcrypt_limits['max_pending'] = max(-(-BCRYPT_MAX_PENDING // workers), concurrency)
+        _bcrypt_slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+
+set_worker_count(1)
+
+
+def _bcrypt_hash(password: bytes, rounds: int):
+    t0 = time.perf_counter()
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)), time.perf_counter() - t0
+
+
+def _bcrypt_check(password: bytes, password_hash: bytes):
+    t0 = time.perf_counter()
+    return bcrypt.checkpw(password, password_hash), time.perf_counter() - t0
+
+
+def _call_bcrypt(fn, *args):
+    # Under gevent a C call blocks the hub: run it in the hub's threadpool
+    threadpool = _gevent_threadpool()
+    if threadpool is not None:
+        return threadpool.apply(fn, args)
+    return fn(*args)
+
+
+def _run_bcrypt(fn, *args):
+    """Run fn once a bcrypt slot of this worker is free and return its result."""
+    with _bcrypt_lock:
+        slots = _bcrypt_slots
+        if slots is not None and _bcrypt_stats['pending'] >= _bcrypt_limits['max_pending']:
+            _bcrypt_stats['rejected'] += 1
+            raise PasswordHasherBusy()
+        _bcrypt_stats['pending'] += 1
+        _bcrypt_stats['peak_pending'] = max(_bcrypt_stats['peak_pending'], _bcrypt_stats['pending'])
+
+    t0 = time.perf_counter()
+    try:
+        if slots is None:
+            result, run_seconds = _call_bcrypt(fn, *args)
+        else:
+            with slots:
+                result, run_seconds = _call_bcrypt(fn, *args)
+    finally:
+        with _bcrypt_lock:
+            _bcrypt_stats['pending'] -= 1
+
+    with _bcrypt_lock:
+        _bcrypt_stats['completed'] += 1
+        _bcrypt_stats['run_seconds'] += run_seconds
+        _bcrypt_stats['wait_seconds'] += max(time.perf_counter() - t0 - run_seconds, 0.0)
+    return result
+
+
+def password_pool_stats() -> dict:
+    """Queue depth and timings of bcrypt in this worker."""
+    with _bcrypt_lock:
+        stats = dict(_bcrypt_stats)
+        limits = dict(_bcrypt_limits)
+    completed = stats['completed']
+    return {
+        'rounds': BCRYPT_ROUNDS,
+        'workers': limits['workers'],
+        'concurrency': limits['concurrency'],
+        'max_pending': limits['max_pending'],
+        'pending': stats['pending'],
+        'peak_pending': stats['peak_pending'],
+        'completed': completed,
+        'rejected': stats['rejected'],
+        'avg_wait_ms': round(stats['wait_seconds'] / completed * 1000, 1) if completed else None,
+        'avg_run_ms': round(stats['run_seconds'] / completed * 1000, 1) if completed else None,
+    }
+
 
 def hash_password(password: str) -> str:
-    """Return a bcrypt hash of the password."""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    """Return a bcrypt hash of the password (cost BCRYPT_ROUNDS)."""
+    return _run_bcrypt(_bcrypt_hash, password.encode('utf-8'), BCRYPT_ROUNDS).decode('utf-8')
 
 
 def verify_password(password: str, password_hash: str) -> bool:
     """Return True if password matches the stored hash."""
-    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    return _run_bcrypt(_bcrypt_check, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """Return True if the hash was made with a cost factor other than BCRYPT_ROUNDS."""
+    try:
+        return int(password_hash.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
 
 
 # ---------------------------------------------------------------------------
@@ -82,6 +228,225 @@ def _get_db():
     return get_db()
 
 
+# ---------------------------------------------------------------------------
+# Shared state across workers — user cache and revoked refresh tokens
+# ---------------------------------------------------------------------------
+#
+# Each process (gunicorn worker) keeps a user cache, entries valid
+# USER_CACHE_TTL seconds, and the set of revoked refresh-token JTIs that have
+# not expired yet, loaded from token_blacklist. Changes are published with
+# NOTIFY in the transaction that makes them, so the listener thread of every
+# worker applies them on commit. On (re)connect the listener clears the user
+# cache and reloads the revoked set; while it is disconnected revocation
+# checks fall back to token_blacklist and the TTL bounds user staleness.
+# The same thread purges expired token_blacklist rows every
+# TOKEN_PURGE_INTERVAL seconds.
+
+_user_cache = {}          # user_id -> (monotonic expiry, user dict)
+_user_cache_lock = threading.Lock()
+_listener_pid = None      # pid whose listener thread is running
+_revoked = {}             # jti -> expiry (epoch seconds)
+_revoked_ready = False    # True while _revoked mirrors token_blacklist
+
+
+def _drop_cached_users(user_id=None):
+    with _user_cache_lock:
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(user_id, None)
+
+
+def _load_revoked(cur):
+    """Replace the revoked set with the unexpired rows of token_blacklist."""
+    global _revoked_ready
+    cur.execute('SELECT token_jti, EXTRACT(EPOCH FROM expires_at) FROM token_blacklist WHERE expires_at > NOW()')
+    rows = cur.fetchall()
+    with _user_cache_lock:
+        _revoked.clear()
+        _revoked.update((jti, float(expires)) for jti, expires in rows)
+        _revoked_ready = True
+
+
+def purge_expired_tokens(cur) -> int:
+    """
+    Delete expired token_blacklist rows in batches of TOKEN_PURGE_BATCH
+    (short transactions on an autocommit connection), one worker at a time.
+    Returns the number of rows deleted.
+    """
+    cur.execute('SELECT pg_try_advisory_lock(%s)', (_TOKEN_PURGE_LOCK,))
+    if not cur.fetchone()[0]:
+        return 0  # another worker is purging
+    purged = 0
+    try:
+        while True:
+            cur.execute(
+                '''DELETE FROM token_blacklist WHERE id IN (
+                       SELECT id FROM token_blacklist WHERE expires_at < NOW() LIMIT %s)''',
+                (TOKEN_PURGE_BATCH,)
+            )
+            purged += cur.rowcount
+            if cur.rowcount < TOKEN_PURGE_BATCH:
+                break
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(%s)', (_TOKEN_PURGE_LOCK,))
+
+    now = time.time()
+    with _user_cache_lock:
+        for jti in [jti for jti, expires in _revoked.items() if expires < now]:
+            del _revoked[jti]
+    return purged
+
+
+def _handle_notification(notify):
+    if notify.channel == REVOKED_TOKEN_CHANNEL:
+        jti, _, expires = notify.payload.partition(' ')
+        with _user_cache_lock:
+            _revoked[jti] = float(expires or 'inf')
+    else:
+        payload = notify.payload
+        _drop_cached_users(int(payload) if payload.isdigit() else None)
+
+
+def _listen_notifications():
+    """Listener thread: apply user and token notifications from every worker, purge expired tokens."""
+    global _revoked_ready
+    # Workers purge at different times
+    next_purge = time.monotonic() + random.uniform(0, TOKEN_PURGE_INTERVAL)
+    while True:
+        conn = None
+        try:
+            # Dedicated connection: LISTEN must stay on the same session
+            conn = psycopg2.connect(DB_DSN)
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f'LISTEN {USER_CACHE_CHANNEL}; LISTEN {REVOKED_TOKEN_CHANNEL}')
+            _drop_cached_users()  # notifications may have been missed while disconnected
+            _load_revoked(cur)
+            while True:
+                if time.monotonic() >= next_purge:
+                    purged = purge_expired_tokens(cur)
+                    if purged:
+                        logger.info(f"{purged} jetons expirés supprimés de token_blacklist")
+                    next_purge = time.monotonic() + TOKEN_PURGE_INTERVAL
+                # Queries may already have collected notifications
+                if not conn.notifies:
+                    timeout = min(60, max(next_purge - time.monotonic(), 0))
+                    if not select.select([conn], [], [], timeout)[0]:
+                        continue
+                    conn.poll()
+                while conn.notifies:
+                    _handle_notification(conn.notifies.pop(0))
+        except Exception as e:
+            logger.warning(f"Écoute des notifications d'authentification interrompue : {e}")
+            _revoked_ready = False
+            _drop_cached_users()
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def _ensure_listener():
+    """Start the listener once per process; after a fork the inherited state is discarded."""
+    global _listener_pid, _revoked_ready
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _user_cache_lock:
+        if _listener_pid == pid:
+            return
+        _user_cache.clear()
+        _revoked.clear()
+        _revoked_ready = False
+        _listener_pid = pid
+    threading.Thread(target=_listen_notifications, name='auth-listener', daemon=True).start()
+
+
+def _get_cached_user(user_id):
+    if USER_CACHE_TTL <= 0:
+        return None
+    _ensure_listener()
+    entry = _user_cache.get(user_id)
+    if entry is None or entry[0] < time.monotonic():
+        return None
+    return entry[1]
+
+
+def _cache_user(user_id, user: dict):
+    if USER_CACHE_TTL > 0:
+        with _user_cache_lock:
+            _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+
+
+def invalidate_user(cur, user_id: int):
+    """
+    Invalidate the cached user in every worker.
+    Must run in the transaction that modifies the user: the notification
+    is delivered when it commits.
+    """
+    _drop_cached_users(user_id)
+    cur.execute('SELECT pg_notify(%s, %s)', (USER_CACHE_CHANNEL, str(user_id)))
+
+
+def is_token_revoked(jti: str) -> bool:
+    """
+    Return True if the refresh token jti was revoked (logout).
+    Answered from memory while the listener is connected, otherwise from
+    token_blacklist.
+    """
+    _ensure_listener()
+    if _revoked_ready:
+        return jti in _revoked
+
+    conn = _get_db()
+    cur = conn.cursor()
+    cur.execute('SELECT 1 FROM token_blacklist WHERE token_jti = %s', (jti,))
+    revoked = cur.fetchone() is not None
+    cur.close()
+    return revoked
+
+
+def revoke_token(cur, jti: str, expires_at: datetime):
+    """
+    Blacklist a refresh token until it expires, in every worker.
+    The notification is delivered when the current transaction commits.
+    """
+    cur.execute(
+        'INSERT INTO token_blacklist (token_jti, expires_at) VALUES (%s, %s) ON CONFLICT DO NOTHING',
+        (jti, expires_at)
+    )
+    cur.execute('SELECT pg_notify(%s, %s)', (REVOKED_TOKEN_CHANNEL, f'{jti} {expires_at.timestamp()}'))
+
+
+def get_user(user_id):
+    """Return the user dict for user_id (cache, then users table), or None."""
+    user = _get_cached_user(user_id)
+    if user is not None:
+        return user
+
+    conn = _get_db()
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT id, email, name, status, is_admin FROM users WHERE id = %s',
+        (user_id,)
+    )
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        return None
+
+    user = {
+        'id': row[0],
+        'email': row[1],
+        'name': row[2],
+        'status': row[3],
+        'is_admin': row[4],
+    }
+    _cache_user(user_id, user)
+    return user
+
+
 def require_auth(f):
     """
     Flask decorator — validates JWT access token in Authorization header.
@@ -105,27 +470,12 @@ def require_auth(f):
         if payload.get('type') != 'access':
             return jsonify({'success': False, 'error': 'Type de token invalide'}), 401
 
-        user_id = payload['sub']
-        conn = _get_db()
-        cur = conn.cursor()
-        cur.execute(
-            'SELECT id, email, name, status, is_admin FROM users WHERE id = %s',
-            (user_id,)
-        )
-        row = cur.fetchone()
-        cur.close()
-
-        if row is None:
+        user = get_user(payload['sub'])
+        if user is None:
             return jsonify({'success': False, 'error': 'Utilisateur introuvable'}), 401
 
-        g.user_id = row[0]
-        g.user = {
-            'id': row[0],
-            'email': row[1],
-            'name': row[2],
-            'status': row[3],
-            'is_admin': row[4],
-        }
+        g.user_id = user['id']
+        g.user = dict(user)
         return f(*args, **kwargs)
 
     return decorated
@@ -1,25 +1,20 @@
+import contextvars
+import functools
 import json
 import os
+from contextlib import contextmanager
 from typing import Dict, List, Optional, Tuple
 from geopy.distance import geodesic
 import requests
 import logging
 
 import psycopg2
-import psycopg2.pool
 import psycopg2.extras
 
-logger = logging.getLogger(__name__)
-
-# Pool de connexions PostGIS pour l'évaluation foncière
-_db_pool = None
+import outbound
+from db import PoolTimeout, get_pool
 
-def _get_db_pool():
-    global _db_pool
-    if _db_pool is None:
-        dsn = os.environ.get("VIGIE_DB_DSN", "dbname=vigie_immo")
-        _db_pool = psycopg2.pool.SimpleConnectionPool(1, 5, dsn=dsn)
-    return _db_pool
+logger = logging.getLogger(__name__)
 
 # URLs des APIs et datasets
 GEOCODING_API_QC = "https://ws.mapserver.transports.gouv.qc.ca/swtq"
@@ -104,6 +99,44 @@ MONTREAL_SERVICES = {
     ]
 }
 
+# ============================================================================
+# SUIVI DES REPLIS
+# ============================================================================
+#
+# Une section dont la source a échoué reste calculée, avec des données de
+# repli. track_fallbacks() permet à l'appelant (cache des sections) de le
+# savoir : les replis servis dans le bloc y sont listés. Un échec rattrapé
+# par une autre source (miroir Overpass, données ouvertes de Montréal) n'en
+# est pas un.
+
+_fallbacks = contextvars.ContextVar('data_fetcher_fallbacks', default=None)
+
+
+@contextmanager
+def track_fallbacks():
+    """with track_fallbacks() as fallbacks: ... — replis servis dans le bloc [(repli, cause)]."""
+    fallbacks = []
+    token = _fallbacks.set(fallbacks)
+    try:
+        yield fallbacks
+    finally:
+        _fallbacks.reset(token)
+
+
+def _fell_back(name: str, cause) -> None:
+    fallbacks = _fallbacks.get()
+    if fallbacks is not None:
+        fallbacks.append((name, cause))
+
+
+def _fallback(fn):
+    """Fonction de repli : chaque appel est noté dans track_fallbacks()."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _fell_back(fn.__name__, 'source indisponible')
+        return fn(*args, **kwargs)
+    return wrapper
+
 # ============================================================================
 # FONCTIONS DE GÉOCODAGE
 # ============================================================================
@@ -122,7 +155,8 @@ def geocode_address(address: str) -> Dict:
         headers = {'User-Agent': 'RapportRisqueImmobilier-Québec/2.0'}
         
         logger.info(f"Tentative de géocodage avec API Québec: {address}")
-        response = requests.get(GEOCODING_API_QC, params=params, headers=headers, timeout=10)
+        response = outbound.get(GEOCODING_API_QC, params=params, headers=headers, timeout=10,
+                                source='geocoding_qc')
         
         if response.status_code != 200:
             logger.warning("API Québec non disponible, utilisation de Nominatim")
@@ -200,7 +234,8 @@ def geocode_with_nominatim(address: str) -> Dict:
         headers = {'User-Agent': 'RapportRisqueImmobilier-Québec/2.0'}
         
         logger.info(f"Tentative de géocodage avec Nominatim: {search_address}")
-        response = requests.get(GEOCODING_API_BACKUP, params=params, headers=headers, timeout=10)
+        response = outbound.get(GEOCODING_API_BACKUP, params=params, headers=headers, timeout=10,
+                                source='geocoding_nominatim')
         response.raise_for_status()
         
         data = response.json()
@@ -321,7 +356,7 @@ def check_flood_zones_api(lat: float, lng: float) -> Optional[Dict]:
         }
         
         logger.info(f"Appel API zones inondables pour ({lat}, {lng})")
-        response = requests.get(FLOOD_ZONES_API, params=params, timeout=15)
+        response = outbound.get(FLOOD_ZONES_API, params=params, timeout=15, source='flood_zones')
         
         if response.status_code == 200:
             data = response.json()
@@ -363,11 +398,14 @@ def check_flood_zones_api(lat: float, lng: float) -> Optional[Dict]:
                     "risk_level": risk_level,
                     "data_quality": "Haute"
                 }
+        else:
+            _fell_back('check_flood_zones_api', f'HTTP {response.status_code}')
         
         return None
         
     except Exception as e:
         logger.error(f"Erreur API zones inondables: {e}")
+        _fell_back('check_flood_zones_api', e)
         return None
 
 def get_montreal_flood_zones(lat: float, lng: float, municipality: str = "") -> Dict:
@@ -445,6 +483,7 @@ def check_flood_zones_fallback(lat: float, lng: float, municipality: str = "") -
         logger.error(f"Erreur fallback zones inondables: {e}")
         return get_fallback_flood_data(lat, lng, municipality)
 
+@_fallback
 def get_fallback_flood_data(lat: float, lng: float, municipality: str = "") -> Dict:
     """Données de fallback minimales"""
     region = get_region_from_coordinates(lat, lng)
@@ -645,7 +684,7 @@ def get_contaminated_sites(lat: float, lng: float, radius_m: int = 500, municipa
         }
 
         logger.info(f"Requête API terrains contaminés pour ({lat}, {lng}), rayon {radius_m}m")
-        response = requests.get(CONTAMINATED_SITES_API, params=params, timeout=30)
+        response = outbound.get(CONTAMINATED_SITES_API, params=params, timeout=30, source='contaminated_sites')
         response.raise_for_status()
 
         data = response.json()
@@ -704,6 +743,7 @@ def get_contaminated_sites(lat: float, lng: float, radius_m: int = 500, municipa
         return _fallback_contamination(lat, lng, region)
 
 
+@_fallback
 def _fallback_contamination(lat: float, lng: float, region: str) -> Dict:
     """Fallback quand l'API terrains contaminés est indisponible"""
     return {
@@ -741,7 +781,8 @@ out center body;"""
     data = None
     for endpoint in OVERPASS_ENDPOINTS:
         try:
-            response = requests.post(endpoint, data={'data': query}, timeout=25)
+            response = outbound.post(endpoint, data={'data': query}, timeout=25,
+                                     source='overpass_services')
             response.raise_for_status()
             data = response.json()
             break
@@ -752,6 +793,7 @@ out center body;"""
     results = {'fire_station': None, 'hospital': None, 'police': None}
 
     if data is None:
+        _fell_back('_query_overpass_all_services', 'aucun serveur Overpass disponible')
         return results
 
     try:
@@ -836,6 +878,7 @@ def get_nearby_services(lat: float, lng: float, radius_m: int = 500, municipalit
 
     except Exception as e:
         logger.error(f"Erreur services: {str(e)}")
+        _fell_back('_get_static_services', e)
         return _get_static_services(lat, lng, region, municipality)
 
 
@@ -983,7 +1026,8 @@ out body;"""
 
     for endpoint in OVERPASS_ENDPOINTS:
         try:
-            response = requests.post(endpoint, data={'data': query}, timeout=25)
+            response = outbound.post(endpoint, data={'data': query}, timeout=25,
+                                     source='overpass_hydrants')
             response.raise_for_status()
             data = response.json()
             break
@@ -1049,7 +1093,7 @@ def _query_montreal_hydrants(lat: float, lng: float, radius_m: int) -> Optional[
             f"WHERE \"LATITUDE\" BETWEEN {lat - delta} AND {lat + delta} "
             f"AND \"LONGITUDE\" BETWEEN {lng - delta} AND {lng + delta} LIMIT 100"
         )
-        response = requests.get(url, params={"sql": sql}, timeout=15)
+        response = outbound.get(url, params={"sql": sql}, timeout=15, source='hydrants_mtl')
         response.raise_for_status()
         data = response.json()
 
@@ -1095,6 +1139,7 @@ def _query_montreal_hydrants(lat: float, lng: float, radius_m: int) -> Optional[
         return None
 
 
+@_fallback
 def _fallback_hydrants(lat: float, lng: float) -> Dict:
     """Fallback statique pour les bornes fontaines"""
     region = get_region_from_coordinates(lat, lng)
@@ -1153,8 +1198,8 @@ def get_seismic_data(lat: float, lng: float) -> Dict:
             "siteDesignationXS": "C"
         }
 
-        response = requests.get(url, params=params, timeout=15,
-                                headers={"User-Agent": "VigiImmo/1.0"})
+        response = outbound.get(url, params=params, timeout=15,
+                                headers={"User-Agent": "VigiImmo/1.0"}, source='seismic')
         response.raise_for_status()
         data = response.json()
 
@@ -1188,6 +1233,7 @@ def get_seismic_data(lat: float, lng: float) -> Dict:
     return _fallback_seismic(lat, lng)
 
 
+@_fallback
 def _fallback_seismic(lat: float, lng: float) -> Dict:
     """Fallback statique basé sur la région"""
     region = get_region_from_coordinates(lat, lng)
@@ -1239,12 +1285,14 @@ def get_air_quality(lat: float, lng: float) -> Dict:
             mtl_result = _query_montreal_air_quality(lat, lng)
             if mtl_result is not None:
                 return mtl_result
+            _fell_back('_fallback_air_quality', 'CSV RSQA indisponible')
 
         # Fallback statique
         return _fallback_air_quality(lat, lng, region)
 
     except Exception as e:
         logger.error(f"Erreur qualité de l'air: {e}")
+        _fell_back('_fallback_air_quality', e)
         return _fallback_air_quality(lat, lng, get_region_from_coordinates(lat, lng))
 
 
@@ -1252,7 +1300,7 @@ def _query_montreal_air_quality(lat: float, lng: float) -> Optional[Dict]:
     """Récupère l'IQA en temps réel depuis le CSV RSQA de Montréal"""
     try:
         csv_url = "https://donnees.montreal.ca/dataset/8f3acae0-eb64-4e27-a356-25e33a9ddfab/resource/2ae670a4-0851-4486-81c4-e46dab5b02f5/download/rsqa-indice-qualite-air.csv"
-        response = requests.get(csv_url, timeout=15)
+        response = outbound.get(csv_url, timeout=15, source='air_quality_mtl')
         response.raise_for_status()
 
         # Trouver la station la plus proche
@@ -1360,7 +1408,8 @@ def get_disaster_history(lat: float, lng: float, radius_km: int = 25) -> Dict:
             "&srsName=epsg:4326"
         )
 
-        response = requests.get(url, timeout=30, headers={"User-Agent": "VigiImmo/1.0"})
+        response = outbound.get(url, timeout=30, headers={"User-Agent": "VigiImmo/1.0"},
+                                source='disaster_history')
         response.raise_for_status()
         data = response.json()
 
@@ -1424,6 +1473,7 @@ def get_disaster_history(lat: float, lng: float, radius_km: int = 25) -> Dict:
         return _fallback_disaster_history(lat, lng)
 
 
+@_fallback
 def _fallback_disaster_history(lat: float, lng: float) -> Dict:
     """Fallback pour l'historique de sinistres"""
     region = get_region_from_coordinates(lat, lng)
@@ -1448,9 +1498,7 @@ def get_property_assessment(lat: float, lng: float, address: str = "") -> Dict:
     """
     try:
         logger.info(f"Récupération évaluation foncière pour ({lat}, {lng})")
-        pool = _get_db_pool()
-        conn = pool.getconn()
-        try:
+        with get_pool().connection() as conn:
             cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
             cur.execute("""
                 SELECT matricule, civic_number, street_name, municipality,
@@ -1468,8 +1516,6 @@ def get_property_assessment(lat: float, lng: float, address: str = "") -> Dict:
             """, (lng, lat, lng, lat))
             row = cur.fetchone()
             cur.close()
-        finally:
-            pool.putconn(conn)
 
         if row:
             return {
@@ -1484,8 +1530,12 @@ def get_property_assessment(lat: float, lng: float, address: str = "") -> Dict:
                 "data_quality": "Haute"
             }
 
+    except PoolTimeout as e:
+        logger.warning(f"Pool PostgreSQL saturé, évaluation foncière de repli: {e}")
+        _fell_back('_fallback_property_assessment', e)
     except Exception as e:
         logger.warning(f"Erreur évaluation foncière PostGIS: {e}")
+        _fell_back('_fallback_property_assessment', e)
 
     return _fallback_property_assessment(lat, lng)
 
@@ -1523,11 +1573,13 @@ def get_crime_data(lat: float, lng: float) -> Dict:
             mtl_result = _query_montreal_crime(lat, lng)
             if mtl_result is not None:
                 return mtl_result
+            _fell_back('_fallback_crime', 'données ouvertes Montréal indisponibles')
 
         return _fallback_crime(lat, lng, region)
 
     except Exception as e:
         logger.error(f"Erreur données criminalité: {e}")
+        _fell_back('_fallback_crime', e)
         return _fallback_crime(lat, lng, get_region_from_coordinates(lat, lng))
 
 
@@ -1545,7 +1597,7 @@ def _query_montreal_crime(lat: float, lng: float) -> Optional[Dict]:
             f"LIMIT 500"
         )
 
-        response = requests.get(url, params={"sql": sql}, timeout=20)
+        response = outbound.get(url, params={"sql": sql}, timeout=20, source='crime_mtl')
         response.raise_for_status()
         data = response.json()
 
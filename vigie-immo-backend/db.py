@@ -0,0 +1,270 @@
+"""
+db.py — Pool de connexions PostgreSQL partagé par app.py, auth.py et data_fetcher.py
+
+Un pool par processus (worker gunicorn), sûr entre threads. Un emprunt attend
+au plus DB_POOL_TIMEOUT secondes qu'une connexion se libère (PoolTimeout
+au-delà). Chaque connexion applique DB_STATEMENT_TIMEOUT_MS ; une connexion
+inactive depuis plus de DB_POOL_CHECK_IDLE secondes est vérifiée (SELECT 1)
+avant d'être prêtée, et remplacée si elle ne répond plus.
+
+Le pool est ouvert (DB_POOL_MIN connexions) au démarrage du worker par le
+hook post_fork de deploy/gunicorn.conf.py. Après un fork, les connexions
+héritées du parent sont abandonnées sans être fermées (la fermeture
+terminerait la session du parent) et l'enfant ouvre son propre pool. Sous
+gevent (socket monkey-patché), l'attente des requêtes rend la main aux
+autres greenlets.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+DB_DSN = os.environ.get('VIGIE_DB_DSN', 'dbname=vigie_immo')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))             # secondes
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', 30))      # secondes, 0 = toujours
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000))
+
+logger = logging.getLogger(__name__)
+
+_IDLE = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Aucune connexion libérée dans le délai d'attente."""
+
+
+class ConnectionPool:
+    """
+    Pool borné de connexions psycopg2 (minconn ouvertes par warm(),
+    maxconn au plus). Les connexions rendues sont annulées (rollback) si une
+    transaction est restée ouverte, fermées si elles sont cassées.
+    """
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout: float,
+                 check_idle: float, statement_timeout_ms: int):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.statement_timeout_ms = statement_timeout_ms
+        self._cond = threading.Condition()
+        self._idle = []   # [(connexion, instant de retour)], la plus récente en dernier
+        self._size = 0    # connexions ouvertes ou en cours d'ouverture
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'timeouts': 0,
+            'opened': 0,
+            'discarded': 0,
+        }
+
+    def warm(self) -> None:
+        """Ouvre les connexions manquantes jusqu'à minconn ; un échec est journalisé, pas levé."""
+        while True:
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                with self._cond:
+                    self._size -= 1
+                logger.warning(f"Préchauffage du pool PostgreSQL impossible : {e}")
+                return
+            with self._cond:
+                self._stats['opened'] += 1
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _abandon(self) -> list:
+        """Après un fork : retire toutes les connexions du pool sans les fermer et les retourne."""
+        conns = [conn for conn, _ in self._idle]
+        self._idle.clear()
+        self._size = 0
+        return conns
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, options=f'-c statement_timeout={self.statement_timeout_ms}')
+
+    def _healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed or conn.info.transaction_status != _IDLE:
+            return False
+        if time.monotonic() - idle_since < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats['discarded'] += 1
+            self._cond.notify()
+
+    def getconn(self, timeout: float = None):
+        """Emprunte une connexion, en attendant au plus `timeout` secondes (DB_POOL_TIMEOUT par défaut)."""
+        timeout = self.timeout if timeout is None else timeout
+        while True:
+            t0 = time.monotonic()
+            waited = False
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = t0 + timeout - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f"Aucune connexion PostgreSQL libre après {timeout:.1f}s")
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    conn = None
+                    self._size += 1
+                wait = time.monotonic() - t0
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                    self._stats['wait_seconds'] += wait
+                    self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], wait)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats['opened'] += 1
+                return conn
+            if self._healthy(conn, idle_since):
+                return conn
+            logger.warning("Connexion PostgreSQL inutilisable retirée du pool")
+            self._discard(conn)
+
+    def putconn(self, conn, close: bool = False) -> None:
+        """Rend une connexion empruntée ; une transaction restée ouverte est annulée."""
+        if not close and not conn.closed:
+            try:
+                if conn.info.transaction_status != _IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """with pool.connection() as conn: ... — la connexion est rendue en sortie."""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            size, idle = self._size, len(self._idle)
+        waits = stats['waits']
+        return {
+            'min': self.minconn,
+            'max': self.maxconn,
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'checkouts': stats['checkouts'],
+            'waits': waits,
+            'timeouts': stats['timeouts'],
+            'opened': stats['opened'],
+            'discarded': stats['discarded'],
+            'avg_wait_ms': round(stats['wait_seconds'] / waits * 1000, 1) if waits else None,
+            'max_wait_ms': round(stats['max_wait_seconds'] * 1000, 1),
+        }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_inherited = []   # connexions héritées du parent : gardées référencées, jamais fermées
+
+
+def get_pool() -> ConnectionPool:
+    """Pool du processus courant, créé (et préchauffé) au premier appel."""
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                pool = ConnectionPool(DB_DSN, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                      DB_POOL_CHECK_IDLE, DB_STATEMENT_TIMEOUT_MS)
+                pool.warm()
+                _pool, _pool_pid = pool, os.getpid()
+    return _pool
+
+
+def _after_fork_in_child() -> None:
+    global _pool, _pool_lock
+    # Les verrous ont pu être copiés pris par un autre thread du parent
+    _pool_lock = threading.Lock()
+    if _pool is not None:
+        _pool._cond = threading.Condition()
+        _inherited.extend(_pool._abandon())
+        _pool = None
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _gevent_wait_callback(conn, timeout=None):
+    """Attente coopérative des entrées-sorties psycopg2 sous gevent."""
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"État de poll inattendu : {state}")
+
+
+def enable_gevent_support() -> bool:
+    """Active l'attente coopérative si gevent a monkey-patché socket ; retourne True si active."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    if not monkey.is_module_patched('socket'):
+        return False
+    psycopg2.extensions.set_wait_callback(_gevent_wait_callback)
+    return True
+
+
+enable_gevent_support()
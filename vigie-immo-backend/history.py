@@ -0,0 +1,522 @@
+"""
+history.py — Stockage de l'historique des analyses
+
+Chaque section de premier niveau d'un rapport (address, flood_zones,
+contamination, ...) est sérialisée en JSON canonique, identifiée par son
+SHA-256 et stockée une seule fois, compressée, dans analysis_result_sections.
+analysis_history ne garde que {section: empreinte} dans result_sections :
+une zone inondable ou une liste de bornes identique d'une analyse à l'autre
+n'est écrite qu'une fois. Les analyses antérieures (result_json complet)
+restent lisibles par load_result.
+
+analysis_history est partitionnée par mois (migration 003). `python3
+history.py --maintain` (timer systemd vigie-immo-maintain) crée d'avance la
+partition du mois suivant, applique la rétention HISTORY_RETENTION_MONTHS et
+supprime les sections qui ne sont plus référencées (partitions supprimées,
+utilisateurs supprimés). Une insertion qui ne trouve pas sa partition (timer
+en retard) crée seulement celle-ci.
+
+Un rapport passé est servi tel quel par GET /api/history/<id> ; son ETag
+est dérivé des empreintes des sections, sans relire les sections. Avec
+?refresh=1, les sections plus anciennes que leur durée de validité
+(SECTION_MAX_AGE) sont recalculées, fusionnées dans le rapport renvoyé et
+enregistrées (date de calcul par section dans sections_refreshed_at).
+
+/api/analyze n'attend pas l'écriture : record_analysis met l'analyse dans
+la file du HistoryWriter du worker, qui l'enregistre avec les suivantes
+(un INSERT multi-lignes et un commit par lot). File pleine : écriture
+immédiate. À l'arrêt du worker (hook worker_exit, atexit), la file est
+vidée avant la sortie.
+"""
+import atexit
+import base64
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import psycopg2.pool
+
+from db import DB_DSN, get_pool
+
+SECTION_COMPRESS_LEVEL = 6
+HISTORY_RETENTION_MONTHS = int(os.environ.get('HISTORY_RETENTION_MONTHS', 0))  # 0 = tout garder
+HISTORY_PAGE_SIZE = 50    # lignes par page de /api/history par défaut
+HISTORY_PAGE_MAX = 200
+HISTORY_WRITE_QUEUE = int(os.environ.get('HISTORY_WRITE_QUEUE', 1000))       # 0 = écriture synchrone
+HISTORY_WRITE_BATCH = int(os.environ.get('HISTORY_WRITE_BATCH', 50))         # analyses par commit
+HISTORY_WRITE_INTERVAL = float(os.environ.get('HISTORY_WRITE_INTERVAL', 0.5))  # secondes
+HISTORY_WRITE_RETRIES = 3
+HISTORY_WRITE_SHUTDOWN_TIMEOUT = 10  # secondes
+
+# Durée de validité (secondes) des sections recalculables par ?refresh=1 ;
+# HISTORY_SECTION_MAX_AGE="air_quality=900,crime=86400" en remplace certaines
+SECTION_MAX_AGE = {
+    'air_quality': 3600,
+    'crime': 7 * 86400,
+    'services': 30 * 86400,
+    'hydrants': 30 * 86400,
+    'flood_zones': 30 * 86400,
+    'contamination': 30 * 86400,
+    'disaster_history': 30 * 86400,
+    'property_assessment': 30 * 86400,
+    'seismic': 365 * 86400,
+}
+for _item in filter(None, os.environ.get('HISTORY_SECTION_MAX_AGE', '').split(',')):
+    _name, _, _age = _item.partition('=')
+    SECTION_MAX_AGE[_name.strip()] = int(_age)
+
+logger = logging.getLogger(__name__)
+
+
+def _canonical(value) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _encode_section(value) -> tuple:
+    """Section → (empreinte SHA-256, JSON compressé, taille du JSON)."""
+    raw = _canonical(value)
+    return hashlib.sha256(raw).digest(), zlib.compress(raw, SECTION_COMPRESS_LEVEL), len(raw)
+
+
+def _store_sections(cur, unique: dict, touch: bool = False) -> None:
+    """
+    Ajoute les sections {empreinte: (JSON compressé, taille)} absentes. Avec
+    `touch`, les sections déjà stockées sont aussi réécrites : collect_sections
+    ne supprime pas une section modifiée depuis sa recherche d'orphelines.
+    """
+    conflict = 'DO UPDATE SET created_at = NOW()' if touch else 'DO NOTHING'
+    # Ordre fixe des clés : deux lots concurrents ne peuvent pas s'interbloquer
+    psycopg2.extras.execute_values(
+        cur,
+        f'''INSERT INTO analysis_result_sections (hash, data, raw_size) VALUES %s
+            ON CONFLICT (hash) {conflict}''',
+        [(psycopg2.Binary(digest), psycopg2.Binary(unique[digest][0]), unique[digest][1])
+         for digest in sorted(unique)]
+    )
+
+
+def save_analyses(cur, entries) -> list:
+    """
+    Enregistre un lot d'analyses [(user_id, address, risk_score, result,
+    created_at ou None)] : sections absentes ajoutées en une requête (les
+    autres sont déjà stockées), puis les lignes d'historique qui les
+    référencent en une autre. Retourne les ids dans l'ordre du lot.
+    """
+    unique = {}
+    rows = []
+    months = set()
+    for user_id, address, risk_score, result, created_at in entries:
+        months.add((created_at or datetime.now(timezone.utc)).astimezone(timezone.utc).date())
+        sections = {name: _encode_section(value) for name, value in result.items()}
+        unique.update((digest, (data, size)) for digest, data, size in sections.values())
+        rows.append((user_id, address, risk_score,
+                     json.dumps({name: digest.hex() for name, (digest, _, _) in sections.items()}),
+                     created_at))
+    _store_sections(cur, unique)
+    insert_sql = '''INSERT INTO analysis_history (user_id, address, risk_score, result_sections, created_at)
+                    VALUES %s RETURNING id'''
+    template = '(%s, %s, %s, %s, COALESCE(%s::timestamptz, NOW()))'
+    cur.execute('SAVEPOINT history_insert')
+    try:
+        ids = psycopg2.extras.execute_values(cur, insert_sql, rows, template, fetch=True)
+    except psycopg2.errors.CheckViolation:
+        # Pas encore de partition pour ce mois (--maintain en retard)
+        cur.execute('ROLLBACK TO SAVEPOINT history_insert')
+        cur.execute(
+            '''SELECT analysis_history_create_partitions(m, m)
+               FROM unnest(%s::date[] || (NOW() AT TIME ZONE 'UTC')::date) m''',
+            (sorted(months),)
+        )
+        ids = psycopg2.extras.execute_values(cur, insert_sql, rows, template, fetch=True)
+    cur.execute('RELEASE SAVEPOINT history_insert')
+    return [row[0] for row in ids]
+
+
+def save_analysis(cur, user_id: int, address: str, risk_score, result: dict) -> int:
+    """Enregistre une analyse dans la transaction de `cur` ; retourne l'id de la ligne d'historique."""
+    return save_analyses(cur, [(user_id, address, risk_score, result, None)])[0]
+
+
+def load_result(cur, result_json, result_sections) -> dict:
+    """Reconstitue le rapport d'une ligne d'historique (sections référencées ou result_json)."""
+    if result_sections is None:
+        return result_json
+    digests = {bytes.fromhex(digest) for digest in result_sections.values()}
+    cur.execute(
+        'SELECT hash, data FROM analysis_result_sections WHERE hash = ANY(%s)',
+        ([psycopg2.Binary(digest) for digest in digests],)
+    )
+    blobs = {bytes(digest): json.loads(zlib.decompress(data)) for digest, data in cur.fetchall()}
+    return {name: blobs[bytes.fromhex(digest)] for name, digest in result_sections.items()}
+
+
+def section_digests(result: dict) -> dict:
+    """{section: empreinte hex} d'un rapport, comme stocké dans result_sections."""
+    return {name: hashlib.sha256(_canonical(value)).hexdigest() for name, value in result.items()}
+
+
+def compress_section(value) -> bytes:
+    """JSON compressé d'une section, tel que stocké dans analysis_result_sections."""
+    return zlib.compress(_canonical(value), SECTION_COMPRESS_LEVEL)
+
+
+def save_refreshed_sections(cur, history_id: int, created_at: datetime, result: dict,
+                            refreshed, refreshed_at: datetime) -> dict:
+    """
+    Enregistre le rapport `result` dont les sections `refreshed` viennent
+    d'être recalculées : sections ajoutées, result_sections remplacé et date de
+    calcul des sections rafraîchies notée. Retourne le nouveau result_sections.
+    """
+    sections = {name: _encode_section(value) for name, value in result.items()}
+    _store_sections(cur, {digest: (data, size) for name, (digest, data, size) in sections.items()
+                          if name not in refreshed})
+    # La ligne existe déjà : son id ne la signale pas à collect_sections
+    _store_sections(cur, {digest: (data, size) for name, (digest, data, size) in sections.items()
+                          if name in refreshed}, touch=True)
+    result_sections = {name: digest.hex() for name, (digest, _, _) in sections.items()}
+    cur.execute(
+        '''UPDATE analysis_history
+           SET result_sections = %s, result_json = NULL,
+               sections_refreshed_at = COALESCE(sections_refreshed_at, '{}'::jsonb) || %s
+           WHERE id = %s AND created_at = %s''',
+        (json.dumps(result_sections),
+         json.dumps({name: refreshed_at.isoformat() for name in refreshed}),
+         history_id, created_at)
+    )
+    return result_sections
+
+
+def result_etag(digests: dict) -> str:
+    """ETag d'un rapport, calculé à partir des empreintes de ses sections."""
+    raw = json.dumps(digests, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+def stale_sections(result_names, created_at: datetime, now: datetime, refreshed_at: dict = None) -> list:
+    """
+    Sections du rapport plus anciennes que leur durée de validité
+    (SECTION_MAX_AGE), datées de leur dernier rafraîchissement
+    (sections_refreshed_at) ou à défaut de l'analyse.
+    """
+    refreshed_at = refreshed_at or {}
+    stale = []
+    for name in result_names:
+        if name not in SECTION_MAX_AGE:
+            continue
+        fetched_at = datetime.fromisoformat(refreshed_at[name]) if name in refreshed_at else created_at
+        if (now - fetched_at).total_seconds() > SECTION_MAX_AGE[name]:
+            stale.append(name)
+    return stale
+
+
+def collect_sections(cur) -> int:
+    """
+    Supprime les sections qui ne sont plus référencées par aucune ligne
+    d'historique (partitions supprimées, utilisateurs supprimés en cascade).
+    Valide d'abord la transaction en cours. Retourne le nombre de sections
+    supprimées.
+    """
+    # Les écritures d'historique ajoutent leurs sections avant leurs lignes :
+    # une fois celles en cours terminées, toute nouvelle ligne aura un id
+    # supérieur à `last_id`. Le verrou n'est tenu que le temps de le lire.
+    cur.execute('LOCK TABLE analysis_result_sections IN SHARE ROW EXCLUSIVE MODE')
+    cur.execute('SELECT COALESCE(MAX(id), 0) FROM analysis_history')
+    last_id = cur.fetchone()[0]
+    cur.connection.commit()
+
+    # Recherche des orphelines sans verrou, écritures en parallèle
+    cur.execute(
+        '''CREATE TEMP TABLE orphan_sections ON COMMIT DROP AS
+           SELECT s.hash, s.xmin AS version FROM analysis_result_sections s
+           WHERE NOT EXISTS (
+               SELECT 1 FROM analysis_history h, jsonb_each_text(h.result_sections) r
+               WHERE r.value = encode(s.hash, 'hex'))'''
+    )
+    # Bloque les insertions le temps de la suppression : seules les lignes
+    # ajoutées depuis la recherche sont relues ; une section réutilisée par
+    # un rafraîchissement (ligne existante) a été réécrite entre-temps
+    cur.execute('LOCK TABLE analysis_result_sections IN SHARE ROW EXCLUSIVE MODE')
+    cur.execute(
+        '''DELETE FROM analysis_result_sections s
+           USING orphan_sections o
+           WHERE s.hash = o.hash AND s.xmin = o.version
+             AND NOT EXISTS (
+                 SELECT 1 FROM analysis_history h, jsonb_each_text(h.result_sections) r
+                 WHERE h.id > %s AND r.value = encode(s.hash, 'hex'))''',
+        (last_id,)
+    )
+    return cur.rowcount
+
+
+def maintain_partitions(cur) -> tuple:
+    """
+    Maintenance hors requête (--maintain) : crée les partitions du mois
+    courant et du suivant, supprime celles qui dépassent
+    HISTORY_RETENTION_MONTHS (si défini) et les valide, puis supprime les
+    sections orphelines. Retourne (partitions créées, partitions supprimées, sections supprimées).
+    """
+    cur.execute(
+        '''SELECT analysis_history_create_partitions(
+               (NOW() AT TIME ZONE 'UTC')::date,
+               ((NOW() AT TIME ZONE 'UTC') + INTERVAL '1 month')::date)'''
+    )
+    created = cur.fetchone()[0]
+    dropped = 0
+    if HISTORY_RETENTION_MONTHS > 0:
+        cur.execute('SELECT analysis_history_drop_partitions(%s)', (HISTORY_RETENTION_MONTHS,))
+        dropped = cur.fetchone()[0]
+    collected = collect_sections(cur)
+    if dropped or collected:
+        logger.info(f"Rétention de l'historique : {dropped} partition(s) et "
+                    f"{collected} section(s) supprimées")
+    return created, dropped, collected
+
+
+def encode_cursor(created_at: datetime, history_id: int) -> str:
+    """Curseur opaque de pagination : position (created_at, id) de la dernière ligne lue."""
+    raw = f'{created_at.isoformat()}|{history_id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Curseur → (created_at, id) ; ValueError s'il est invalide."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, history_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(history_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Curseur invalide: {cursor}') from e
+
+
+def list_history(cur, user_id: int, limit: int, cursor: str = None) -> tuple:
+    """
+    Page d'historique d'un utilisateur, du plus récent au plus ancien, après
+    `cursor` : pagination par clé (created_at, id), coût proportionnel à la page.
+    Retourne (lignes (id, address, risk_score, created_at), curseur suivant ou None).
+    """
+    if cursor:
+        created_at, history_id = decode_cursor(cursor)
+        cur.execute(
+            '''SELECT id, address, risk_score, created_at
+               FROM analysis_history
+               WHERE user_id = %s AND (created_at, id) < (%s, %s)
+               ORDER BY created_at DESC, id DESC
+               LIMIT %s''',
+            (user_id, created_at, history_id, limit + 1)
+        )
+    else:
+        cur.execute(
+            '''SELECT id, address, risk_score, created_at
+               FROM analysis_history
+               WHERE user_id = %s
+               ORDER BY created_at DESC, id DESC
+               LIMIT %s''',
+            (user_id, limit + 1)
+        )
+    rows = cur.fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][3], rows[-1][0])
+
+
+_STOP = object()
+
+
+class HistoryWriter:
+    """
+    Écriture différée de l'historique d'un worker : file bornée vidée par un
+    thread, par lots d'au plus `batch` analyses réunis pendant au plus
+    `interval` secondes, une transaction (un commit) par lot.
+    """
+
+    def __init__(self, maxsize: int, batch: int, interval: float):
+        self.maxsize = maxsize
+        self.batch = batch
+        self.interval = interval
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {
+            'queued': 0,
+            'rejected': 0,
+            'written': 0,
+            'batches': 0,
+            'lost': 0,
+            'flush_seconds': 0.0,
+            'max_delay_seconds': 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id: int, address: str, risk_score, result: dict) -> bool:
+        """Met l'analyse en file ; False si la file est pleine ou le writer fermé."""
+        entry = (time.monotonic(), (user_id, address, risk_score, result, datetime.now(timezone.utc)))
+        with self._lock:
+            if self._closed:
+                return False
+            try:
+                self._queue.put_nowait(entry)
+            except queue.Full:
+                self._stats['rejected'] += 1
+                return False
+            self._stats['queued'] += 1
+        return True
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(items) < self.batch and items[-1] is not _STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            stop = items[-1] is _STOP
+            if stop:
+                items.pop()
+            if items:
+                self._write(items)
+            if stop:
+                return
+
+    def _write(self, items: list) -> None:
+        t0 = time.monotonic()
+        entries = [entry for _, entry in items]
+        for attempt in range(1, HISTORY_WRITE_RETRIES + 1):
+            try:
+                with get_pool().connection() as conn, conn, conn.cursor() as cur:
+                    save_analyses(cur, entries)
+                break
+            except (psycopg2.OperationalError, psycopg2.pool.PoolError) as e:
+                if attempt == HISTORY_WRITE_RETRIES:
+                    self._lose(items, e)
+                    return
+                logger.warning(f"Écriture de l'historique échouée (essai {attempt}) : {e}")
+                time.sleep(attempt)
+            except Exception as e:
+                if len(items) > 1:
+                    # Isoler l'analyse fautive plutôt que perdre tout le lot
+                    for item in items:
+                        self._write([item])
+                    return
+                self._lose(items, e)
+                return
+        now = time.monotonic()
+        with self._lock:
+            self._stats['written'] += len(items)
+            self._stats['batches'] += 1
+            self._stats['flush_seconds'] += now - t0
+            self._stats['max_delay_seconds'] = max(self._stats['max_delay_seconds'], now - items[0][0])
+
+    def _lose(self, items: list, error: Exception) -> None:
+        with self._lock:
+            self._stats['lost'] += len(items)
+        logger.error(f"Historique : {len(items)} analyse(s) non enregistrée(s) : {error}")
+
+    def close(self, timeout: float = None) -> bool:
+        """Refuse les nouvelles analyses et attend l'écriture de la file ; False si le délai expire."""
+        with self._lock:
+            if self._closed:
+                return not self._thread.is_alive()
+            self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        pending = self._queue.qsize()
+        if self._thread.is_alive():
+            logger.error(f"Historique : arrêt avant écriture complète ({pending} analyse(s) en file)")
+            return False
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats['batches']
+        return {
+            'max_queue': self.maxsize,
+            'batch': self.batch,
+            'interval_ms': round(self.interval * 1000),
+            'pending': self._queue.qsize(),
+            'queued': stats['queued'],
+            'rejected': stats['rejected'],
+            'written': stats['written'],
+            'lost': stats['lost'],
+            'batches': batches,
+            'avg_batch': round(stats['written'] / batches, 1) if batches else None,
+            'avg_flush_ms': round(stats['flush_seconds'] / batches * 1000, 1) if batches else None,
+            'max_delay_ms': round(stats['max_delay_seconds'] * 1000, 1),
+        }
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Writer du processus courant (créé au premier appel) ; None si HISTORY_WRITE_QUEUE = 0."""
+    global _writer, _writer_pid
+    if HISTORY_WRITE_QUEUE <= 0:
+        return None
+    if _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer_pid != os.getpid():
+                _writer = HistoryWriter(HISTORY_WRITE_QUEUE, HISTORY_WRITE_BATCH, HISTORY_WRITE_INTERVAL)
+                _writer_pid = os.getpid()
+    return _writer
+
+
+def record_analysis(user_id: int, address: str, risk_score, result: dict) -> None:
+    """
+    Enregistre une analyse sans attendre la base : mise en file du writer,
+    ou écriture immédiate (transaction dédiée) si la file est pleine ou
+    désactivée, ce qui ralentit les requêtes plutôt que perdre l'historique.
+    """
+    writer = get_writer()
+    if writer is not None and writer.submit(user_id, address, risk_score, result):
+        return
+    with get_pool().connection() as conn, conn, conn.cursor() as cur:
+        save_analysis(cur, user_id, address, risk_score, result)
+
+
+def writer_stats():
+    """Statistiques du writer de ce processus, None s'il n'a pas démarré."""
+    return _writer.stats() if _writer is not None and _writer_pid == os.getpid() else None
+
+
+def close_writer(timeout: float = HISTORY_WRITE_SHUTDOWN_TIMEOUT) -> None:
+    """Vide la file du writer de ce processus (arrêt du worker)."""
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.close(timeout)
+
+
+atexit.register(close_writer)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance de l'historique des analyses")
+    parser.add_argument('--maintain', action='store_true',
+                        help='Créer les partitions à venir, appliquer HISTORY_RETENTION_MONTHS '
+                             'et supprimer les sections orphelines')
+    args = parser.parse_args()
+    if args.maintain:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+        conn = psycopg2.connect(DB_DSN)
+        with conn, conn.cursor() as cur:
+            created, dropped, collected = maintain_partitions(cur)
+        conn.close()
+        print(f"Partitions créées : {created}, supprimées : {dropped} ; sections supprimées : {collected}")
@@ -8,21 +8,39 @@ Sources :
 
 Usage :
     python import_assessments.py [--dsn DSN] [--skip-download] [--csv-only]
+                                 [--loader {insert,copy}] [--copy-format {text,binary}]
+                                 [--jobs N] [--incremental] [--resume] [--pipeline]
+                                 [--report FICHIER.json] [--synthetic N [--seed S]]
 """
 
 import argparse
+import array
+import concurrent.futures
+import contextlib
 import csv
+import email.utils
 import io
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import random
+import re
+import resource
+import struct
 import sys
 import time
+import urllib.error
 import urllib.request
 import xml.etree.ElementTree as ET
 import zipfile
+import zlib
 
+import numpy as np
 import psycopg2
 import psycopg2.extras
+from psycopg2 import sql
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,56 +56,556 @@ ZIP_PATH = os.path.join(DOWNLOAD_DIR, "Roles_Donnees_Ouvertes_2025.zip")
 BATCH_SIZE = 5000
 DEFAULT_DSN = "dbname=vigie_immo"
 
+TARGET_TABLE = "property_assessments"
+STAGING_TABLE = "property_assessments_load"
+MEMBERS_TABLE = "assessment_import_members"
+CHECKPOINT_TABLE = "assessment_import_checkpoints"
+CSV_CHECKPOINT_ROWS = 500000  # lignes CSV copiées entre deux points de reprise
 
-def download_file(url: str, dest: str) -> None:
-    """Download a file with progress logging."""
-    if os.path.exists(dest):
-        size_mb = os.path.getsize(dest) / (1024 * 1024)
-        logger.info(f"Fichier existant : {dest} ({size_mb:.1f} MB), skip download")
-        return
-    logger.info(f"Téléchargement de {url} ...")
+# Colonnes chargées, dans l'ordre des tuples produits par les parseurs.
+# Chaque ligne est suivie de (lon, lat), None si le matricule n'a pas de coordonnées.
+LOAD_COLUMNS = (
+    "matricule", "civic_number", "street_name", "municipality", "land_value",
+    "building_value", "total_value", "year_built", "lot_area_sqm",
+    "building_area_sqm", "use_code",
+)
+
+
+# ---------------------------------------------------------------------------
+# Mesures de l'import : durée par phase, temps base de données par lot, débit
+# et pic de mémoire, exportés en JSON avec --report. Le parsing et l'écriture
+# en base sont entrelacés (flux) : le temps passé à produire les lignes compte
+# dans la phase de parsing, le reste de chaque lot dans db_load.
+# ---------------------------------------------------------------------------
+
+class ImportReport:
+    """Mesures d'un import (voir ci-dessus). Un rapport global par exécution : _report."""
+
+    PHASES = ("download", "csv_parse", "xml_parse", "join", "db_load", "index_build", "swap", "verify")
+
+    def __init__(self):
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.batches = []  # (secondes en base, lignes)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - t0
+
+    @contextlib.contextmanager
+    def db_batch(self, *parse_phases: str):
+        """
+        Mesure un lot écrit en base. Le temps passé pendant le lot dans les
+        phases `parse_phases` (lignes produites en flux) en est déduit.
+        Le lot reçoit son nombre de lignes dans batch["rows"].
+        """
+        parsed = sum(self.phases[p] for p in parse_phases)
+        t0 = time.perf_counter()
+        batch = {"rows": 0}
+        yield batch
+        self.add_batch(time.perf_counter() - t0 - (sum(self.phases[p] for p in parse_phases) - parsed),
+                       batch["rows"])
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] += seconds
+
+    def add_batch(self, seconds: float, rows: int) -> None:
+        self.batches.append((seconds, rows))
+        self.phases["db_load"] += seconds
+
+    def timed_rows(self, rows, name: str):
+        """Itère sur `rows` en comptant le temps de production des lignes dans la phase `name`."""
+        rows = iter(rows)
+        phases = self.phases
+        while True:
+            t0 = time.perf_counter()
+            row = next(rows, None)
+            phases[name] += time.perf_counter() - t0
+            if row is None:
+                return
+            yield row
+
+    def merge(self, phases: dict, batches: list) -> None:
+        """Ajoute les mesures d'un worker de l'import parallèle (phases additionnées)."""
+        for name, seconds in phases.items():
+            self.phases[name] += seconds
+        self.batches.extend(batches)
+
+    def to_dict(self, rows: int, elapsed: float, **context) -> dict:
+        phases = dict(self.phases)
+        # Les recherches de coordonnées (join) ont lieu pendant le parsing XML
+        phases["xml_parse"] = max(phases["xml_parse"] - phases["join"], 0.0)
+        times = sorted(seconds for seconds, _ in self.batches)
+
+        def percentile(q):
+            return round(times[min(len(times) - 1, int(q * len(times)))] * 1000, 2) if times else None
+
+        # ru_maxrss est en Kio sous Linux
+        return {
+            **context,
+            "rows": rows,
+            "elapsed_s": round(elapsed, 3),
+            "rows_per_s": round(rows / elapsed) if elapsed > 0 else None,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "peak_rss_workers_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            "phases_s": {name: round(seconds, 3) for name, seconds in phases.items()},
+            "db_batches": {
+                "count": len(times),
+                "rows": sum(count for _, count in self.batches),
+                "total_s": round(sum(times), 3),
+                "mean_ms": round(sum(times) / len(times) * 1000, 2) if times else None,
+                "p50_ms": percentile(0.50),
+                "p95_ms": percentile(0.95),
+                "max_ms": percentile(1.0),
+            },
+        }
+
+
+class _TimedCoords:
+    """CoordIndex dont les recherches sont comptées dans la phase join."""
+
+    __slots__ = ("_coords", "_phases")
+
+    def __init__(self, coords, report: ImportReport):
+        self._coords = coords
+        self._phases = report.phases
+
+    def get(self, matricule: str, default=None):
+        t0 = time.perf_counter()
+        value = self._coords.get(matricule, default)
+        self._phases["join"] += time.perf_counter() - t0
+        return value
+
+
+_report = ImportReport()
+
+
+def _read_download_meta(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_download_meta(path: str, meta: dict) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def download_file(url: str, dest: str, progress: bool = True) -> None:
+    """
+    Download a file with progress logging.
+
+    Les validateurs HTTP (ETag, Last-Modified) sont conservés dans dest.meta :
+    - fichier déjà présent : requête conditionnelle, conservé si le serveur
+      répond 304 (à défaut de validateurs, la date du fichier est utilisée) ;
+    - téléchargement interrompu (dest.part) : reprise par Range à partir de la
+      taille du .part, If-Range garantissant que la ressource n'a pas changé ;
+      sinon le serveur renvoie la ressource entière et on repart de zéro.
+    `progress` : affichage de l'avancement (désactivé en arrière-plan).
+    """
     tmp = dest + ".part"
-    req = urllib.request.Request(url, headers={"User-Agent": "VigiImmo/1.0"})
-    with urllib.request.urlopen(req, timeout=600) as resp, open(tmp, "wb") as f:
+    headers = {"User-Agent": "VigiImmo/1.0"}
+
+    if os.path.exists(dest):
+        meta = _read_download_meta(dest + ".meta")
+        if meta.get("url") != url:
+            meta = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        headers["If-Modified-Since"] = meta.get("last_modified") or email.utils.formatdate(
+            os.path.getmtime(dest), usegmt=True)
+
+    offset = 0
+    part_meta = _read_download_meta(tmp + ".meta")
+    # If-Range exige un validateur fort : ETag non faible, sinon Last-Modified
+    etag = part_meta.get("etag")
+    validator = etag if etag and not etag.startswith("W/") else part_meta.get("last_modified")
+    if os.path.exists(tmp) and part_meta.get("url") == url and validator:
+        offset = os.path.getsize(tmp)
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+    logger.info(f"Téléchargement de {url} ..." if not offset
+                else f"Reprise du téléchargement de {url} à {offset / (1024 * 1024):.1f} MB ...")
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        resp = urllib.request.urlopen(req, timeout=600)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            if os.path.exists(tmp):
+                os.remove(tmp)  # reliquat d'un rafraîchissement interrompu
+            size_mb = os.path.getsize(dest) / (1024 * 1024)
+            logger.info(f"Fichier à jour : {dest} ({size_mb:.1f} MB), skip download")
+            return
+        if e.code == 416 and offset:
+            # .part incohérent avec la ressource : repartir de zéro
+            os.remove(tmp)
+            return download_file(url, dest, progress)
+        raise
+
+    if resp.status == 206 and not resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+        resp.close()
+        os.remove(tmp)
+        return download_file(url, dest, progress)
+
+    with resp:
+        if resp.status == 206:
+            mode = "ab"
+            downloaded = offset
+        else:
+            if offset:
+                logger.info("  Reprise impossible (ressource modifiée), téléchargement complet")
+            mode = "wb"
+            downloaded = 0
+            _write_download_meta(tmp + ".meta", {
+                "url": url,
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+            })
         total = int(resp.headers.get("Content-Length", 0))
-        downloaded = 0
+        total = total + downloaded if total else 0
+        with open(tmp, mode) as f:
+            while True:
+                chunk = resp.read(1024 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+                downloaded += len(chunk)
+                if total and progress:
+                    pct = downloaded * 100 / total
+                    print(f"\r  {downloaded / (1024*1024):.1f} / {total / (1024*1024):.1f} MB ({pct:.0f}%)", end="", flush=True)
+    if progress:
+        print()
+    if total and downloaded != total:
+        raise IOError(f"Téléchargement incomplet : {downloaded} octets sur {total}")
+    os.replace(tmp, dest)
+    os.replace(tmp + ".meta", dest + ".meta")
+    logger.info(f"Téléchargement terminé : {dest}")
+
+
+class CoordIndex:
+    """
+    Index compact matricule → (longitude, latitude) pour la jointure CSV → XML.
+
+    Les matricules (18 octets ASCII) sont triés dans un seul bloc d'octets,
+    les coordonnées dans deux tableaux float64 parallèles ; la recherche est
+    dichotomique. Environ 34 octets par unité, contre plusieurs centaines pour
+    un dict {str: (float, float)}. Ces tampons ne sont jamais modifiés : après
+    un fork, les workers de l'import parallèle les partagent sans copie.
+
+    S'utilise comme le dict qu'il remplace (get, len). Pour une clé en double,
+    la dernière occurrence du CSV l'emporte, comme avec un dict.
+    """
+
+    WIDTH = 18
+
+    def __init__(self, keys: bytes, lons: array.array, lats: array.array, extra: dict = None):
+        self._keys = keys
+        self._lons = lons
+        self._lats = lats
+        # Matricules hors format (longueur != 18 octets), rares : dict classique
+        self._extra = extra or {}
+
+    @classmethod
+    def from_unsorted(cls, keys: bytes, lons, lats, extra: dict = None) -> "CoordIndex":
+        """
+        Trie les entrées et construit l'index. `keys` : blocs de WIDTH octets,
+        `lons`/`lats` : séquences de float parallèles.
+        Le tri est stable : parmi des doublons, seule la dernière entrée est gardée.
+        """
+        width = cls.WIDTH
+        block = np.frombuffer(keys, dtype=np.uint8).reshape(-1, width)
+        # Ordre lexicographique des octets : clés découpées en entiers gros-boutistes
+        parts = (block[:, 16:], block[:, 8:16], block[:, :8])
+        order = np.lexsort([np.ascontiguousarray(p).view(f">u{p.shape[1]}").ravel() for p in parts])
+        ordered = block[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (ordered[1:] != ordered[:-1]).any(axis=1)
+        order = order[last]
+        return cls(
+            ordered[last].tobytes(),
+            array.array("d", np.asarray(lons, dtype=np.float64)[order].tobytes()),
+            array.array("d", np.asarray(lats, dtype=np.float64)[order].tobytes()),
+            extra,
+        )
+
+    def __len__(self) -> int:
+        return len(self._lons) + len(self._extra)
+
+    def get(self, matricule: str, default=None):
+        key = matricule.encode("utf-8")
+        if len(key) != self.WIDTH:
+            return self._extra.get(matricule, default)
+
+        # Dernière position dont la clé est <= key (bisect_right - 1)
+        keys, width = self._keys, self.WIDTH
+        lo, hi = 0, len(self._lons)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < keys[mid * width:(mid + 1) * width]:
+                hi = mid
+            else:
+                lo = mid + 1
+        i = lo - 1
+        if i >= 0 and keys[i * width:(i + 1) * width] == key:
+            return (self._lons[i], self._lats[i])
+        return default
+
+
+# ---------------------------------------------------------------------------
+# Lecture vectorisée du CSV géoréférencé : le fichier est lu par blocs
+# d'enregistrements complets, découpés en champs et convertis avec NumPy.
+# Les blocs hors du cas simple (guillemets doublés ou isolés, \r seul) et les
+# nombres hors du format décimal courant sont traités ligne à ligne comme
+# avec csv.reader et float() : le résultat est identique.
+# ---------------------------------------------------------------------------
+
+CSV_CHUNK_BYTES = 16 * 1024 * 1024
+
+_QUOTE, _COMMA, _NEWLINE, _POINT = ord('"'), ord(","), ord("\n"), ord(".")
+_CSV_FIELDS = (1, 5, 6, 7)  # code municipal, matricule, longitude, latitude
+_CSV_PADDING = 32           # octets nuls après chaque bloc : champs lus par fenêtres fixes
+_NUMBER_WIDTH = 24          # au-delà, conversion ligne à ligne
+
+# Classes d'octets (drapeaux) pour repérer les nombres au format courant
+_KIND_DIGIT, _KIND_POINT, _KIND_SIGN, _KIND_OTHER = 1, 2, 4, 8
+_CHAR_KINDS = np.full(256, _KIND_OTHER, dtype=np.uint8)
+_CHAR_KINDS[0] = 0  # bourrage après la fin du champ
+_CHAR_KINDS[ord("0"):ord("9") + 1] = _KIND_DIGIT
+_CHAR_KINDS[[ord("-"), ord("+")]] = _KIND_SIGN
+_CHAR_KINDS[_POINT] = _KIND_POINT
+
+
+def _padded(data: bytes):
+    return np.frombuffer(data + bytes(_CSV_PADDING), dtype=np.uint8)
+
+
+def _field_window(buf, starts, ends, width: int):
+    """Champs [starts, ends) en matrice (champs, width), complétés par des octets nuls."""
+    chars = np.lib.stride_tricks.sliding_window_view(buf, width)[starts]
+    chars[np.arange(width) >= (ends - starts)[:, None]] = 0
+    return chars
+
+
+class _CsvBatch:
+    """
+    Lignes retenues d'un bloc du CSV : bornes (début, fin) des champs
+    matricule et code municipal dans `buf` (bloc complété par _padded),
+    et coordonnées float64.
+    """
+
+    __slots__ = ("buf", "mat", "mun", "lons", "lats")
+
+    def __init__(self, buf, mat: tuple, mun: tuple, lons, lats):
+        self.buf = buf
+        self.mat = mat
+        self.mun = mun
+        self.lons = lons
+        self.lats = lats
+
+    @classmethod
+    def from_rows(cls, rows: list) -> "_CsvBatch":
+        """Construit un lot depuis des tuples (matricule, code municipal, lon, lat)."""
+        fields = [field.encode("utf-8") for row in rows for field in row[:2]]
+        lengths = np.array([len(field) for field in fields], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        return cls(
+            _padded(b"".join(fields)),
+            (starts[0::2], ends[0::2]),
+            (starts[1::2], ends[1::2]),
+            np.array([row[2] for row in rows], dtype=np.float64),
+            np.array([row[3] for row in rows], dtype=np.float64),
+        )
+
+    def strings(self, bounds: tuple) -> list:
+        """Valeurs (str) des champs délimités par `bounds`."""
+        starts, ends = bounds
+        width = int((ends - starts).max(initial=0))
+        if width == 0:
+            return [""] * len(starts)
+        if width > _CSV_PADDING:
+            buf = self.buf
+            return [buf[s:e].tobytes().decode("utf-8") for s, e in zip(starts.tolist(), ends.tolist())]
+        fields = _field_window(self.buf, starts, ends, width).view(f"S{width}").ravel().tolist()
+        return [field.decode("utf-8") for field in fields]
+
+
+def _csv_row_coordinates(row: list):
+    """Une ligne lue par csv.reader → (matricule, code municipal, lon, lat), ou None si rejetée."""
+    if len(row) < 8:
+        return None
+    try:
+        # Coordonnées en format français (virgule = séparateur décimal)
+        lon = float(row[6].replace(",", "."))
+        lat = float(row[7].replace(",", "."))
+    except (ValueError, IndexError):
+        return None
+    if not (-85 < lon < -50 and 40 < lat < 65):
+        return None
+    return row[5], row[1], lon, lat
+
+
+def _split_csv_fields(buf, fields: tuple):
+    """
+    Découpe un bloc d'enregistrements complets (terminé par \\n) en champs.
+    Retourne (débuts, fins) : tableaux (enregistrements, len(fields)) des
+    bornes des champs demandés, guillemets encadrants exclus, pour les
+    enregistrements d'au moins 8 champs ; ou None si un guillemet n'encadre
+    pas un champ entier.
+    """
+    special = np.flatnonzero((buf == _QUOTE) | (buf == _COMMA) | (buf == _NEWLINE))
+    is_quote = buf[special] == _QUOTE
+    quotes = special[is_quote]
+    if len(quotes):
+        if len(quotes) % 2:
+            return None
+        opening, closing = quotes[0::2], quotes[1::2]
+        before = buf[np.maximum(opening - 1, 0)]
+        if not ((before == _COMMA) | (before == _NEWLINE) | (opening == 0)).all():
+            return None
+        after = buf[closing + 1]
+        if not ((after == _COMMA) | (after == _NEWLINE)).all():
+            return None
+        # Séparateurs entre guillemets : contenu du champ (parité des guillemets précédents)
+        outside = (np.cumsum(is_quote, dtype=np.uint8) & 1) == 0
+        delims = special[outside & ~is_quote]
+    else:
+        delims = special
+
+    record_ends = np.flatnonzero(buf[delims] == _NEWLINE)
+    firsts = np.empty_like(record_ends)
+    firsts[:1] = 0
+    firsts[1:] = record_ends[:-1] + 1
+    firsts = firsts[record_ends - firsts >= 7]
+
+    # Le champ k va du délimiteur k - 1 (exclu) au délimiteur k
+    positions = firsts[:, None] + np.asarray(fields)
+    ends = delims[positions]
+    starts = delims[np.maximum(positions - 1, 0)] + 1
+    starts[positions == 0] = 0
+    quoted = buf[starts] == _QUOTE
+    quoted &= ends > starts
+    return starts + quoted, ends - quoted
+
+
+def _parse_decimals(buf, starts, ends):
+    """
+    Convertit des champs décimaux (virgule ou point) en float64, NaN si invalides.
+    Le format courant [-+]chiffres[,chiffres] est converti en bloc par NumPy
+    (arrondi correct, comme float()) ; le reste (espaces, exposants, champs
+    longs...) l'est ligne à ligne par float().
+    """
+    widths = ends - starts
+    width = int(min(widths.max(initial=1), _NUMBER_WIDTH))
+    chars = _field_window(buf, starts, ends, width)
+    chars[chars == _COMMA] = _POINT
+
+    kinds = _CHAR_KINDS[chars]
+    rest = np.bitwise_or.reduce(kinds[:, 1:], axis=1) if width > 1 else np.zeros(len(starts), np.uint8)
+    simple = (
+        (widths > 0) & (widths <= _NUMBER_WIDTH)
+        & ((rest & (_KIND_SIGN | _KIND_OTHER)) == 0)
+        & ((kinds[:, 0] & _KIND_OTHER) == 0)
+        & (((rest | kinds[:, 0]) & _KIND_DIGIT) != 0)
+        & ((chars == _POINT).sum(axis=1) <= 1)
+    )
+
+    values = np.full(len(starts), np.nan)
+    values[simple] = chars[simple].view(f"S{width}").ravel().astype(np.float64)
+    for i in np.flatnonzero(~simple).tolist():
+        text = buf[starts[i]:ends[i]].tobytes().decode("utf-8")
+        try:
+            values[i] = float(text.replace(",", "."))
+        except ValueError:
+            pass
+    return values
+
+
+def _scan_csv_block(data: bytes) -> _CsvBatch:
+    """Lot des lignes retenues d'un bloc d'enregistrements complets (terminé par \\n)."""
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n")
+    fields = None
+    if b"\r" not in data:
+        buf = _padded(data)
+        fields = _split_csv_fields(buf, _CSV_FIELDS)
+    if fields is None:
+        # Cas hors du découpage vectorisé : csv.reader, avec les fins de ligne
+        # universelles de la lecture en mode texte
+        reader = csv.reader(io.StringIO(data.decode("utf-8"), newline=None))
+        return _CsvBatch.from_rows([r for r in map(_csv_row_coordinates, reader) if r is not None])
+
+    starts, ends = fields
+    lons = _parse_decimals(buf, starts[:, 2], ends[:, 2])
+    lats = _parse_decimals(buf, starts[:, 3], ends[:, 3])
+    keep = (-85 < lons) & (lons < -50) & (40 < lats) & (lats < 65)
+    starts, ends = starts[keep], ends[keep]
+    return _CsvBatch(buf, (starts[:, 1], ends[:, 1]), (starts[:, 0], ends[:, 0]), lons[keep], lats[keep])
+
+
+def _iter_csv_batches(csv_path: str):
+    """Génère les lots (_CsvBatch) du CSV, en-tête exclu, dans l'ordre du fichier."""
+    with open(csv_path, "rb") as f:
+        f.readline()  # skip header
+        pending = b""
         while True:
-            chunk = resp.read(1024 * 1024)
+            chunk = f.read(CSV_CHUNK_BYTES)
+            data = pending + chunk
             if not chunk:
-                break
-            f.write(chunk)
-            downloaded += len(chunk)
-            if total:
-                pct = downloaded * 100 / total
-                print(f"\r  {downloaded / (1024*1024):.1f} / {total / (1024*1024):.1f} MB ({pct:.0f}%)", end="", flush=True)
-    print()
-    os.rename(tmp, dest)
-    logger.info(f"Téléchargement terminé : {dest}")
+                if data:
+                    yield _scan_csv_block(data if data.endswith(b"\n") else data + b"\n")
+                return
+            # Couper après le dernier saut de ligne hors guillemets
+            cut = data.rfind(b"\n")
+            while cut >= 0 and data.count(b'"', 0, cut) % 2:
+                cut = data.rfind(b"\n", 0, cut)
+            if cut < 0:
+                pending = data
+                continue
+            pending = data[cut + 1:]
+            yield _scan_csv_block(data[:cut + 1])
+
+
+def iter_csv_points(csv_path: str):
+    """Génère (matricule, code municipal, lon, lat) pour chaque ligne retenue du CSV."""
+    for batch in _iter_csv_batches(csv_path):
+        yield from zip(batch.strings(batch.mat), batch.strings(batch.mun),
+                       batch.lons.tolist(), batch.lats.tolist())
 
 
-def parse_csv_coordinates(csv_path: str) -> dict:
+def parse_csv_coordinates(csv_path: str) -> CoordIndex:
     """
     Parse le CSV pour extraire les coordonnées par matricule.
-    Retourne {matricule: (longitude, latitude)}.
+    Retourne un CoordIndex {matricule: (longitude, latitude)}.
     Les coordonnées sont en WGS84 (EPSG:4326).
     """
     logger.info("Parsing du CSV des coordonnées ...")
-    coords = {}
-    with open(csv_path, "r", encoding="utf-8") as f:
-        f.readline()  # skip header
-        reader = csv.reader(f)
-        for row in reader:
-            if len(row) < 8:
-                continue
-            mat18 = row[5]
-            try:
-                # Coordonnées en format français (virgule = séparateur décimal)
-                lon = float(row[6].replace(",", "."))
-                lat = float(row[7].replace(",", "."))
-            except (ValueError, IndexError):
-                continue
-            if -85 < lon < -50 and 40 < lat < 65:
-                coords[mat18] = (lon, lat)
+    keys, lons, lats = [], [], []
+    extra = {}
+    width = CoordIndex.WIDTH
+    for batch in _iter_csv_batches(csv_path):
+        starts, ends = batch.mat
+        fixed = ends - starts == width
+        keys.append(_field_window(batch.buf, starts[fixed], ends[fixed], width))
+        lons.append(batch.lons[fixed])
+        lats.append(batch.lats[fixed])
+        others = ~fixed
+        if others.any():
+            odd = (starts[others], ends[others])
+            extra.update(zip(batch.strings(odd), zip(batch.lons[others].tolist(), batch.lats[others].tolist())))
+    coords = CoordIndex.from_unsorted(
+        np.concatenate(keys or [np.empty((0, width), dtype=np.uint8)]).tobytes(),
+        np.concatenate(lons or [np.empty(0)]),
+        np.concatenate(lats or [np.empty(0)]),
+        extra,
+    )
     logger.info(f"  {len(coords)} coordonnées chargées")
     return coords
 
@@ -112,200 +630,1258 @@ def _float_or_none(val):
         return None
 
 
-def parse_xml_and_insert(zip_path: str, coords: dict, dsn: str) -> int:
+def _parse_unit(unit, mun_code: str, coords: CoordIndex):
+    """
+    Extrait une unité d'évaluation (élément RLUEx).
+    Retourne un tuple dans l'ordre de LOAD_COLUMNS suivi de (lon, lat),
+    ou None si l'unité n'a pas de matricule.
+    """
+    # Build matricule from RL0104 parts
+    rl0104 = unit.find("RL0104")
+    if rl0104 is None:
+        return None
+    a = _text(rl0104, "RL0104A")
+    b = _text(rl0104, "RL0104B")
+    c = _text(rl0104, "RL0104C")
+    d = _text(rl0104, "RL0104D")
+    matricule = f"{a}{b}{c}{d}".ljust(18, "0")
+
+    # Address from RL0101
+    civic_number = None
+    street_name = None
+    rl0101 = unit.find("RL0101")
+    if rl0101 is not None:
+        first_addr = rl0101.find("RL0101x")
+        if first_addr is not None:
+            civic_number = _text(first_addr, "RL0101Ax") or None
+            street_type = _text(first_addr, "RL0101Ex")
+            street_nm = _text(first_addr, "RL0101Gx")
+            if street_nm:
+                street_name = f"{street_type} {street_nm}".strip() if street_type else street_nm
+
+    # Coordinates from CSV
+    coord = coords.get(matricule)
+    lon = coord[0] if coord else None
+    lat = coord[1] if coord else None
+
+    return (
+        matricule,
+        civic_number,
+        street_name,
+        mun_code,
+        _int_or_none(_text(unit, "RL0402A")),    # land_value
+        _int_or_none(_text(unit, "RL0403A")),    # building_value
+        _int_or_none(_text(unit, "RL0404A")),    # total_value
+        _int_or_none(_text(unit, "RL0307A")),    # year_built
+        _float_or_none(_text(unit, "RL0302A")),  # lot_area_sqm
+        _float_or_none(_text(unit, "RL0308A")),  # building_area_sqm
+        _text(unit, "RL0105A") or None,          # use_code
+        lon,
+        lat,
+    )
+
+
+def iter_member_rows(zf: zipfile.ZipFile, xml_name: str, coords: CoordIndex, stats: dict = None):
+    """
+    Génère les lignes d'un fichier XML (une municipalité) du ZIP.
+
+    Lecture en flux (iterparse) : chaque RLUEx est traité à sa balise fermante
+    puis libéré, la mémoire reste constante quelle que soit la taille du fichier.
+    Le code municipal (RLM01A) précède normalement les unités ; sinon les lignes
+    sont retenues jusqu'à sa lecture pour produire le même résultat qu'ET.parse.
+    Un fichier mal formé n'est détecté qu'à l'erreur, après que les unités qui
+    la précèdent ont été produites : comme ET.parse, qui l'ignorait en entier,
+    l'appelant doit alors annuler ces lignes (stats["error"] renseigné).
+
+    Si `stats` est fourni, il reçoit en fin de lecture "rows" (lignes produites),
+    "municipality" (code RLM01A) et "error" (message si le XML est mal formé).
+    """
+    if stats is None:
+        stats = {}
+    stats.update(rows=0, municipality=None, error=None)
+    mun_code = None
+    pending = []
+    depth = 0
+    root = None
+
+    with zf.open(xml_name) as f:
+        try:
+            for event, elem in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if root is None:
+                        root = elem
+                    continue
+
+                depth -= 1
+                if depth != 1:
+                    continue  # seuls les enfants directs de la racine nous intéressent
+
+                if elem.tag == "RLM01A" and mun_code is None:
+                    mun_code = elem.text.strip() if elem.text else ""
+                    for unit_row in pending:
+                        stats["rows"] += 1
+                        yield unit_row[:3] + (mun_code,) + unit_row[4:]
+                    pending.clear()
+                elif elem.tag == "RLUEx":
+                    row = _parse_unit(elem, mun_code or "", coords)
+                    if row is not None:
+                        if mun_code is None:
+                            pending.append(row)
+                        else:
+                            stats["rows"] += 1
+                            yield row
+                root.clear()
+        except ET.ParseError as e:
+            logger.warning(f"  Erreur XML dans {xml_name}: {e}")
+            stats["error"] = str(e)
+            return
+
+    stats["rows"] += len(pending)
+    yield from pending
+    if stats["rows"]:
+        stats["municipality"] = mun_code or ""
+
+
+def _timed_member_rows(zf: zipfile.ZipFile, xml_name: str, coords: CoordIndex, stats: dict = None):
+    """iter_member_rows mesuré : parsing dans la phase xml_parse, recherches de coordonnées dans join."""
+    return _report.timed_rows(
+        iter_member_rows(zf, xml_name, _TimedCoords(coords, _report), stats), "xml_parse")
+
+
+def _member_fingerprint(info: zipfile.ZipInfo) -> str:
+    """Empreinte du contenu d'un fichier du ZIP : CRC-32 et taille, lus dans le répertoire central."""
+    return f"{info.CRC:08x}:{info.file_size}"
+
+
+def iter_csv_rows(csv_path: str):
+    """
+    Génère les lignes du mode CSV-only : matricule, municipalité et coordonnées,
+    les autres colonnes de LOAD_COLUMNS à None.
+    """
+    nulls = itertools.repeat(None)
+    for batch in _iter_csv_batches(csv_path):
+        yield from zip(
+            batch.strings(batch.mat), nulls, nulls, batch.strings(batch.mun),
+            *(nulls,) * 7, batch.lons.tolist(), batch.lats.tolist(),
+        )
+
+
+# ---------------------------------------------------------------------------
+# Rechargement sans interruption : l'import remplit property_assessments_new,
+# y construit les index et les statistiques, puis la substitue à
+# property_assessments par renommage dans une seule transaction. Les lectures
+# de l'API continuent d'interroger une table complète et indexée.
+# ---------------------------------------------------------------------------
+
+_NEW_SUFFIX = "_new"
+_INDEXDEF_RE = re.compile(r"^(CREATE (?:UNIQUE )?INDEX )(\S+)( ON (?:ONLY )?)(\S+)")
+
+
+def _secondary_indexes(cur, table: str) -> list:
+    """
+    Retourne [(nom, définition)] des index de la table qui ne portent pas une
+    contrainte (clé primaire, unicité) : ceux qu'on recrée avec CREATE INDEX.
+    """
+    cur.execute("""
+        SELECT i.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+        ORDER BY i.relname
+    """, (table,))
+    return cur.fetchall()
+
+
+def _index_constraints(cur, table: str) -> list:
+    """Retourne [(nom, définition)] des contraintes que LIKE ne recopie pas (PK, unicité, exclusion, FK)."""
+    cur.execute("""
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'x', 'f')
+        ORDER BY conname
+    """, (table,))
+    return cur.fetchall()
+
+
+def _serial_sequences(cur, table: str) -> list:
+    """Retourne [(colonne, séquence)] des colonnes serial (hors identity) de la table."""
+    cur.execute("""
+        SELECT a.attname, pg_get_serial_sequence(%s, a.attname)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0
+          AND NOT a.attisdropped AND a.attidentity = ''
+    """, (table, table))
+    return [(col, seq) for col, seq in cur.fetchall() if seq]
+
+
+def _dependent_objects(cur, table: str) -> list:
+    """
+    Retourne les objets d'autres tables qui dépendent de `table` (vues, clés
+    étrangères) : DROP TABLE échouerait et CASCADE les supprimerait.
+    """
+    cur.execute("""
+        SELECT DISTINCT 'vue ' || v.oid::regclass::text
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = %s::regclass AND v.oid <> d.refobjid
+        UNION ALL
+        SELECT 'clé étrangère ' || conname || ' de ' || conrelid::regclass::text
+        FROM pg_constraint
+        WHERE contype = 'f' AND confrelid = %s::regclass AND conrelid <> confrelid
+        ORDER BY 1
+    """, (table, table))
+    return [row[0] for row in cur.fetchall()]
+
+
+def _prepare_new_table(cur) -> None:
+    """
+    (Re)crée property_assessments_new vide : même structure et valeurs par défaut
+    que property_assessments, sans index ni contraintes d'unicité (construits
+    après le chargement). Chaque colonne serial reçoit sa propre séquence, qui
+    part de 1 : celle de la table en service n'est pas touchée.
+    """
+    new_table = TARGET_TABLE + _NEW_SUFFIX
+    dependents = _dependent_objects(cur, TARGET_TABLE)
+    if dependents:
+        # La bascule supprime l'ancienne table : refuser avant de charger quoi que ce soit
+        raise RuntimeError(f"{TARGET_TABLE} ne peut pas être remplacée, objets dépendants : "
+                           + ", ".join(dependents))
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(new_table)))
+    cur.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING ALL EXCLUDING INDEXES)").format(
+        sql.Identifier(new_table), sql.Identifier(TARGET_TABLE)))
+    for col, seq in _serial_sequences(cur, TARGET_TABLE):
+        new_seq = f"{new_table}_{col}_seq"
+        cur.execute("SELECT format_type(seqtypid, NULL) FROM pg_sequence WHERE seqrelid = %s::regclass", (seq,))
+        seq_type = cur.fetchone()[0]
+        cur.execute(sql.SQL("DROP SEQUENCE IF EXISTS {}").format(sql.Identifier(new_seq)))
+        cur.execute(sql.SQL("CREATE SEQUENCE {} AS {} OWNED BY {}.{}").format(
+            sql.Identifier(new_seq), sql.SQL(seq_type), sql.Identifier(new_table), sql.Identifier(col)))
+        cur.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN {} SET DEFAULT nextval({}::regclass)").format(
+            sql.Identifier(new_table), sql.Identifier(col), sql.Literal(new_seq)))
+
+    # LIKE ne recopie pas les droits : les reporter pour que l'API garde l'accès
+    cur.execute("""
+        SELECT grantee, privilege_type
+        FROM information_schema.table_privileges
+        WHERE table_schema = current_schema() AND table_name = %s AND grantee <> current_user
+    """, (TARGET_TABLE,))
+    for grantee, privilege in cur.fetchall():
+        cur.execute(sql.SQL("GRANT {} ON {} TO {}").format(
+            sql.SQL(privilege),
+            sql.Identifier(new_table),
+            sql.SQL("PUBLIC") if grantee == "PUBLIC" else sql.Identifier(grantee),
+        ))
+
+
+def _publish_new_table(conn) -> None:
+    """
+    Construit contraintes et index de property_assessments_new (noms suffixés),
+    lance ANALYZE, puis la substitue à property_assessments en une transaction :
+    suppression de l'ancienne table (et de ses séquences), renommage de la
+    nouvelle, de ses index et de ses séquences.
+    Dans la même transaction, le suivi de l'import incrémental est remplacé par
+    les fichiers XML des points de reprise (vidé pour un import CSV-only), et
+    les points de reprise sont effacés.
+    """
+    new_table = TARGET_TABLE + _NEW_SUFFIX
+    cur = conn.cursor()
+    try:
+        t_build = time.time()
+        constraints = _index_constraints(cur, TARGET_TABLE)
+        indexes = _secondary_indexes(cur, TARGET_TABLE)
+
+        for name, definition in constraints:
+            t0 = time.time()
+            cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+                sql.Identifier(new_table), sql.Identifier(name + _NEW_SUFFIX), sql.SQL(definition)))
+            logger.info(f"  Contrainte {name} construite en {time.time() - t0:.1f}s")
+        for name, definition in indexes:
+            t0 = time.time()
+            cur.execute(_INDEXDEF_RE.sub(
+                lambda m: (m.group(1) + sql.Identifier(name + _NEW_SUFFIX).as_string(cur)
+                           + m.group(3) + sql.Identifier(new_table).as_string(cur)),
+                definition,
+            ))
+            logger.info(f"  Index {name} construit en {time.time() - t0:.1f}s")
+        cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(new_table)))
+        conn.commit()
+        _report.add("index_build", time.time() - t_build)
+
+        # Bascule : verrou exclusif bref, tout ou rien
+        t0 = time.time()
+        cur.execute(sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(sql.Identifier(TARGET_TABLE)))
+        dependents = _dependent_objects(cur, TARGET_TABLE)
+        if dependents:
+            raise RuntimeError(f"{TARGET_TABLE} ne peut pas être remplacée, objets dépendants : "
+                               + ", ".join(dependents))
+        old_sequences = {}
+        for col, seq in _serial_sequences(cur, TARGET_TABLE):
+            cur.execute("SELECT relname FROM pg_class WHERE oid = %s::regclass", (seq,))
+            old_sequences[col] = cur.fetchone()[0]
+        new_sequences = _serial_sequences(cur, new_table)
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(TARGET_TABLE)))
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+            sql.Identifier(new_table), sql.Identifier(TARGET_TABLE)))
+        for col, seq in new_sequences:
+            # La valeur par défaut référence la séquence par oid : le renommage est sans effet sur elle
+            if col in old_sequences:
+                cur.execute(sql.SQL("ALTER SEQUENCE {} RENAME TO {}").format(
+                    sql.SQL(seq), sql.Identifier(old_sequences[col])))
+        for name, _ in constraints:
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                sql.Identifier(TARGET_TABLE), sql.Identifier(name + _NEW_SUFFIX), sql.Identifier(name)))
+        for name, _ in indexes:
+            cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                sql.Identifier(name + _NEW_SUFFIX), sql.Identifier(name)))
+        _ensure_members_table(cur)
+        _ensure_checkpoint_table(cur)
+        cur.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(MEMBERS_TABLE)))
+        cur.execute(sql.SQL("""
+            INSERT INTO {} (member, municipality, fingerprint, row_count)
+            SELECT member, municipality, fingerprint, row_count
+            FROM {} WHERE source LIKE 'xml:%' AND member LIKE '%.xml'
+        """).format(sql.Identifier(MEMBERS_TABLE), sql.Identifier(CHECKPOINT_TABLE)))
+        cur.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(CHECKPOINT_TABLE)))
+        conn.commit()
+        _report.add("swap", time.time() - t0)
+        logger.info(f"  Bascule vers la nouvelle table en {time.time() - t0:.2f}s")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+# ---------------------------------------------------------------------------
+# Points de reprise : chaque fichier XML (ou tranche du CSV) chargé est
+# enregistré dans la même transaction que ses lignes. Avec --resume, un import
+# interrompu repart de la table de travail existante et saute ce qui y est
+# déjà ; les empreintes des fichiers sources doivent être inchangées.
+# ---------------------------------------------------------------------------
+
+def _file_fingerprint(path: str) -> str:
+    """Empreinte d'un fichier source : CRC-32 du contenu et taille, comme _member_fingerprint."""
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            crc = zlib.crc32(chunk, crc)
+    return f"{crc:08x}:{os.path.getsize(path)}"
+
+
+def _ensure_checkpoint_table(cur) -> None:
+    """Crée au besoin la table des points de reprise."""
+    cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {} (
+            source       TEXT NOT NULL,
+            member       TEXT NOT NULL,
+            municipality TEXT,
+            fingerprint  TEXT NOT NULL,
+            row_count    BIGINT NOT NULL,
+            completed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (source, member)
+        )
+    """).format(sql.Identifier(CHECKPOINT_TABLE)))
+
+
+def _save_checkpoint(cur, source: str, member: str, municipality: str, fingerprint: str, row_count: int) -> None:
+    cur.execute(sql.SQL("""
+        INSERT INTO {} (source, member, municipality, fingerprint, row_count)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (source, member) DO UPDATE
+        SET municipality = EXCLUDED.municipality,
+            fingerprint = EXCLUDED.fingerprint,
+            row_count = EXCLUDED.row_count,
+            completed_at = NOW()
+    """).format(sql.Identifier(CHECKPOINT_TABLE)), (source, member, municipality, fingerprint, row_count))
+
+
+def _resume_checkpoints(conn, source: str, table: str, fingerprints: dict, resume: bool) -> dict:
+    """
+    Retourne {member: row_count} des points de reprise de `source` utilisables,
+    ou {} s'il faut repartir de zéro (les points de reprise sont alors effacés
+    et l'appelant recrée la table de travail).
+
+    Une reprise n'est acceptée que si tous les points de reprise appartiennent
+    à `source`, que les empreintes enregistrées correspondent à `fingerprints`
+    (fichiers sources actuels) et que `table` contient exactement la somme des
+    lignes enregistrées.
+    """
+    cur = conn.cursor()
+    try:
+        _ensure_checkpoint_table(cur)
+        done = {}
+        if resume:
+            cur.execute(sql.SQL("SELECT source, member, fingerprint, row_count FROM {}").format(
+                sql.Identifier(CHECKPOINT_TABLE)))
+            saved = cur.fetchall()
+            cur.execute("SELECT to_regclass(%s)", (table,))
+            stored = None
+            if cur.fetchone()[0] is not None:
+                cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(table)))
+                stored = cur.fetchone()[0]
+            if not saved:
+                logger.info("Aucun point de reprise : import complet")
+            elif any(src != source or fingerprints.get(member) != fp for src, member, fp, _ in saved):
+                logger.warning("Points de reprise d'un autre import ou de fichiers modifiés : import complet")
+            elif stored != sum(count for *_, count in saved):
+                logger.warning(f"Table {table} incohérente avec les points de reprise : import complet")
+            else:
+                done = {member: count for _, member, _, count in saved}
+                logger.info(f"Reprise : {len(done)} point(s) de reprise, {stored} lignes déjà chargées")
+        if not done:
+            cur.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(CHECKPOINT_TABLE)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return done
+
+
+def _xml_fingerprints(zip_path: str, csv_path: str) -> tuple:
+    """
+    Retourne (infos, empreintes) des fichiers XML du ZIP. Les empreintes
+    incluent celle du CSV : les coordonnées jointes en dépendent.
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        infos = [i for i in zf.infolist() if i.filename.endswith(".xml")]
+    fingerprints = {i.filename: _member_fingerprint(i) for i in infos}
+    fingerprints[os.path.basename(csv_path)] = _file_fingerprint(csv_path)
+    return infos, fingerprints
+
+
+def parse_xml_and_insert(zip_path: str, coords: CoordIndex, dsn: str,
+                         resume: bool = False, csv_path: str = CSV_PATH) -> int:
     """
     Parse les fichiers XML du ZIP et insère les données dans PostGIS.
-    Joint avec les coordonnées du CSV par matricule.
+    Joint avec les coordonnées du CSV par matricule (`csv_path` : CSV d'où
+    viennent `coords`, pour les points de reprise).
+    Chaque fichier est inséré et marqué comme traité dans une seule transaction ;
+    avec `resume`, les fichiers déjà traités d'un import interrompu sont sautés.
     Retourne le nombre total de lignes insérées.
     """
+    source = "xml:insert"
+    csv_name = os.path.basename(csv_path)
+    infos, fingerprints = _xml_fingerprints(zip_path, csv_path)
+
     conn = psycopg2.connect(dsn)
     conn.autocommit = False
     cur = conn.cursor()
 
-    # Vider la table avant import
-    cur.execute("TRUNCATE TABLE property_assessments RESTART IDENTITY;")
-    conn.commit()
+    # Charger dans une nouvelle table, la table en service reste lisible
+    done = _resume_checkpoints(conn, source, TARGET_TABLE + _NEW_SUFFIX, fingerprints, resume)
+    if not done:
+        _prepare_new_table(cur)
+        _save_checkpoint(cur, source, csv_name, None, fingerprints[csv_name], 0)
+        conn.commit()
 
-    total_inserted = 0
+    total_inserted = sum(done.values())
     batch = []
 
     insert_sql = """
-        INSERT INTO property_assessments
+        INSERT INTO property_assessments_new
             (matricule, civic_number, street_name, municipality, land_value,
              building_value, total_value, year_built, lot_area_sqm,
              building_area_sqm, use_code, geom)
         VALUES %s
     """
     template = (
-        "(%(matricule)s, %(civic_number)s, %(street_name)s, %(municipality)s, "
-        "%(land_value)s, %(building_value)s, %(total_value)s, %(year_built)s, "
-        "%(lot_area_sqm)s, %(building_area_sqm)s, %(use_code)s, "
-        "ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326))"
-    )
-    template_no_geom = (
-        "(%(matricule)s, %(civic_number)s, %(street_name)s, %(municipality)s, "
-        "%(land_value)s, %(building_value)s, %(total_value)s, %(year_built)s, "
-        "%(lot_area_sqm)s, %(building_area_sqm)s, %(use_code)s, NULL)"
+        "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, "
+        "ST_SetSRID(ST_MakePoint(%s, %s), 4326))"
     )
+    template_no_geom = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NULL)"
 
     def flush_batch():
         nonlocal total_inserted
         if not batch:
             return
         # Split into rows with and without geometry
-        with_geom = [r for r in batch if r.get("lon") is not None]
-        without_geom = [r for r in batch if r.get("lon") is None]
-        if with_geom:
-            psycopg2.extras.execute_values(
-                cur, insert_sql, with_geom, template=template, page_size=BATCH_SIZE
-            )
-        if without_geom:
-            psycopg2.extras.execute_values(
-                cur, insert_sql, without_geom, template=template_no_geom, page_size=BATCH_SIZE
-            )
-        conn.commit()
+        with_geom = [r for r in batch if r[-2] is not None]
+        without_geom = [r[:-2] for r in batch if r[-2] is None]
+        with _report.db_batch() as timed:
+            if with_geom:
+                psycopg2.extras.execute_values(
+                    cur, insert_sql, with_geom, template=template, page_size=BATCH_SIZE
+                )
+            if without_geom:
+                psycopg2.extras.execute_values(
+                    cur, insert_sql, without_geom, template=template_no_geom, page_size=BATCH_SIZE
+                )
+            timed["rows"] = len(batch)
         total_inserted += len(batch)
         batch.clear()
 
     with zipfile.ZipFile(zip_path) as zf:
-        xml_files = [n for n in zf.namelist() if n.endswith(".xml")]
-        logger.info(f"Traitement de {len(xml_files)} fichiers XML ...")
-
-        for i, xml_name in enumerate(xml_files):
-            with zf.open(xml_name) as f:
-                try:
-                    tree = ET.parse(f)
-                except ET.ParseError as e:
-                    logger.warning(f"  Erreur XML dans {xml_name}: {e}")
-                    continue
-            root = tree.getroot()
-            mun_code = _text(root, "RLM01A")
-
-            for unit in root.findall("RLUEx"):
-                # Build matricule from RL0104 parts
-                rl0104 = unit.find("RL0104")
-                if rl0104 is None:
-                    continue
-                a = _text(rl0104, "RL0104A")
-                b = _text(rl0104, "RL0104B")
-                c = _text(rl0104, "RL0104C")
-                d = _text(rl0104, "RL0104D")
-                matricule = f"{a}{b}{c}{d}".ljust(18, "0")
-
-                # Address from RL0101
-                civic_number = None
-                street_name = None
-                rl0101 = unit.find("RL0101")
-                if rl0101 is not None:
-                    first_addr = rl0101.find("RL0101x")
-                    if first_addr is not None:
-                        civic_number = _text(first_addr, "RL0101Ax") or None
-                        street_type = _text(first_addr, "RL0101Ex")
-                        street_nm = _text(first_addr, "RL0101Gx")
-                        if street_nm:
-                            street_name = f"{street_type} {street_nm}".strip() if street_type else street_nm
-
-                # Values
-                land_value = _int_or_none(_text(unit, "RL0402A"))
-                building_value = _int_or_none(_text(unit, "RL0403A"))
-                total_value = _int_or_none(_text(unit, "RL0404A"))
-                year_built = _int_or_none(_text(unit, "RL0307A"))
-                lot_area_sqm = _float_or_none(_text(unit, "RL0302A"))
-                building_area_sqm = _float_or_none(_text(unit, "RL0308A"))
-                use_code = _text(unit, "RL0105A") or None
-
-                # Coordinates from CSV
-                coord = coords.get(matricule)
-                lon = coord[0] if coord else None
-                lat = coord[1] if coord else None
-
-                batch.append({
-                    "matricule": matricule,
-                    "civic_number": civic_number,
-                    "street_name": street_name,
-                    "municipality": mun_code,
-                    "land_value": land_value,
-                    "building_value": building_value,
-                    "total_value": total_value,
-                    "year_built": year_built,
-                    "lot_area_sqm": lot_area_sqm,
-                    "building_area_sqm": building_area_sqm,
-                    "use_code": use_code,
-                    "lon": lon,
-                    "lat": lat,
-                })
+        logger.info(f"Traitement de {len(infos)} fichiers XML ...")
 
+        for i, info in enumerate(infos):
+            if info.filename in done:
+                continue
+            stats = {}
+            inserted_before = total_inserted
+            for row in _timed_member_rows(zf, info.filename, coords, stats):
+                batch.append(row)
                 if len(batch) >= BATCH_SIZE:
                     flush_batch()
+            flush_batch()
+            if stats["error"]:
+                # Fichier mal formé ignoré en entier, sans point de reprise
+                conn.rollback()
+                total_inserted = inserted_before
+                continue
+            with _report.phase("db_load"):
+                _save_checkpoint(cur, source, info.filename, stats["municipality"],
+                                 fingerprints[info.filename], stats["rows"])
+                conn.commit()
 
             if (i + 1) % 50 == 0:
-                flush_batch()
-                logger.info(f"  {i + 1}/{len(xml_files)} fichiers traités, {total_inserted} lignes insérées")
+                logger.info(f"  {i + 1}/{len(infos)} fichiers traités, {total_inserted} lignes insérées")
 
-    flush_batch()
     cur.close()
+    _publish_new_table(conn)
     conn.close()
     return total_inserted
 
 
-def parse_csv_only_and_insert(csv_path: str, dsn: str) -> int:
+def parse_csv_only_and_insert(csv_path: str, dsn: str, resume: bool = False) -> int:
     """
     Mode simplifié : insère uniquement les données du CSV (matricule + coordonnées).
     Utile pour tester rapidement sans le ZIP XML.
+    Le nombre de lignes insérées est enregistré à chaque lot ; avec `resume`,
+    un import interrompu reprend après la dernière ligne enregistrée.
     """
     logger.info("Mode CSV-only : import des coordonnées uniquement ...")
+    source = "csv:insert"
+    csv_name = os.path.basename(csv_path)
+    fingerprint = _file_fingerprint(csv_path)
+
     conn = psycopg2.connect(dsn)
     conn.autocommit = False
     cur = conn.cursor()
 
-    cur.execute("TRUNCATE TABLE property_assessments RESTART IDENTITY;")
-    conn.commit()
+    done = _resume_checkpoints(conn, source, TARGET_TABLE + _NEW_SUFFIX, {csv_name: fingerprint}, resume)
+    if not done:
+        _prepare_new_table(cur)
+        conn.commit()
 
     insert_sql = """
-        INSERT INTO property_assessments (matricule, municipality, geom)
+        INSERT INTO property_assessments_new (matricule, municipality, geom)
         VALUES %s
     """
-    template = (
-        "(%(matricule)s, %(municipality)s, "
-        "ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326))"
-    )
+    template = "(%s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))"
 
-    total = 0
+    total = done.get(csv_name, 0)
     batch = []
-    with open(csv_path, "r", encoding="utf-8") as f:
-        f.readline()  # skip header
-        reader = csv.reader(f)
-        for row in reader:
-            if len(row) < 8:
-                continue
-            code_mun = row[1]
-            mat18 = row[5]
-            try:
-                lon = float(row[6].replace(",", "."))
-                lat = float(row[7].replace(",", "."))
-            except (ValueError, IndexError):
-                continue
-            if not (-85 < lon < -50 and 40 < lat < 65):
-                continue
-            batch.append({"matricule": mat18, "municipality": code_mun, "lon": lon, "lat": lat})
-            if len(batch) >= BATCH_SIZE:
-                psycopg2.extras.execute_values(cur, insert_sql, batch, template=template, page_size=BATCH_SIZE)
-                conn.commit()
-                total += len(batch)
-                batch.clear()
-                if total % 100000 == 0:
-                    logger.info(f"  {total} lignes insérées ...")
+
+    def flush_batch():
+        nonlocal total
+        with _report.db_batch() as timed:
+            psycopg2.extras.execute_values(cur, insert_sql, batch, template=template, page_size=BATCH_SIZE)
+            total += len(batch)
+            _save_checkpoint(cur, source, csv_name, None, fingerprint, total)
+            conn.commit()
+            timed["rows"] = len(batch)
+        batch.clear()
+
+    points = _report.timed_rows(itertools.islice(iter_csv_points(csv_path), total, None), "csv_parse")
+    for point in points:
+        batch.append(point)
+        if len(batch) >= BATCH_SIZE:
+            flush_batch()
+            if total % 100000 == 0:
+                logger.info(f"  {total} lignes insérées ...")
 
     if batch:
-        psycopg2.extras.execute_values(cur, insert_sql, batch, template=template, page_size=BATCH_SIZE)
-        conn.commit()
-        total += len(batch)
+        flush_batch()
 
     cur.close()
+    _publish_new_table(conn)
     conn.close()
     return total
 
 
+# ---------------------------------------------------------------------------
+# Chargeur COPY : flux COPY FROM STDIN vers une table de staging non indexée,
+# puis construction des géométries et des index en SQL ensembliste.
+# ---------------------------------------------------------------------------
+
+# Types de la table de staging ; le format binaire de COPY exige qu'ils
+# correspondent exactement aux encodeurs de _BINARY_ENCODERS.
+STAGING_COLUMNS = (
+    ("matricule", "text"),
+    ("civic_number", "text"),
+    ("street_name", "text"),
+    ("municipality", "text"),
+    ("land_value", "bigint"),
+    ("building_value", "bigint"),
+    ("total_value", "bigint"),
+    ("year_built", "integer"),
+    ("lot_area_sqm", "double precision"),
+    ("building_area_sqm", "double precision"),
+    ("use_code", "text"),
+    ("lon", "double precision"),
+    ("lat", "double precision"),
+)
+
+_COPY_TEXT_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+_PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_PGCOPY_TRAILER = struct.pack("!h", -1)
+_PGCOPY_NULL = struct.pack("!i", -1)
+_PGCOPY_FIELD_COUNT = struct.pack("!h", len(STAGING_COLUMNS))
+_PGCOPY_LEN = struct.Struct("!i")
+_PGCOPY_INT8 = struct.Struct("!iq")
+_PGCOPY_INT4 = struct.Struct("!ii")
+_PGCOPY_FLOAT8 = struct.Struct("!id")
+
+
+def _encode_text(value) -> bytes:
+    data = value.encode("utf-8")
+    return _PGCOPY_LEN.pack(len(data)) + data
+
+
+_BINARY_ENCODERS = {
+    "text": _encode_text,
+    "bigint": lambda v: _PGCOPY_INT8.pack(8, v),
+    "integer": lambda v: _PGCOPY_INT4.pack(4, v),
+    "double precision": lambda v: _PGCOPY_FLOAT8.pack(8, v),
+}
+_ROW_ENCODERS = tuple(_BINARY_ENCODERS[t] for _, t in STAGING_COLUMNS)
+
+
+def _copy_text_row(row) -> bytes:
+    """Encode une ligne au format texte de COPY (tabulations, \\N pour NULL)."""
+    return ("\t".join(
+        "\\N" if v is None else str(v).translate(_COPY_TEXT_ESCAPES) for v in row
+    ) + "\n").encode("utf-8")
+
+
+def _copy_binary_row(row) -> bytes:
+    """Encode une ligne au format binaire de COPY."""
+    parts = [_PGCOPY_FIELD_COUNT]
+    for value, encode in zip(row, _ROW_ENCODERS):
+        parts.append(_PGCOPY_NULL if value is None else encode(value))
+    return b"".join(parts)
+
+
+class _CopyStream:
+    """
+    Objet fichier en lecture seule au-dessus d'un itérateur de lignes, pour
+    cursor.copy_expert : les lignes sont encodées au fil de la lecture, sans
+    jamais matérialiser l'import complet en mémoire.
+    """
+
+    def __init__(self, rows, fmt: str = "text"):
+        self._rows = iter(rows)
+        self._binary = fmt == "binary"
+        self._encode = _copy_binary_row if self._binary else _copy_text_row
+        self._buf = bytearray(_PGCOPY_HEADER if self._binary else b"")
+        self._done = False
+        self.count = 0
+
+    def _fill(self, size: int) -> None:
+        while not self._done and (size < 0 or len(self._buf) < size):
+            row = next(self._rows, None)
+            if row is None:
+                self._done = True
+                if self._binary:
+                    self._buf += _PGCOPY_TRAILER
+                break
+            self._buf += self._encode(row)
+            self.count += 1
+
+    def read(self, size: int = -1) -> bytes:
+        self._fill(size)
+        if size < 0 or size >= len(self._buf):
+            chunk = bytes(self._buf)
+            self._buf.clear()
+        else:
+            chunk = bytes(self._buf[:size])
+            del self._buf[:size]
+        return chunk
+
+    readline = read
+
+
+def _create_staging_table(cur, table: str = STAGING_TABLE, temporary: bool = False) -> None:
+    """
+    (Re)crée une table de staging sans index ni géométrie : UNLOGGED, ou
+    temporaire et supprimée au commit si `temporary`.
+    """
+    columns = sql.SQL(", ").join(
+        sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(type_))
+        for name, type_ in STAGING_COLUMNS
+    )
+    if temporary:
+        cur.execute(sql.SQL("CREATE TEMP TABLE {} ({}) ON COMMIT DROP").format(
+            sql.Identifier(table), columns))
+    else:
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+        cur.execute(sql.SQL("CREATE UNLOGGED TABLE {} ({})").format(
+            sql.Identifier(table), columns))
+
+
+def _copy_into_staging(cur, rows, fmt: str, table: str = STAGING_TABLE) -> int:
+    """COPY FROM STDIN des lignes dans une table de staging. Retourne le nombre de lignes."""
+    stream = _CopyStream(rows, fmt)
+    options = sql.SQL("FORMAT binary") if fmt == "binary" else sql.SQL("FORMAT text")
+    cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH ({})").format(
+        sql.Identifier(table),
+        sql.SQL(", ").join(sql.Identifier(name) for name, _ in STAGING_COLUMNS),
+        options,
+    ).as_string(cur), stream, size=1024 * 1024)
+    return stream.count
+
+
+def _merge_staging(cur) -> int:
+    """
+    Remplit property_assessments_new depuis la table de staging : géométries
+    construites en un seul INSERT ... SELECT. Retourne le nombre de lignes.
+    Les index et la bascule sont faits ensuite par _publish_new_table.
+    """
+    _prepare_new_table(cur)
+    columns = sql.SQL(", ").join(sql.Identifier(c) for c in LOAD_COLUMNS)
+    cur.execute(sql.SQL("""
+        INSERT INTO {target} ({columns}, geom)
+        SELECT {columns},
+               CASE WHEN lon IS NOT NULL
+                    THEN ST_SetSRID(ST_MakePoint(lon, lat), 4326) END
+        FROM {staging}
+    """).format(
+        target=sql.Identifier(TARGET_TABLE + _NEW_SUFFIX),
+        staging=sql.Identifier(STAGING_TABLE),
+        columns=columns,
+    ))
+    return cur.rowcount
+
+
+def _log_rate(label: str, count: int, elapsed: float) -> None:
+    rate = count / elapsed if elapsed > 0 else 0
+    logger.info(f"  {label} : {count} lignes en {elapsed:.1f}s ({rate:.0f} lignes/s)")
+
+
+def _start_copy_load(conn, source: str, fingerprints: dict, resume: bool) -> dict:
+    """
+    Prépare la table de staging d'un chargement COPY : reprise de l'existante
+    si les points de reprise le permettent, sinon table neuve.
+    Retourne les points de reprise (voir _resume_checkpoints).
+    """
+    done = _resume_checkpoints(conn, source, STAGING_TABLE, fingerprints, resume)
+    if not done:
+        cur = conn.cursor()
+        _create_staging_table(cur)
+        cur.close()
+        conn.commit()
+    return done
+
+
+def _finish_copy_load(conn, expected: int) -> int:
+    """
+    Vérifie que la table de staging contient `expected` lignes, la fusionne dans
+    une nouvelle table substituée à property_assessments une fois indexée, puis
+    la supprime. Retourne le nombre de lignes chargées.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(STAGING_TABLE)))
+        staged = cur.fetchone()[0]
+        if staged != expected:
+            raise RuntimeError(f"Staging incohérent : {staged} lignes pour {expected} attendues")
+
+        logger.info(f"Fusion dans {TARGET_TABLE} (géométries + index) ...")
+        t0 = time.time()
+        count = _merge_staging(cur)
+        if count != expected:
+            raise RuntimeError(f"Fusion incomplète : {count} lignes pour {expected} copiées")
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(STAGING_TABLE)))
+        conn.commit()
+        _report.add("db_load", time.time() - t0)
+        _publish_new_table(conn)
+        _log_rate("Fusion", count, time.time() - t0)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return count
+
+
+def copy_xml_load(zip_path: str, coords: CoordIndex, dsn: str, fmt: str = "text",
+                  resume: bool = False, csv_path: str = CSV_PATH) -> int:
+    """
+    Charge les fichiers XML du ZIP via COPY FROM STDIN dans une table de staging
+    non indexée, un fichier par transaction avec son point de reprise, puis les
+    fusionne dans une nouvelle table substituée à property_assessments.
+    fmt : "text" ou "binary" (format de COPY).
+    Avec `resume`, les fichiers déjà copiés d'un import interrompu sont sautés.
+    Retourne le nombre de lignes chargées.
+    """
+    source = "xml:copy"
+    csv_name = os.path.basename(csv_path)
+    infos, fingerprints = _xml_fingerprints(zip_path, csv_path)
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = False
+    try:
+        done = _start_copy_load(conn, source, fingerprints, resume)
+        cur = conn.cursor()
+        if not done:
+            _save_checkpoint(cur, source, csv_name, None, fingerprints[csv_name], 0)
+            conn.commit()
+
+        logger.info(f"COPY ({fmt}) de {len(infos)} fichiers XML vers {STAGING_TABLE} ...")
+        copied = 0
+        t0 = time.time()
+        with zipfile.ZipFile(zip_path) as zf:
+            for i, info in enumerate(infos):
+                if info.filename in done:
+                    continue
+                stats = {}
+                with _report.db_batch("xml_parse") as batch:
+                    count = _copy_into_staging(cur, _timed_member_rows(zf, info.filename, coords, stats), fmt)
+                    if stats["error"]:
+                        # Fichier mal formé ignoré en entier, sans point de reprise
+                        conn.rollback()
+                        count = 0
+                    else:
+                        _save_checkpoint(cur, source, info.filename, stats["municipality"],
+                                         fingerprints[info.filename], count)
+                        conn.commit()
+                    batch["rows"] = count
+                copied += count
+                if (i + 1) % 50 == 0:
+                    logger.info(f"  {i + 1}/{len(infos)} fichiers traités")
+        cur.close()
+        _log_rate("COPY", copied, time.time() - t0)
+
+        return _finish_copy_load(conn, copied + sum(done.values()))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def copy_csv_load(csv_path: str, dsn: str, fmt: str = "text", resume: bool = False) -> int:
+    """
+    Mode CSV-only avec le chargeur COPY : le CSV est copié par tranches de
+    CSV_CHECKPOINT_ROWS lignes, chacune validée avec son point de reprise.
+    Avec `resume`, un import interrompu reprend après la dernière tranche.
+    Retourne le nombre de lignes chargées.
+    """
+    logger.info("Mode CSV-only : import des coordonnées uniquement ...")
+    source = "csv:copy"
+    csv_name = os.path.basename(csv_path)
+    fingerprint = _file_fingerprint(csv_path)
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = False
+    try:
+        done = _start_copy_load(conn, source, {csv_name: fingerprint}, resume)
+        offset = done.get(csv_name, 0)
+        cur = conn.cursor()
+
+        logger.info(f"COPY ({fmt}) vers {STAGING_TABLE} ...")
+        copied = 0
+        t0 = time.time()
+        rows = _report.timed_rows(itertools.islice(iter_csv_rows(csv_path), offset, None), "csv_parse")
+        while True:
+            with _report.db_batch("csv_parse") as batch:
+                count = _copy_into_staging(cur, itertools.islice(rows, CSV_CHECKPOINT_ROWS), fmt)
+                if count:
+                    _save_checkpoint(cur, source, csv_name, None, fingerprint, offset + copied + count)
+                    conn.commit()
+                batch["rows"] = count
+            if not count:
+                break
+            copied += count
+        cur.close()
+        _log_rate("COPY", copied, time.time() - t0)
+
+        return _finish_copy_load(conn, offset + copied)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Import parallèle : un fichier XML (municipalité) par tâche, répartis sur un
+# pool de processus. Chaque worker parse son fichier et le charge par COPY dans
+# la table de staging ; le processus principal fusionne et vérifie à la fin.
+# ---------------------------------------------------------------------------
+
+# État des workers, initialisé par _init_import_worker. Le CoordIndex est
+# hérité du parent par fork : ses tampons en lecture seule restent partagés.
+_worker_coords = None
+_worker_zip = None
+_worker_conn = None
+
+
+def _init_import_worker(zip_path: str, dsn: str) -> None:
+    global _worker_zip, _worker_conn
+    _worker_zip = zipfile.ZipFile(zip_path)
+    _worker_conn = psycopg2.connect(dsn)
+    _worker_conn.autocommit = False
+
+
+def _import_member_worker(task):
+    """
+    Parse un fichier XML et le copie dans la table de staging, avec son point
+    de reprise dans la même transaction.
+    Retourne (nom, lignes, municipalité, durée, mesures de la tâche), les
+    mesures étant ajoutées au rapport du processus principal.
+    """
+    global _report
+
+    xml_name, fingerprint, fmt = task
+    t0 = time.time()
+    _report = ImportReport()
+    stats = {}
+    cur = _worker_conn.cursor()
+    try:
+        with _report.db_batch("xml_parse") as batch:
+            count = _copy_into_staging(cur, _timed_member_rows(_worker_zip, xml_name, _worker_coords, stats), fmt)
+            if stats["error"]:
+                # Fichier mal formé ignoré en entier, sans point de reprise
+                _worker_conn.rollback()
+                count = 0
+            else:
+                _save_checkpoint(cur, "xml:copy", xml_name, stats["municipality"], fingerprint, count)
+                _worker_conn.commit()
+            batch["rows"] = count
+    except Exception:
+        _worker_conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return xml_name, count, stats["municipality"], time.time() - t0, (_report.phases, _report.batches)
+
+
+def parallel_xml_load(zip_path: str, coords: CoordIndex, dsn: str, jobs: int, fmt: str = "text",
+                      resume: bool = False, csv_path: str = CSV_PATH) -> int:
+    """
+    Import des fichiers XML du ZIP sur `jobs` processus (chargeur COPY).
+    Les fichiers sont distribués du plus gros au plus petit ; la progression est
+    journalisée dans cet ordre. Avant la fusion, le nombre de lignes en staging
+    est comparé au total rapporté par les workers. Les points de reprise sont
+    ceux de copy_xml_load : une reprise peut changer de nombre de processus.
+    Retourne le nombre de lignes chargées.
+    """
+    global _worker_coords
+
+    source = "xml:copy"
+    csv_name = os.path.basename(csv_path)
+    infos, fingerprints = _xml_fingerprints(zip_path, csv_path)
+    infos.sort(key=lambda info: info.file_size, reverse=True)
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = False
+    try:
+        done = _start_copy_load(conn, source, fingerprints, resume)
+        if not done:
+            cur = conn.cursor()
+            _save_checkpoint(cur, source, csv_name, None, fingerprints[csv_name], 0)
+            cur.close()
+            conn.commit()
+
+        xml_files = [info.filename for info in infos if info.filename not in done]
+        logger.info(f"Traitement de {len(xml_files)} fichiers XML sur {jobs} processus ...")
+
+        _worker_coords = coords
+        ctx = multiprocessing.get_context("fork")
+        copied = 0
+        t0 = time.time()
+        with ctx.Pool(jobs, initializer=_init_import_worker, initargs=(zip_path, dsn)) as pool:
+            tasks = [(name, fingerprints[name], fmt) for name in xml_files]
+            for i, (name, count, _, _, measures) in enumerate(pool.imap(_import_member_worker, tasks)):
+                _report.merge(*measures)
+                copied += count
+                if (i + 1) % 50 == 0 or i + 1 == len(xml_files):
+                    logger.info(f"  {i + 1}/{len(xml_files)} fichiers traités, {copied} lignes copiées")
+        _worker_coords = None
+        _log_rate(f"COPY parallèle ({fmt}, {jobs} processus)", copied, time.time() - t0)
+
+        return _finish_copy_load(conn, copied + sum(done.values()))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Import incrémental : chaque fichier XML est identifié par son empreinte
+# (CRC-32 + taille). Les municipalités inchangées, XML comme coordonnées, sont
+# ignorées ; les autres sont mises à jour en place par matricule, les unités
+# disparues supprimées, chaque fichier dans sa propre transaction.
+# ---------------------------------------------------------------------------
+
+def _ensure_members_table(cur) -> None:
+    """Crée au besoin la table de suivi des fichiers XML importés."""
+    cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {} (
+            member       TEXT PRIMARY KEY,
+            municipality TEXT,
+            fingerprint  TEXT NOT NULL,
+            row_count    INTEGER NOT NULL,
+            imported_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """).format(sql.Identifier(MEMBERS_TABLE)))
+
+
+def _record_member(cur, member: str, municipality: str, fingerprint: str, row_count: int) -> None:
+    cur.execute(sql.SQL("""
+        INSERT INTO {} (member, municipality, fingerprint, row_count)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (member) DO UPDATE
+        SET municipality = EXCLUDED.municipality,
+            fingerprint = EXCLUDED.fingerprint,
+            row_count = EXCLUDED.row_count,
+            imported_at = NOW()
+    """).format(sql.Identifier(MEMBERS_TABLE)), (member, municipality, fingerprint, row_count))
+
+
+def _coordinate_drift(conn, municipalities: set, coords: CoordIndex) -> set:
+    """
+    Retourne les municipalités dont au moins une unité n'a plus, dans le CSV,
+    les coordonnées enregistrées en base (XML inchangé mais CSV modifié).
+    """
+    drifted = set()
+    if not municipalities:
+        return drifted
+    cur = conn.cursor(name="coordinate_drift")
+    cur.itersize = 50000
+    cur.execute(sql.SQL("""
+        SELECT municipality, matricule, ST_X(geom), ST_Y(geom)
+        FROM {} WHERE municipality = ANY(%s)
+    """).format(sql.Identifier(TARGET_TABLE)), (list(municipalities),))
+    for mun_code, matricule, lon, lat in cur:
+        if mun_code in drifted:
+            continue
+        stored = (lon, lat) if lon is not None else None
+        if coords.get(matricule) != stored:
+            drifted.add(mun_code)
+    cur.close()
+    conn.commit()
+    return drifted
+
+
+def _apply_member(cur, municipalities: list) -> tuple:
+    """
+    Applique la table temporaire member_load à property_assessments pour les
+    municipalités données : mise à jour des unités modifiées, ajout des nouvelles,
+    suppression des disparues. Retourne (mises à jour, ajouts, suppressions).
+    """
+    params = {
+        "target": sql.Identifier(TARGET_TABLE),
+        "columns": sql.SQL(", ").join(sql.Identifier(c) for c in LOAD_COLUMNS),
+        "s_columns": sql.SQL(", ").join(sql.SQL("s.") + sql.Identifier(c) for c in LOAD_COLUMNS),
+        "t_columns": sql.SQL(", ").join(sql.SQL("t.") + sql.Identifier(c) for c in LOAD_COLUMNS),
+        "assignments": sql.SQL(", ").join(
+            sql.SQL("{0} = s.{0}").format(sql.Identifier(c)) for c in LOAD_COLUMNS),
+    }
+    cur.execute(sql.SQL("""
+        UPDATE {target} t
+        SET {assignments},
+            geom = CASE WHEN s.lon IS NOT NULL
+                        THEN ST_SetSRID(ST_MakePoint(s.lon, s.lat), 4326) END
+        FROM member_load s
+        WHERE t.matricule = s.matricule
+          AND t.municipality = ANY(%(municipalities)s)
+          AND ({t_columns}, ST_X(t.geom), ST_Y(t.geom))
+              IS DISTINCT FROM ({s_columns}, s.lon, s.lat)
+    """).format(**params), {"municipalities": municipalities})
+    updated = cur.rowcount
+    cur.execute(sql.SQL("""
+        INSERT INTO {target} ({columns}, geom)
+        SELECT {s_columns},
+               CASE WHEN s.lon IS NOT NULL
+                    THEN ST_SetSRID(ST_MakePoint(s.lon, s.lat), 4326) END
+        FROM member_load s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {target} t
+            WHERE t.matricule = s.matricule AND t.municipality = ANY(%(municipalities)s)
+        )
+    """).format(**params), {"municipalities": municipalities})
+    inserted = cur.rowcount
+    cur.execute(sql.SQL("""
+        DELETE FROM {target} t
+        WHERE t.municipality = ANY(%(municipalities)s)
+          AND NOT EXISTS (SELECT 1 FROM member_load s WHERE s.matricule = t.matricule)
+    """).format(**params), {"municipalities": municipalities})
+    return updated, inserted, cur.rowcount
+
+
+def incremental_xml_load(zip_path: str, coords: CoordIndex, dsn: str, fmt: str = "text") -> int:
+    """
+    Import incrémental du ZIP XML dans property_assessments, en place.
+    Ne retraite que les fichiers dont l'empreinte a changé depuis le dernier
+    import (ou dont les coordonnées CSV ont changé), et supprime les unités des
+    fichiers retirés du ZIP. Retourne le nombre de lignes des fichiers retraités.
+    """
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = False
+    cur = conn.cursor()
+    try:
+        _ensure_members_table(cur)
+        cur.execute(sql.SQL("SELECT member, municipality, fingerprint FROM {}").format(
+            sql.Identifier(MEMBERS_TABLE)))
+        known = {member: (mun_code, fp) for member, mun_code, fp in cur.fetchall()}
+        conn.commit()
+
+        with zipfile.ZipFile(zip_path) as zf:
+            infos = [i for i in zf.infolist() if i.filename.endswith(".xml")]
+            unchanged = {
+                i.filename for i in infos
+                if i.filename in known and known[i.filename][1] == _member_fingerprint(i)
+            }
+            drifted = _coordinate_drift(
+                conn, {known[name][0] for name in unchanged if known[name][0]}, coords)
+            todo = [i for i in infos if i.filename not in unchanged or known[i.filename][0] in drifted]
+            logger.info(
+                f"Import incrémental : {len(todo)}/{len(infos)} fichiers à traiter "
+                f"({len(drifted)} municipalité(s) aux coordonnées modifiées)"
+            )
+
+            total = 0
+            for i, info in enumerate(todo):
+                stats = {}
+                _create_staging_table(cur, "member_load", temporary=True)
+                t_member = time.time()
+                parsed = _report.phases["xml_parse"]
+                count = _copy_into_staging(
+                    cur, _timed_member_rows(zf, info.filename, coords, stats), fmt, "member_load")
+                if stats["error"] or not count:
+                    # Données existantes conservées ; le fichier sera retenté au prochain import
+                    logger.warning(f"  {info.filename} ignoré : aucune ligne valide")
+                    conn.rollback()
+                    continue
+
+                municipalities = [stats["municipality"]]
+                previous = known.get(info.filename, (None, None))[0]
+                if previous and previous != stats["municipality"]:
+                    municipalities.append(previous)
+                updated, inserted, deleted = _apply_member(cur, municipalities)
+                _record_member(cur, info.filename, stats["municipality"], _member_fingerprint(info), count)
+                conn.commit()
+                _report.add_batch(time.time() - t_member - (_report.phases["xml_parse"] - parsed), count)
+                total += count
+                logger.info(
+                    f"  {i + 1}/{len(todo)} {info.filename} : {updated} mises à jour, "
+                    f"{inserted} ajouts, {deleted} suppressions"
+                )
+
+        # Fichiers retirés du ZIP : leurs unités disparaissent aussi
+        removed = set(known) - {i.filename for i in infos}
+        for member in sorted(removed):
+            mun_code = known[member][0]
+            if mun_code:
+                cur.execute(sql.SQL("DELETE FROM {} WHERE municipality = %s").format(
+                    sql.Identifier(TARGET_TABLE)), (mun_code,))
+                logger.info(f"  {member} retiré du ZIP : {cur.rowcount} unités supprimées")
+            cur.execute(sql.SQL("DELETE FROM {} WHERE member = %s").format(
+                sql.Identifier(MEMBERS_TABLE)), (member,))
+            conn.commit()
+
+        if todo or removed:
+            cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(TARGET_TABLE)))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return total
+
+
+# ---------------------------------------------------------------------------
+# Banc d'essai : jeu de données factice de taille choisie (--synthetic), au
+# format des fichiers publiés, pour mesurer l'import contre une base locale
+# sans téléchargement.
+# ---------------------------------------------------------------------------
+
+SYNTHETIC_DIR = os.path.join(DOWNLOAD_DIR, "synthetic")
+SYNTHETIC_UNITS_PER_FILE = 3000
+_SYNTHETIC_STREETS = ("rue", "avenue", "boulevard", "chemin", "rang", "")
+_SYNTHETIC_NAMES = ("Principale", "des Érables", "Saint-Laurent", "du Lac", "Notre-Dame", "de l'Église")
+
+
+def _synthetic_unit(rng: random.Random, parts: tuple) -> str:
+    """Un élément RLUEx factice : matricule, adresse, utilisation, superficies et valeurs."""
+    land = rng.randrange(20000, 400000)
+    building = rng.randrange(0, 900000)
+    street_type = rng.choice(_SYNTHETIC_STREETS)
+    street_type = f"<RL0101Ex>{street_type}</RL0101Ex>" if street_type else ""
+    return (
+        "<RLUEx>"
+        "<RL0104><RL0104A>{}</RL0104A><RL0104B>{}</RL0104B><RL0104C>{}</RL0104C>"
+        "<RL0104D>{}</RL0104D></RL0104>"
+        "<RL0101><RL0101x><RL0101Ax>{}</RL0101Ax>{}<RL0101Gx>{}</RL0101Gx></RL0101x></RL0101>"
+        "<RL0105A>{}</RL0105A><RL0302A>{:.1f}</RL0302A><RL0307A>{}</RL0307A>"
+        "<RL0308A>{:.1f}</RL0308A><RL0402A>{}</RL0402A><RL0403A>{}</RL0403A>"
+        "<RL0404A>{}</RL0404A>"
+        "</RLUEx>\n"
+    ).format(
+        *parts, rng.randrange(1, 9999), street_type, rng.choice(_SYNTHETIC_NAMES),
+        rng.choice((1000, 1211, 5000, 6000, 9100)), rng.uniform(150, 20000), rng.randrange(1850, 2026),
+        rng.uniform(40, 800), land, building, land + building,
+    )
+
+
+def generate_synthetic_data(units: int, seed: int = 0, directory: str = SYNTHETIC_DIR) -> tuple:
+    """
+    Génère `units` unités factices : un ZIP d'un fichier XML par municipalité
+    (SYNTHETIC_UNITS_PER_FILE unités chacun) et le CSV de leurs coordonnées
+    (format français, entre guillemets). Environ 10 % des unités n'ont pas de
+    coordonnées et le CSV contient 1 % de matricules absents du ZIP.
+    Les fichiers, déterministes pour (units, seed), sont réutilisés s'ils existent.
+    Retourne (chemin du CSV, chemin du ZIP).
+    """
+    csv_path = os.path.join(directory, f"synthetic_{units}_{seed}.csv")
+    zip_path = os.path.join(directory, f"synthetic_{units}_{seed}.zip")
+    if os.path.exists(csv_path) and os.path.exists(zip_path):
+        logger.info(f"Données synthétiques existantes : {csv_path}, {zip_path}")
+        return csv_path, zip_path
+
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    t0 = time.time()
+    files = -(-units // SYNTHETIC_UNITS_PER_FILE)
+    with open(csv_path + ".part", "w", encoding="utf-8") as csv_file, \
+            zipfile.ZipFile(zip_path + ".part", "w", zipfile.ZIP_DEFLATED) as zf:
+        csv_file.write("id,code_mun,annee,code_utilisation,nb_logements,matricule,longitude,latitude\n")
+        for n in range(files):
+            mun_code = f"{10000 + n * 7 % 90000:05d}"
+            center = (rng.uniform(-79.0, -60.0), rng.uniform(45.0, 49.0))
+            body = [f'<?xml version="1.0" encoding="UTF-8"?>\n<RL>\n<RLM01A>{mun_code}</RLM01A>\n']
+            lines = []
+            count = min(SYNTHETIC_UNITS_PER_FILE, units - n * SYNTHETIC_UNITS_PER_FILE)
+            for u in range(count + count // 100):
+                parts = (f"{n % 10000:04d}", f"{u // 10000:02d}", f"{u % 10000:04d}", str(n // 10000))
+                if u < count:
+                    body.append(_synthetic_unit(rng, parts))
+                    if rng.random() < 0.1:
+                        continue
+                matricule = "".join(parts).ljust(18, "0")
+                lon = f"{center[0] + rng.uniform(-0.2, 0.2):.6f}".replace(".", ",")
+                lat = f"{center[1] + rng.uniform(-0.2, 0.2):.6f}".replace(".", ",")
+                lines.append(f'{n * SYNTHETIC_UNITS_PER_FILE + u},{mun_code},2026,1000,1,{matricule},"{lon}","{lat}"\n')
+            body.append("</RL>\n")
+            zf.writestr(f"RL{mun_code}_2026.xml", "".join(body))
+            csv_file.writelines(lines)
+    os.replace(csv_path + ".part", csv_path)
+    os.replace(zip_path + ".part", zip_path)
+    logger.info(f"Données synthétiques : {units} unités, {files} fichiers XML générés en {time.time() - t0:.1f}s")
+    return csv_path, zip_path
+
+
 def main():
     parser = argparse.ArgumentParser(description="Import évaluation foncière dans PostGIS")
     parser.add_argument("--dsn", default=os.environ.get("VIGIE_DB_DSN", DEFAULT_DSN),
@@ -314,44 +1890,126 @@ def main():
                         help="Ne pas télécharger, utiliser les fichiers existants")
     parser.add_argument("--csv-only", action="store_true",
                         help="Importer uniquement le CSV (coordonnées sans valeurs foncières)")
+    parser.add_argument("--loader", choices=("insert", "copy"), default="insert",
+                        help="Chargement : INSERT par lots (défaut) ou COPY FROM STDIN + staging")
+    parser.add_argument("--copy-format", choices=("text", "binary"), default="text",
+                        help="Format de COPY pour --loader copy (défaut: text)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Nombre de processus pour l'import XML (défaut: 1 ; >1 implique --loader copy)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Ne retraiter que les municipalités modifiées depuis le dernier import (XML)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Reprendre un import interrompu à partir de ses points de reprise")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Télécharger le ZIP en arrière-plan pendant le téléchargement et le parsing du CSV")
+    parser.add_argument("--report", metavar="FICHIER",
+                        help="Écrire les mesures de l'import (phases, débit, mémoire, lots) en JSON")
+    parser.add_argument("--synthetic", type=int, metavar="N",
+                        help="Banc d'essai : importer N unités factices générées localement, sans téléchargement")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Graine des données de --synthetic (défaut: 0)")
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error("--jobs doit être >= 1")
+    if args.incremental and (args.csv_only or args.jobs > 1):
+        parser.error("--incremental ne s'utilise ni avec --csv-only ni avec --jobs")
+    if args.incremental and args.resume:
+        parser.error("--incremental reprend déjà fichier par fichier, --resume est inutile")
+    if args.jobs > 1 and args.loader != "copy":
+        logger.info("--jobs > 1 : utilisation du chargeur COPY")
+        args.loader = "copy"
+    if args.synthetic is not None and args.synthetic < 1:
+        parser.error("--synthetic doit être >= 1")
+
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     t0 = time.time()
+    csv_path, zip_path = CSV_PATH, ZIP_PATH
 
     # Download
-    if not args.skip_download:
-        download_file(CSV_URL, CSV_PATH)
-        if not args.csv_only:
-            download_file(XML_URL, ZIP_PATH)
+    zip_download = None
+    if args.synthetic:
+        csv_path, zip_path = generate_synthetic_data(args.synthetic, args.seed)
+    elif not args.skip_download:
+        with _report.phase("download"):
+            if args.pipeline and not args.csv_only:
+                # Réseau (ZIP) et CPU (CSV) se recouvrent ; le ZIP n'est attendu qu'avant le parsing XML
+                downloader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                zip_download = downloader.submit(download_file, XML_URL, zip_path, False)
+                downloader.shutdown(wait=False)
+            download_file(CSV_URL, csv_path)
+            if not args.csv_only and zip_download is None:
+                download_file(XML_URL, zip_path)
     else:
-        if not os.path.exists(CSV_PATH):
-            logger.error(f"CSV introuvable : {CSV_PATH}")
+        if not os.path.exists(csv_path):
+            logger.error(f"CSV introuvable : {csv_path}")
             sys.exit(1)
-        if not args.csv_only and not os.path.exists(ZIP_PATH):
-            logger.error(f"ZIP introuvable : {ZIP_PATH}")
+        if not args.csv_only and not os.path.exists(zip_path):
+            logger.error(f"ZIP introuvable : {zip_path}")
             sys.exit(1)
 
-    # Import
+    # Import (mesures à partir d'ici : les données synthétiques ne comptent pas)
+    t_start = time.time()
+    t_import = t_start
     if args.csv_only:
-        count = parse_csv_only_and_insert(CSV_PATH, args.dsn)
+        if args.loader == "copy":
+            count = copy_csv_load(csv_path, args.dsn, args.copy_format, args.resume)
+        else:
+            count = parse_csv_only_and_insert(csv_path, args.dsn, args.resume)
     else:
-        coords = parse_csv_coordinates(CSV_PATH)
-        count = parse_xml_and_insert(ZIP_PATH, coords, args.dsn)
+        with _report.phase("csv_parse"):
+            coords = parse_csv_coordinates(csv_path)
+        if zip_download is not None:
+            if not zip_download.done():
+                logger.info("Attente de la fin du téléchargement du ZIP ...")
+            with _report.phase("download"):
+                zip_download.result()
+        t_import = time.time()
+        if args.incremental:
+            count = incremental_xml_load(zip_path, coords, args.dsn, args.copy_format)
+        elif args.jobs > 1:
+            count = parallel_xml_load(zip_path, coords, args.dsn, args.jobs, args.copy_format,
+                                      args.resume, csv_path=csv_path)
+        elif args.loader == "copy":
+            count = copy_xml_load(zip_path, coords, args.dsn, args.copy_format, args.resume, csv_path=csv_path)
+        else:
+            count = parse_xml_and_insert(zip_path, coords, args.dsn, args.resume, csv_path=csv_path)
+    mode = "incrémental" if args.incremental else args.loader
+    _log_rate(f"Chargement ({mode})", count, time.time() - t_import)
 
     elapsed = time.time() - t0
     logger.info(f"Import terminé : {count} lignes en {elapsed:.0f}s")
 
     # Verify
-    conn = psycopg2.connect(args.dsn)
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM property_assessments;")
-    total = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM property_assessments WHERE geom IS NOT NULL;")
-    with_geom = cur.fetchone()[0]
-    logger.info(f"Vérification : {total} lignes totales, {with_geom} avec géométrie")
-    cur.close()
-    conn.close()
+    with _report.phase("verify"):
+        conn = psycopg2.connect(args.dsn)
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM property_assessments;")
+        total = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM property_assessments WHERE geom IS NOT NULL;")
+        with_geom = cur.fetchone()[0]
+        logger.info(f"Vérification : {total} lignes totales, {with_geom} avec géométrie")
+        cur.close()
+        conn.close()
+
+    report = _report.to_dict(
+        count, time.time() - t_start,
+        mode="csv-only" if args.csv_only else "xml",
+        loader="incremental" if args.incremental else args.loader,
+        copy_format=args.copy_format,
+        jobs=args.jobs,
+        resume=args.resume,
+        pipeline=args.pipeline,
+        synthetic_units=args.synthetic,
+        total_rows=total,
+        rows_with_geom=with_geom,
+    )
+    logger.info("Phases : " + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in report["phases_s"].items()))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        logger.info(f"Rapport écrit dans {args.report}")
 
 
 if __name__ == "__main__":
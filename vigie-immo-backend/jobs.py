@@ -0,0 +1,275 @@
+"""
+jobs.py — File d'attente des analyses
+
+POST /api/analyze/jobs enregistre un job dans analysis_jobs et répond
+aussitôt ; GET /api/analyze/jobs/<id> en donne l'état puis le rapport. Les
+analyses sont exécutées hors du serveur web par `python3 jobs.py` (service
+vigie-immo-jobs), ANALYZE_JOB_THREADS à la fois par processus : chaque
+thread prend le plus ancien job en attente avec SELECT ... FOR UPDATE SKIP
+LOCKED, sans attendre les jobs déjà pris par d'autres. Plus de processus
+(sur cette machine ou une autre) = plus d'analyses simultanées.
+
+Un NOTIFY sur vigie_analysis_jobs réveille les workers à chaque nouveau
+job. Le rapport est enregistré dans l'historique dans la transaction qui
+termine le job. Un job resté 'running' plus de ANALYZE_JOB_TIMEOUT secondes
+(worker arrêté) est remis en file, au plus ANALYZE_JOB_MAX_ATTEMPTS
+exécutions au total. La maintenance purge aussi le cache des sections.
+"""
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import outbound
+from analysis import AnalysisError, analyze, purge_section_cache, risk_score_value
+from db import DB_DSN, get_pool
+from history import load_result, save_analysis
+
+ANALYZE_JOB_THREADS = int(os.environ.get('ANALYZE_JOB_THREADS', 4))          # par processus
+ANALYZE_JOB_MAX_PENDING = int(os.environ.get('ANALYZE_JOB_MAX_PENDING', 5))  # par utilisateur
+ANALYZE_JOB_TIMEOUT = int(os.environ.get('ANALYZE_JOB_TIMEOUT', 300))        # secondes
+ANALYZE_JOB_MAX_ATTEMPTS = 2
+# Attente totale des créneaux des API externes (voie batch) d'un job : le
+# reste de ANALYZE_JOB_TIMEOUT couvre les requêtes elles-mêmes
+ANALYZE_JOB_WAIT_BUDGET = ANALYZE_JOB_TIMEOUT / 2
+ANALYZE_JOB_RETENTION_DAYS = int(os.environ.get('ANALYZE_JOB_RETENTION_DAYS', 7))
+ANALYZE_JOB_POLL_INTERVAL = 5     # secondes, au cas où un NOTIFY serait manqué
+ANALYZE_JOB_MAINTENANCE_INTERVAL = 60
+JOBS_CHANNEL = 'vigie_analysis_jobs'
+_SUBMIT_LOCK = 0x5647_0002  # pg advisory lock (classe, user_id) de submit_job
+
+_SERVER_ERROR = {'error': 'Erreur serveur', 'message': "Une erreur s'est produite lors de l'analyse", 'status': 500}
+_INTERRUPTED = {'error': 'Analyse interrompue', 'message': "L'analyse n'a pas pu être menée à terme", 'status': 500}
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """L'utilisateur a déjà ANALYZE_JOB_MAX_PENDING jobs en attente ou en cours."""
+
+
+def submit_job(cur, user_id: int, address: str) -> int:
+    """Met une analyse en file (les workers sont notifiés au commit) ; retourne l'id du job."""
+    # Les soumissions d'un même utilisateur passent l'une après l'autre jusqu'au
+    # commit : deux requêtes simultanées ne peuvent pas dépasser la limite
+    cur.execute('SELECT pg_advisory_xact_lock(%s, %s)', (_SUBMIT_LOCK, user_id))
+    cur.execute(
+        "SELECT COUNT(*) FROM analysis_jobs WHERE user_id = %s AND status IN ('queued', 'running')",
+        (user_id,)
+    )
+    if cur.fetchone()[0] >= ANALYZE_JOB_MAX_PENDING:
+        raise JobQueueFull(f"{ANALYZE_JOB_MAX_PENDING} analyses déjà en attente")
+    cur.execute('INSERT INTO analysis_jobs (user_id, address) VALUES (%s, %s) RETURNING id', (user_id, address))
+    job_id = cur.fetchone()[0]
+    cur.execute('SELECT pg_notify(%s, %s)', (JOBS_CHANNEL, str(job_id)))
+    return job_id
+
+
+def get_job(cur, job_id: int, user_id: int):
+    """État d'un job de l'utilisateur (rang dans la file, rapport ou erreur) ; None s'il n'existe pas."""
+    cur.execute(
+        '''SELECT status, address, history_id, error, created_at, started_at, finished_at
+           FROM analysis_jobs WHERE id = %s AND user_id = %s''',
+        (job_id, user_id)
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    status, address, history_id, error, created_at, started_at, finished_at = row
+    job = {
+        'id': job_id,
+        'status': status,
+        'address': address,
+        'created_at': created_at.isoformat(),
+        'started_at': started_at.isoformat() if started_at else None,
+        'finished_at': finished_at.isoformat() if finished_at else None,
+    }
+    if status == 'queued':
+        cur.execute("SELECT COUNT(*) FROM analysis_jobs WHERE status = 'queued' AND id < %s", (job_id,))
+        job['position'] = cur.fetchone()[0] + 1
+    elif status == 'done':
+        cur.execute('SELECT result_json, result_sections FROM analysis_history WHERE id = %s', (history_id,))
+        stored = cur.fetchone()
+        job['history_id'] = history_id
+        job['result'] = load_result(cur, *stored) if stored else None
+    elif status == 'failed':
+        job['error'] = error
+    return job
+
+
+def claim_job(cur, worker: str):
+    """Prend le plus ancien job en attente ; (id, user_id, address) ou None si la file est vide."""
+    cur.execute(
+        '''UPDATE analysis_jobs
+           SET status = 'running', attempts = attempts + 1, worker = %s, started_at = NOW()
+           WHERE id = (SELECT id FROM analysis_jobs
+                       WHERE status = 'queued'
+                       ORDER BY id
+                       LIMIT 1
+                       FOR UPDATE SKIP LOCKED)
+           RETURNING id, user_id, address''',
+        (worker,)
+    )
+    return cur.fetchone()
+
+
+def _finish_job(cur, job_id: int, worker: str, history_id=None, error=None) -> bool:
+    """Termine un job encore détenu par `worker` ; False s'il a été repris entre-temps."""
+    cur.execute(
+        '''UPDATE analysis_jobs
+           SET status = %s, history_id = %s, error = %s, finished_at = NOW()
+           WHERE id = %s AND status = 'running' AND worker = %s''',
+        ('failed' if error else 'done', history_id, json.dumps(error) if error else None, job_id, worker)
+    )
+    return cur.rowcount == 1
+
+
+def run_job(job_id: int, user_id: int, address: str, worker: str) -> None:
+    """Exécute l'analyse d'un job pris par claim_job et enregistre son issue."""
+    t0 = time.monotonic()
+    error = None
+    try:
+        with outbound.lane('batch', deadline=t0 + ANALYZE_JOB_WAIT_BUDGET):
+            result = analyze(address)
+    except AnalysisError as e:
+        error = {'error': e.error, 'message': e.message, 'status': e.status}
+    except Exception as e:
+        logger.error(f"💥 Job {job_id} : {e}", exc_info=True)
+        error = _SERVER_ERROR
+
+    with get_pool().connection() as conn, conn, conn.cursor() as cur:
+        history_id = None
+        if error is None:
+            history_id = save_analysis(cur, user_id, result['address']['formatted'],
+                                       risk_score_value(result), result)
+        if not _finish_job(cur, job_id, worker, history_id, error):
+            # Remis en file (délai dépassé) et repris ailleurs : ce résultat est abandonné
+            conn.rollback()
+            logger.warning(f"Job {job_id} repris par un autre worker, résultat ignoré")
+            return
+    logger.info(f"Job {job_id} {'échoué' if error else 'terminé'} en {time.monotonic() - t0:.1f}s")
+
+
+def maintain_jobs(cur) -> tuple:
+    """
+    Remet en file les jobs 'running' depuis plus de ANALYZE_JOB_TIMEOUT
+    secondes (échec après ANALYZE_JOB_MAX_ATTEMPTS) et supprime les jobs
+    terminés depuis plus de ANALYZE_JOB_RETENTION_DAYS jours.
+    Retourne (remis en file, abandonnés, supprimés).
+    """
+    cur.execute(
+        '''UPDATE analysis_jobs
+           SET status = CASE WHEN attempts >= %(max)s THEN 'failed' ELSE 'queued' END,
+               error = CASE WHEN attempts >= %(max)s THEN %(error)s::jsonb END,
+               finished_at = CASE WHEN attempts >= %(max)s THEN NOW() END,
+               worker = NULL
+           WHERE status = 'running' AND started_at < NOW() - make_interval(secs => %(timeout)s)
+           RETURNING status''',
+        {'max': ANALYZE_JOB_MAX_ATTEMPTS, 'error': json.dumps(_INTERRUPTED), 'timeout': ANALYZE_JOB_TIMEOUT}
+    )
+    statuses = [row[0] for row in cur.fetchall()]
+    requeued = statuses.count('queued')
+    if requeued:
+        cur.execute('SELECT pg_notify(%s, %s)', (JOBS_CHANNEL, ''))
+    cur.execute(
+        'DELETE FROM analysis_jobs WHERE finished_at < NOW() - make_interval(days => %s)',
+        (ANALYZE_JOB_RETENTION_DAYS,)
+    )
+    purged = cur.rowcount
+    if statuses or purged:
+        logger.info(f"Jobs : {requeued} remis en file, {len(statuses) - requeued} abandonnés, {purged} supprimés")
+    return requeued, len(statuses) - requeued, purged
+
+
+class JobWorker:
+    """Processus d'exécution des jobs : `threads` threads d'exécution, un thread LISTEN."""
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self._stop = threading.Event()
+        self._wake = threading.Condition()
+        self._name = f'{socket.gethostname()}:{os.getpid()}'
+
+    def stop(self, *_):
+        self._stop.set()
+        with self._wake:
+            self._wake.notify_all()
+
+    def _listen(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(DB_DSN)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN {JOBS_CHANNEL}')
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], ANALYZE_JOB_POLL_INTERVAL) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        with self._wake:
+                            self._wake.notify_all()
+            except psycopg2.Error as e:
+                logger.warning(f"Écoute de {JOBS_CHANNEL} interrompue : {e}")
+                self._stop.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _work(self, index: int):
+        worker = f'{self._name}:{index}'
+        while not self._stop.is_set():
+            try:
+                with get_pool().connection() as conn, conn, conn.cursor() as cur:
+                    job = claim_job(cur, worker)
+            except psycopg2.Error as e:
+                logger.warning(f"Prise de job impossible : {e}")
+                self._stop.wait(ANALYZE_JOB_POLL_INTERVAL)
+                continue
+            if job is None:
+                with self._wake:
+                    self._wake.wait(ANALYZE_JOB_POLL_INTERVAL)
+                continue
+            try:
+                run_job(*job, worker)
+            except psycopg2.Error as e:
+                # Le job reste 'running' : maintain_jobs le remettra en file
+                logger.error(f"Job {job[0]} non enregistré : {e}")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        threading.Thread(target=self._listen, name='jobs-listener', daemon=True).start()
+        workers = [threading.Thread(target=self._work, args=(i,), name=f'jobs-{i}')
+                   for i in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        logger.info(f"Worker {self._name} : {self.threads} analyses simultanées")
+        while not self._stop.is_set():
+            try:
+                with get_pool().connection() as conn, conn, conn.cursor() as cur:
+                    maintain_jobs(cur)
+                    purge_section_cache(cur)
+            except psycopg2.Error as e:
+                logger.warning(f"Maintenance des jobs impossible : {e}")
+            self._stop.wait(ANALYZE_JOB_MAINTENANCE_INTERVAL)
+        # Terminer les analyses en cours avant de sortir
+        for thread in workers:
+            thread.join()
+        logger.info(f"Worker {self._name} arrêté")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    JobWorker(ANALYZE_JOB_THREADS).run()
@@ -23,7 +23,7 @@ CREATE TABLE IF NOT EXISTS analysis_history (
     created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
-CREATE INDEX IF NOT EXISTS idx_analysis_history_user ON analysis_history(user_id);
+-- Index par utilisateur : idx_analysis_history_user_created (migration 003)
 
 -- Table de blacklist des refresh tokens (pour logout)
 CREATE TABLE IF NOT EXISTS token_blacklist (
@@ -0,0 +1,18 @@
+-- Migration 002: Stockage dédupliqué des résultats d'analyse
+-- Vigie-Immo
+
+-- Sections de rapport (flood_zones, contamination, ...) stockées une seule
+-- fois, identifiées par le SHA-256 de leur JSON canonique
+CREATE TABLE IF NOT EXISTS analysis_result_sections (
+    hash       BYTEA PRIMARY KEY,
+    data       BYTEA NOT NULL,      -- JSON compressé (zlib)
+    raw_size   INTEGER NOT NULL,    -- taille du JSON décompressé
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Déjà compressé : stockage hors ligne sans recompression TOAST
+ALTER TABLE analysis_result_sections ALTER COLUMN data SET STORAGE EXTERNAL;
+
+-- {section: empreinte hexadécimale} ; result_json reste rempli pour les
+-- analyses antérieures à cette migration
+ALTER TABLE analysis_history ADD COLUMN IF NOT EXISTS result_sections JSONB;
@@ -0,0 +1,94 @@
+-- Migration 003: Historique des analyses partitionné par mois
+-- Vigie-Immo
+
+-- Partitions mensuelles (UTC) analysis_history_AAAA_MM de first_month à last_month
+CREATE OR REPLACE FUNCTION analysis_history_create_partitions(first_month DATE, last_month DATE)
+RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    month   DATE := date_trunc('month', first_month);
+    created INTEGER := 0;
+    name    TEXT;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('analysis_history_partitions'));
+    WHILE month <= last_month LOOP
+        name := 'analysis_history_' || to_char(month, 'YYYY_MM');
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'analysis_history'::regclass AND c.relname = name
+        ) THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF analysis_history FOR VALUES FROM (%L) TO (%L)',
+                name, month || ' 00:00:00+00', (month + INTERVAL '1 month')::date || ' 00:00:00+00'
+            );
+            created := created + 1;
+        END IF;
+        month := month + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END $$;
+
+-- Rétention : supprime les partitions entièrement antérieures aux keep_months
+-- derniers mois (mois courant compris)
+CREATE OR REPLACE FUNCTION analysis_history_drop_partitions(keep_months INTEGER)
+RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    cutoff  DATE := date_trunc('month', NOW() AT TIME ZONE 'UTC') - (keep_months - 1) * INTERVAL '1 month';
+    dropped INTEGER := 0;
+    part    TEXT;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('analysis_history_partitions'));
+    FOR part IN
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'analysis_history'::regclass
+          AND c.relname ~ '^analysis_history_\d{4}_\d{2}$'
+          AND to_date(substring(c.relname FROM 18), 'YYYY_MM') < cutoff
+    LOOP
+        EXECUTE format('DROP TABLE %I', part);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END $$;
+
+-- Conversion de la table existante (une seule fois)
+DO $$
+DECLARE
+    first_month DATE;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'analysis_history'::regclass) <> 'r' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE analysis_history RENAME TO analysis_history_unpartitioned;
+    ALTER TABLE analysis_history_unpartitioned RENAME CONSTRAINT analysis_history_pkey TO analysis_history_unpartitioned_pkey;
+
+    CREATE TABLE analysis_history (
+        id              INTEGER NOT NULL DEFAULT nextval('analysis_history_id_seq'),
+        user_id         INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        address         VARCHAR(500) NOT NULL,
+        risk_score      INTEGER,
+        result_json     JSONB,
+        result_sections JSONB,
+        created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    ALTER SEQUENCE analysis_history_id_seq OWNED BY analysis_history.id;
+
+    SELECT date_trunc('month', MIN(created_at) AT TIME ZONE 'UTC') INTO first_month
+    FROM analysis_history_unpartitioned;
+    PERFORM analysis_history_create_partitions(
+        COALESCE(first_month, (NOW() AT TIME ZONE 'UTC')::date),
+        ((NOW() AT TIME ZONE 'UTC') + INTERVAL '1 month')::date
+    );
+
+    INSERT INTO analysis_history (id, user_id, address, risk_score, result_json, result_sections, created_at)
+    SELECT id, user_id, address, risk_score, result_json, result_sections, created_at
+    FROM analysis_history_unpartitioned;
+    DROP TABLE analysis_history_unpartitioned;
+END $$;
+
+-- Historique d'un utilisateur, du plus récent au plus ancien (pagination par curseur)
+CREATE INDEX IF NOT EXISTS idx_analysis_history_user_created
+    ON analysis_history (user_id, created_at DESC, id DESC);
+
+-- Remplacé par idx_analysis_history_user_created (bases créées avant cette migration)
+DROP INDEX IF EXISTS idx_analysis_history_user;
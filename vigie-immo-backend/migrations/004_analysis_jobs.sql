@@ -0,0 +1,24 @@
+-- Migration 004: File d'attente des analyses (jobs)
+-- Vigie-Immo
+
+CREATE TABLE IF NOT EXISTS analysis_jobs (
+    id          BIGSERIAL PRIMARY KEY,
+    user_id     INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    address     VARCHAR(500) NOT NULL,
+    status      VARCHAR(20) NOT NULL DEFAULT 'queued',  -- queued, running, done, failed
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    worker      VARCHAR(100),                           -- hôte:pid du worker qui l'exécute
+    history_id  INTEGER,                                -- analysis_history.id du rapport (done)
+    error       JSONB,                                  -- {error, message, status} (failed)
+    created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    started_at  TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+
+-- Prise du prochain job (FOR UPDATE SKIP LOCKED) et rang dans la file
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_queued ON analysis_jobs (id) WHERE status = 'queued';
+-- Jobs abandonnés par un worker arrêté
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_running ON analysis_jobs (started_at) WHERE status = 'running';
+-- Jobs en cours d'un utilisateur, purge des jobs terminés
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_user ON analysis_jobs (user_id, status);
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_finished ON analysis_jobs (finished_at) WHERE finished_at IS NOT NULL;
@@ -0,0 +1,10 @@
+-- Migration 005: Seaux à jetons des API externes (outbound.py)
+-- Vigie-Immo
+
+-- Heure théorique d'arrivée (GCRA) du prochain appel par hôte, partagée par
+-- tous les processus. État éphémère : UNLOGGED, perdu sans conséquence
+-- après un arrêt brutal de PostgreSQL
+CREATE UNLOGGED TABLE IF NOT EXISTS outbound_buckets (
+    host VARCHAR(255) PRIMARY KEY,
+    tat  TIMESTAMPTZ NOT NULL
+);
@@ -0,0 +1,17 @@
+-- Migration 006: Cache partagé des sections d'analyse
+-- Vigie-Immo
+--
+-- Dernière valeur de chaque section par emplacement, écrite dès qu'une source
+-- répond (même après que la requête qui l'attendait a répondu sans elle).
+-- UNLOGGED : perdu en cas d'arrêt brutal de PostgreSQL, ce n'est qu'un cache.
+
+CREATE UNLOGGED TABLE IF NOT EXISTS section_cache (
+    section    VARCHAR(50) NOT NULL,
+    location   VARCHAR(600) NOT NULL,   -- coordonnées arrondies (+ adresse saisie selon la section)
+    data       BYTEA NOT NULL,          -- JSON compressé (zlib)
+    fetched_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (section, location)
+);
+
+-- Purge des entrées périmées
+CREATE INDEX IF NOT EXISTS idx_section_cache_fetched ON section_cache (fetched_at);
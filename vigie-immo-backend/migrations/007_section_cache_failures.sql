@@ -0,0 +1,10 @@
+-- Migration 007: Échecs des sources dans le cache des sections
+-- Vigie-Immo
+--
+-- Une section calculée pendant une panne de sa source est mise en cache comme
+-- repli (degraded) ; failed_at date le dernier échec, pendant lequel la source
+-- n'est plus interrogée pour cet emplacement. Un échec sur une entrée valide
+-- ne la remplace pas : seul failed_at est mis à jour.
+
+ALTER TABLE section_cache ADD COLUMN IF NOT EXISTS degraded BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE section_cache ADD COLUMN IF NOT EXISTS failed_at TIMESTAMPTZ;
@@ -0,0 +1,8 @@
+-- Migration 008: Sections rafraîchies d'une analyse passée
+-- Vigie-Immo
+--
+-- GET /api/history/<id>?refresh=1 enregistre les sections recalculées dans
+-- result_sections ; {section: date ISO du recalcul} sert ensuite à dater ces
+-- sections à la place de created_at.
+
+ALTER TABLE analysis_history ADD COLUMN IF NOT EXISTS sections_refreshed_at JSONB;
@@ -0,0 +1,347 @@
+"""
+outbound.py — Ordonnancement des appels aux API externes
+
+Chaque hôte externe (Nominatim, Overpass, NRCan, donnees.montreal.ca, ...)
+a un débit (requêtes/s) et une rafale autorisés (UPSTREAM_LIMITS,
+OUTBOUND_LIMITS pour les modifier). Avant chaque requête, get()/post()
+réservent un créneau dans le seau à jetons de l'hôte, tenu dans PostgreSQL
+(outbound_buckets, migration 005) pour être partagé par tous les workers
+gunicorn et les processus de jobs : un UPDATE atomique avance l'heure
+théorique d'arrivée (GCRA) et retourne l'attente avant le créneau.
+
+Deux voies de priorité :
+- interactive (défaut, POST /api/analyze) : réserve le prochain créneau
+  libre, au plus OUTBOUND_MAX_WAIT secondes plus tard, UpstreamBusy au-delà ;
+- batch (jobs, `with lane('batch')`) : ne prend un créneau que si le seau
+  est au moins à moitié plein, sinon attend et réessaie ; les rafales
+  restent disponibles pour les analyses interactives. L'attente est bornée
+  par appel (OUTBOUND_BATCH_MAX_WAIT) et pour tout le bloc par l'échéance
+  de lane('batch', deadline=...) : un job cesse d'attendre avant
+  ANALYZE_JOB_TIMEOUT au lieu d'être remis en file pendant qu'il attend.
+
+Une réponse 429/503 d'un hôte repousse ses créneaux de son Retry-After.
+Si la base est indisponible, un seau local au processus prend le relais.
+Après OUTBOUND_FAILURE_THRESHOLD échecs consécutifs (connexion, délai
+dépassé, erreur 5xx), un hôte est tenu pour hors service pendant
+OUTBOUND_NEGATIVE_TTL secondes : ses appels lèvent aussitôt
+UpstreamUnavailable, pour tous les emplacements, au lieu d'attendre chacun
+leur délai d'expiration. L'appel suivant ce délai sert d'essai.
+
+Le délai d'expiration de chaque source suit ses latences récentes : p99
+des OUTBOUND_LATENCY_WINDOW dernières réponses × OUTBOUND_TIMEOUT_FACTOR,
+borné par OUTBOUND_TIMEOUT_MIN/MAX. La source est le nom logique passé par
+l'appelant (source='crime_mtl' : deux requêtes SQL au même point d'accès
+CKAN n'ont pas la même latence) sur l'hôte interrogé, à défaut hôte +
+chemin. Le timeout passé par l'appelant ne sert qu'en l'absence de mesures
+suffisantes. Une expiration compte comme une réponse à la durée du délai,
+ce qui relève le p99 d'une source devenue lente au lieu de la couper
+indéfiniment. Comme pour requests, le délai borne la connexion puis chaque
+lecture du socket, pas la durée totale de l'appel : une réponse qui arrive
+goutte à goutte peut le dépasser.
+"""
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import psycopg2
+import requests
+
+from db import get_pool
+
+# hôte → (requêtes par seconde, rafale)
+UPSTREAM_LIMITS = {
+    'nominatim.openstreetmap.org': (1.0, 1),   # politique d'usage : 1 req/s au plus
+    'overpass-api.de': (0.5, 2),                # créneaux par IP
+    'overpass.kumi.systems': (0.5, 2),
+    'www.earthquakescanada.nrcan.gc.ca': (2.0, 4),
+    'donnees.montreal.ca': (5.0, 10),
+}
+DEFAULT_LIMIT = (5.0, 10)
+# OUTBOUND_LIMITS="nominatim.openstreetmap.org=1/1,donnees.montreal.ca=2/4"
+for _item in filter(None, os.environ.get('OUTBOUND_LIMITS', '').split(',')):
+    _host, _, _limit = _item.partition('=')
+    _rate, _, _burst = _limit.partition('/')
+    UPSTREAM_LIMITS[_host.strip()] = (float(_rate), int(_burst or 1))
+
+OUTBOUND_MAX_WAIT = float(os.environ.get('OUTBOUND_MAX_WAIT', 10))    # secondes (voie interactive)
+OUTBOUND_BATCH_MAX_WAIT = 120                                          # secondes (voie batch)
+OUTBOUND_DEFAULT_PENALTY = 10                                          # secondes, 429/503 sans Retry-After
+OUTBOUND_MAX_PENALTY = 300                                             # Retry-After retenu au plus (s)
+OUTBOUND_TIMEOUT_FACTOR = float(os.environ.get('OUTBOUND_TIMEOUT_FACTOR', 3))   # × p99
+OUTBOUND_TIMEOUT_MIN = float(os.environ.get('OUTBOUND_TIMEOUT_MIN', 2))         # secondes
+OUTBOUND_TIMEOUT_MAX = float(os.environ.get('OUTBOUND_TIMEOUT_MAX', 30))        # secondes
+OUTBOUND_LATENCY_WINDOW = 200        # dernières réponses retenues par source
+OUTBOUND_LATENCY_MIN_SAMPLES = 20    # en deçà, timeout de l'appelant
+OUTBOUND_FAILURE_THRESHOLD = int(os.environ.get('OUTBOUND_FAILURE_THRESHOLD', 3))   # échecs consécutifs
+OUTBOUND_NEGATIVE_TTL = float(os.environ.get('OUTBOUND_NEGATIVE_TTL', 30))          # secondes hors service
+
+logger = logging.getLogger(__name__)
+
+_lane = contextvars.ContextVar('outbound_lane', default='interactive')
+_lane_deadline = contextvars.ContextVar('outbound_lane_deadline', default=None)
+
+
+class UpstreamBusy(requests.RequestException):
+    """Pas de créneau libre pour cet hôte dans le délai d'attente de la voie."""
+
+
+class UpstreamUnavailable(requests.RequestException):
+    """Hôte tenu pour hors service après des échecs consécutifs (OUTBOUND_NEGATIVE_TTL)."""
+
+
+def current_lane() -> str:
+    """Voie de priorité des appels faits dans le contexte courant."""
+    return _lane.get()
+
+
+@contextmanager
+def lane(name: str, deadline: float = None):
+    """
+    with lane('batch'): ... — voie de priorité des appels faits dans le bloc.
+    `deadline` (time.monotonic()) : au-delà, les appels batch du bloc
+    n'attendent plus de créneau (UpstreamBusy si le seau n'en a pas).
+    """
+    token = _lane.set(name)
+    deadline_token = _lane_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _lane_deadline.reset(deadline_token)
+        _lane.reset(token)
+
+
+_RESERVE_SQL = '''
+WITH t AS (SELECT clock_timestamp() AS now)
+INSERT INTO outbound_buckets AS b (host, tat)
+SELECT %(host)s, t.now + make_interval(secs => %(interval)s) FROM t
+ON CONFLICT (host) DO UPDATE
+SET tat = GREATEST(b.tat, EXCLUDED.tat - make_interval(secs => %(interval)s)) + make_interval(secs => %(interval)s)
+WHERE b.tat - (SELECT now FROM t) <= make_interval(secs => %(limit)s)
+RETURNING EXTRACT(EPOCH FROM b.tat - (SELECT now FROM t))::float8 - %(interval)s - %(tolerance)s
+'''
+
+_PENALIZE_SQL = '''
+INSERT INTO outbound_buckets AS b (host, tat)
+VALUES (%(host)s, clock_timestamp() + make_interval(secs => %(delay)s))
+ON CONFLICT (host) DO UPDATE SET tat = GREATEST(b.tat, EXCLUDED.tat)
+'''
+
+_local_tat = {}           # hôte → heure théorique d'arrivée (time.monotonic), seau de secours
+_local_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {}               # (hôte, voie) → compteurs
+_latency = {}             # source → deque des durées des dernières réponses (s)
+_latency_lock = threading.Lock()
+_health = {}              # hôte → [échecs consécutifs, hors service jusqu'à (time.monotonic)]
+_health_lock = threading.Lock()
+
+
+def _reserve_local(host: str, interval: float, tolerance: float, limit: float):
+    with _local_lock:
+        now = time.monotonic()
+        tat = _local_tat.get(host, now)
+        if tat - now > limit:
+            return None
+        tat = max(tat, now) + interval
+        _local_tat[host] = tat
+        return tat - now - interval - tolerance
+
+
+def _reserve(host: str, interval: float, tolerance: float, limit: float):
+    """Réserve un créneau ; attente en secondes (≤ 0 : immédiat), None si aucun dans `limit`."""
+    params = {'host': host, 'interval': interval, 'tolerance': tolerance, 'limit': limit}
+    try:
+        with get_pool().connection() as conn, conn, conn.cursor() as cur:
+            cur.execute(_RESERVE_SQL, params)
+            row = cur.fetchone()
+        return row[0] if row else None
+    except psycopg2.Error as e:
+        logger.warning(f"Seau partagé de {host} indisponible, seau local utilisé : {e}")
+        return _reserve_local(host, interval, tolerance, limit)
+
+
+def _penalize(host: str, delay: float) -> None:
+    """Aucun créneau pour `host` avant `delay` secondes (réponse 429/503 de l'hôte)."""
+    rate, burst = UPSTREAM_LIMITS.get(host, DEFAULT_LIMIT)
+    delay += (burst - 1) / rate   # rafale comprise
+    with _local_lock:
+        _local_tat[host] = max(_local_tat.get(host, 0), time.monotonic() + delay)
+    try:
+        with get_pool().connection() as conn, conn, conn.cursor() as cur:
+            cur.execute(_PENALIZE_SQL, {'host': host, 'delay': delay})
+    except psycopg2.Error as e:
+        logger.warning(f"Pénalité de {host} non partagée : {e}")
+
+
+def _check_available(host: str) -> None:
+    with _health_lock:
+        down_until = _health.get(host, (0, 0.0))[1]
+    if time.monotonic() < down_until:
+        _record(host, _lane.get(), unavailable=1)
+        raise UpstreamUnavailable(f"{host} hors service encore {down_until - time.monotonic():.0f}s")
+
+
+def _report(host: str, failed: bool) -> None:
+    """Note l'issue d'un appel ; l'hôte est mis hors service au seuil d'échecs consécutifs."""
+    with _health_lock:
+        if not failed:
+            _health.pop(host, None)
+            return
+        health = _health.setdefault(host, [0, 0.0])
+        health[0] += 1
+        if health[0] < OUTBOUND_FAILURE_THRESHOLD:
+            return
+        health[1] = time.monotonic() + OUTBOUND_NEGATIVE_TTL
+        failures = health[0]
+    logger.warning(f"{host} hors service pour {OUTBOUND_NEGATIVE_TTL:.0f}s après {failures} échecs consécutifs")
+
+
+def _record(host: str, lane_name: str, **counts) -> None:
+    with _stats_lock:
+        stats = _stats.setdefault((host, lane_name), {
+            'requests': 0, 'busy': 0, 'throttled': 0, 'unavailable': 0,
+            'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+        })
+        for key, value in counts.items():
+            if key == 'max_wait_seconds':
+                stats[key] = max(stats[key], value)
+            else:
+                stats[key] += value
+
+
+def acquire(host: str) -> float:
+    """Attend le créneau de `host` dans la voie courante ; retourne l'attente (s), UpstreamBusy si trop longue."""
+    lane_name = _lane.get()
+    rate, burst = UPSTREAM_LIMITS.get(host, DEFAULT_LIMIT)
+    interval = 1.0 / rate
+    tolerance = (burst - 1) * interval
+    t0 = time.monotonic()
+    if lane_name == 'batch':
+        # Seulement si le seau est au moins à moitié plein ; sinon céder la place
+        deadline = t0 + OUTBOUND_BATCH_MAX_WAIT
+        if _lane_deadline.get() is not None:
+            deadline = min(deadline, _lane_deadline.get())
+        while True:
+            wait = _reserve(host, interval, tolerance, tolerance / 2)
+            if wait is not None:
+                break
+            if time.monotonic() >= deadline:
+                _record(host, lane_name, busy=1)
+                raise UpstreamBusy(f"{host} : aucun créneau batch après {time.monotonic() - t0:.0f}s")
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+    else:
+        wait = _reserve(host, interval, tolerance, tolerance + OUTBOUND_MAX_WAIT)
+        if wait is None:
+            _record(host, lane_name, busy=1)
+            raise UpstreamBusy(f"{host} : aucun créneau dans les {OUTBOUND_MAX_WAIT:.0f}s")
+    if wait > 0:
+        time.sleep(wait)
+    waited = time.monotonic() - t0
+    _record(host, lane_name, requests=1, wait_seconds=waited, max_wait_seconds=waited)
+    return waited
+
+
+def _percentile(samples: list, q: float) -> float:
+    """Percentile (rang le plus proche) d'une liste triée non vide."""
+    return samples[max(0, math.ceil(q * len(samples)) - 1)]
+
+
+def _observe(source: str, seconds: float) -> None:
+    with _latency_lock:
+        window = _latency.get(source)
+        if window is None:
+            window = _latency[source] = deque(maxlen=OUTBOUND_LATENCY_WINDOW)
+        window.append(seconds)
+
+
+def timeout_for(source: str, default: float) -> float:
+    """Délai d'expiration de `source` : p99 × facteur, borné ; `default` faute de mesures."""
+    with _latency_lock:
+        samples = sorted(_latency.get(source, ()))
+    if len(samples) < OUTBOUND_LATENCY_MIN_SAMPLES:
+        return default
+    return min(OUTBOUND_TIMEOUT_MAX, max(OUTBOUND_TIMEOUT_MIN, _percentile(samples, 0.99) * OUTBOUND_TIMEOUT_FACTOR))
+
+
+def request(method: str, url: str, timeout: float = OUTBOUND_TIMEOUT_MAX, source: str = None,
+            **kwargs) -> requests.Response:
+    """
+    requests.request() après réservation du créneau de l'hôte de `url`, avec
+    le délai d'expiration adapté à la source (`timeout` faute de mesures) ;
+    délai de connexion et de chaque lecture, pas de l'appel entier.
+    """
+    parts = urlsplit(url)
+    host = parts.hostname or ''
+    source = f'{host}:{source}' if source else f'{host}{parts.path}'
+    _check_available(host)
+    acquire(host)
+    timeout = timeout_for(source, timeout)
+    t0 = time.monotonic()
+    try:
+        response = requests.request(method, url, timeout=timeout, **kwargs)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        if isinstance(e, requests.Timeout):
+            _observe(source, timeout)
+        _report(host, failed=True)
+        raise
+    _observe(source, time.monotonic() - t0)
+    # 503 : l'hôte a demandé une pause (Retry-After), il n'est pas en panne
+    _report(host, failed=response.status_code >= 500 and response.status_code != 503)
+    if response.status_code in (429, 503):
+        try:
+            delay = float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            delay = 0   # date HTTP : délai par défaut
+        delay = min(delay or OUTBOUND_DEFAULT_PENALTY, OUTBOUND_MAX_PENALTY)
+        _record(host, _lane.get(), throttled=1)
+        logger.warning(f"{host} a limité la requête ({response.status_code}), pause de {delay:.0f}s")
+        _penalize(host, delay)
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+def stats() -> dict:
+    """Par hôte et par voie : requêtes, attente moyenne et maximale du créneau, refus, limitations, hôte hors service."""
+    with _stats_lock:
+        snapshot = {key: dict(value) for key, value in _stats.items()}
+    result = {}
+    for (host, lane_name), stats in sorted(snapshot.items()):
+        requests_count = stats['requests']
+        result.setdefault(host, {})[lane_name] = {
+            'requests': requests_count,
+            'busy': stats['busy'],
+            'throttled': stats['throttled'],
+            'unavailable': stats['unavailable'],
+            'avg_wait_ms': round(stats['wait_seconds'] / requests_count * 1000, 1) if requests_count else None,
+            'max_wait_ms': round(stats['max_wait_seconds'] * 1000, 1),
+        }
+    return result
+
+
+def latency_stats() -> dict:
+    """Par source : nombre de mesures, p50, p99 et délai d'expiration appliqué."""
+    with _latency_lock:
+        snapshot = {source: sorted(window) for source, window in _latency.items()}
+    return {
+        source: {
+            'samples': len(samples),
+            'p50_ms': round(_percentile(samples, 0.5) * 1000, 1),
+            'p99_ms': round(_percentile(samples, 0.99) * 1000, 1),
+            'timeout_s': round(timeout_for(source, OUTBOUND_TIMEOUT_MAX), 2)
+            if len(samples) >= OUTBOUND_LATENCY_MIN_SAMPLES else None,
+        }
+        for source, samples in sorted(snapshot.items())
+    }
@@ -0,0 +1,99 @@
+"""
+Fixtures communes des tests.
+
+Les tests qui ont besoin de PostgreSQL utilisent la base de VIGIE_TEST_DB_DSN
+(sautés sinon), chacun dans un schéma jetable placé en tête du search_path :
+les tables créées par le code testé (noms non qualifiés) y atterrissent.
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2  # noqa: E402
+
+
+@pytest.fixture
+def pg_dsn():
+    """DSN d'un schéma vide, supprimé après le test."""
+    dsn = os.environ.get('VIGIE_TEST_DB_DSN')
+    if not dsn:
+        pytest.skip('VIGIE_TEST_DB_DSN non défini')
+    schema = f'test_{uuid.uuid4().hex[:12]}'
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    admin.cursor().execute(f'CREATE SCHEMA {schema}')
+    try:
+        yield f"{dsn} options='-c search_path={schema},public'"
+    finally:
+        admin.cursor().execute(f'DROP SCHEMA {schema} CASCADE')
+        admin.close()
+
+
+@pytest.fixture
+def pg_conn(pg_dsn):
+    conn = psycopg2.connect(pg_dsn)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+# Fonctions PostGIS utilisées par l'import, si l'extension est absente de la base de test
+_POSTGIS_SHIMS = '''
+CREATE FUNCTION st_makepoint(float8, float8) RETURNS text
+    AS $$ SELECT 'POINT(' || $1 || ' ' || $2 || ')' $$ LANGUAGE sql IMMUTABLE;
+CREATE FUNCTION st_setsrid(text, int) RETURNS text AS $$ SELECT $1 $$ LANGUAGE sql IMMUTABLE;
+CREATE FUNCTION st_x(text) RETURNS float8
+    AS $$ SELECT split_part(split_part($1, '(', 2), ' ', 1)::float8 $$ LANGUAGE sql IMMUTABLE;
+CREATE FUNCTION st_y(text) RETURNS float8
+    AS $$ SELECT rtrim(split_part(split_part($1, '(', 2), ' ', 2), ')')::float8 $$ LANGUAGE sql IMMUTABLE;
+'''
+
+
+@pytest.fixture
+def assessments_conn(pg_conn):
+    """Connexion avec une table property_assessments vide, structurée comme en production."""
+    with pg_conn.cursor() as cur:
+        cur.execute("SELECT to_regtype('geometry') IS NOT NULL")
+        postgis = cur.fetchone()[0]
+        if not postgis:
+            cur.execute(_POSTGIS_SHIMS)
+        cur.execute(f'''
+            CREATE TABLE property_assessments (
+                id SERIAL PRIMARY KEY,
+                matricule VARCHAR(18),
+                civic_number VARCHAR(20),
+                street_name VARCHAR(255),
+                municipality VARCHAR(10),
+                land_value BIGINT,
+                building_value BIGINT,
+                total_value BIGINT,
+                year_built INTEGER,
+                lot_area_sqm NUMERIC,
+                building_area_sqm NUMERIC,
+                use_code VARCHAR(10),
+                geom {'geometry(Point, 4326)' if postgis else 'TEXT'}
+            );
+            CREATE INDEX idx_pa_matricule ON property_assessments (matricule);
+        ''')
+    pg_conn.commit()
+    return pg_conn
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+@pytest.fixture
+def app_conn(pg_conn):
+    """Connexion sur un schéma où toutes les migrations ont été appliquées, dans l'ordre."""
+    with pg_conn.cursor() as cur:
+        for name in sorted(os.listdir(MIGRATIONS_DIR)):
+            if name.endswith('.sql'):
+                with open(os.path.join(MIGRATIONS_DIR, name), encoding='utf-8') as f:
+                    cur.execute(f.read())
+    pg_conn.commit()
+    return pg_conn
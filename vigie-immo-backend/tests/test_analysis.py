@@ -0,0 +1,114 @@
+"""
+Cache des sections : une section n'est mise en cache comme repli (degraded)
+que si sa valeur en est un ; un rafraîchissement ne remplace pas une section
+stockée par un repli.
+"""
+import pytest
+import requests
+
+import analysis
+import data_fetcher
+import outbound
+from db import PoolTimeout
+
+# Montréal : les sources de la ville sont interrogées
+ADDRESS = {'latitude': 45.5017, 'longitude': -73.5673, 'input': '1 rue Test', 'municipality': 'Montréal'}
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    stored = {}
+    monkeypatch.setattr(analysis, '_store_section',
+                        lambda name, address, value, degraded: stored.update({name: (value, degraded)}))
+    return stored
+
+
+def _response(status_code, payload=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = requests.compat.json.dumps(payload or {}).encode('utf-8')
+    return response
+
+
+def test_pool_timeout_fallback_is_degraded(stored, monkeypatch):
+    def saturated():
+        raise PoolTimeout('pool saturé')
+
+    monkeypatch.setattr(data_fetcher, 'get_pool', saturated)
+    value, degraded = analysis._fetch_section('property_assessment', ADDRESS)
+    assert value['data_quality'] == 'Indisponible' and degraded
+    assert stored['property_assessment'] == (value, True)
+
+
+def test_failover_to_another_mirror_is_not_degraded(stored, monkeypatch):
+    elements = [{'lat': 45.502, 'lon': -73.567, 'tags': {'amenity': amenity, 'name': amenity}}
+                for amenity in ('fire_station', 'hospital', 'police')]
+    responses = iter([_response(429), _response(200, {'elements': elements})])
+    monkeypatch.setattr(outbound, 'post', lambda *args, **kwargs: next(responses))
+
+    value, degraded = analysis._fetch_section('services', ADDRESS)
+    assert value['data_quality'] == 'Haute' and not degraded
+    assert stored['services'] == (value, False)
+
+
+def test_all_mirrors_down_is_degraded(stored, monkeypatch):
+    def down(*args, **kwargs):
+        raise requests.ConnectionError('injoignable')
+
+    monkeypatch.setattr(outbound, 'post', down)
+    value, degraded = analysis._fetch_section('services', ADDRESS)
+    assert degraded and stored['services'] == (value, True)
+
+
+def test_static_data_outside_montreal_is_not_degraded(stored, monkeypatch):
+    def unexpected(*args, **kwargs):
+        raise AssertionError('aucun appel externe attendu')
+
+    monkeypatch.setattr(outbound, 'get', unexpected)
+    quebec = dict(ADDRESS, latitude=46.81, longitude=-71.21, municipality='Québec')
+    value, _ = analysis._fetch_section('crime', quebec)
+    assert stored['crime'] == (value, False)
+
+
+def test_inflight_shared_within_a_lane_only(monkeypatch):
+    release = analysis.threading.Event()
+    calls = []
+
+    def slow_fetch(name, address):
+        calls.append(outbound.current_lane())
+        release.wait(5)
+        return {'lane': outbound.current_lane()}
+
+    monkeypatch.setattr(analysis, '_fetch_section', slow_fetch)
+    try:
+        revalidation = analysis._submit_section('crime', ADDRESS, revalidate=True)
+        interactive = analysis._submit_section('crime', ADDRESS)
+        assert interactive is not revalidation   # pas d'attente derrière la voie batch
+        assert analysis._submit_section('crime', ADDRESS) is interactive
+    finally:
+        release.set()
+    assert revalidation.result(5) == {'lane': 'batch'}
+    assert interactive.result(5) == {'lane': 'interactive'}
+    assert sorted(calls) == ['batch', 'interactive']
+
+
+def test_refresh_keeps_stored_fallbacks_and_late_sections(stored, monkeypatch):
+    release = analysis.threading.Event()
+
+    def fallback(address):
+        data_fetcher._fell_back('repli', 'source indisponible')
+        return {'data_quality': 'Indisponible'}
+
+    monkeypatch.setattr(analysis, 'SECTION_FETCHERS', {
+        'air_quality': lambda address: {'aqi': 2},
+        'crime': fallback,
+        'seismic': lambda address: release.wait(5) and {'zone': 'C'},
+    })
+    result = {'address': ADDRESS, 'air_quality': {'aqi': 1}, 'crime': {'total': 3}, 'seismic': {'zone': 'B'}}
+    try:
+        refreshed = analysis.refresh_sections(result, ['air_quality', 'crime', 'seismic'],
+                                              analysis.time.monotonic() + 0.2)
+    finally:
+        release.set()
+    assert refreshed == ['air_quality']
+    assert result == {'address': ADDRESS, 'air_quality': {'aqi': 2}, 'crime': {'total': 3}, 'seismic': {'zone': 'B'}}
@@ -0,0 +1,73 @@
+"""
+Limites de bcrypt (BCRYPT_CONCURRENCY / BCRYPT_MAX_PENDING) réparties entre les
+workers gunicorn.
+"""
+import threading
+import time
+
+import pytest
+
+import auth
+
+
+@pytest.fixture
+def bcrypt_limits(monkeypatch):
+    monkeypatch.setattr(auth, 'BCRYPT_ROUNDS', 4)
+    monkeypatch.setattr(auth, '_bcrypt_stats', dict(auth._bcrypt_stats, pending=0, rejected=0))
+
+    def configure(concurrency, max_pending, workers):
+        monkeypatch.setattr(auth, 'BCRYPT_CONCURRENCY', concurrency)
+        monkeypatch.setattr(auth, 'BCRYPT_MAX_PENDING', max_pending)
+        auth.set_worker_count(workers)
+
+    yield configure
+    monkeypatch.undo()
+    auth.set_worker_count(1)
+
+
+def test_limits_split_between_workers(bcrypt_limits):
+    bcrypt_limits(concurrency=4, max_pending=16, workers=4)
+    stats = auth.password_pool_stats()
+    assert (stats['concurrency'], stats['max_pending']) == (1, 4)
+
+    bcrypt_limits(concurrency=3, max_pending=2, workers=4)
+    stats = auth.password_pool_stats()
+    assert (stats['concurrency'], stats['max_pending']) == (1, 1)
+
+
+def test_hash_and_verify(bcrypt_limits):
+    bcrypt_limits(concurrency=2, max_pending=4, workers=1)
+    password_hash = auth.hash_password('secret')
+    assert auth.verify_password('secret', password_hash)
+    assert not auth.verify_password('other', password_hash)
+    assert not auth.password_needs_rehash(password_hash)
+
+
+def test_busy_beyond_max_pending(bcrypt_limits, monkeypatch):
+    bcrypt_limits(concurrency=1, max_pending=2, workers=1)
+    release = threading.Event()
+
+    def slow_check(password, password_hash):
+        release.wait(5)
+        return True, 0.0
+
+    monkeypatch.setattr(auth, '_bcrypt_check', slow_check)
+    threads = [threading.Thread(target=auth.verify_password, args=('a', 'b')) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while auth.password_pool_stats()['pending'] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)   # l'un tourne, l'autre attend son tour
+    try:
+        with pytest.raises(auth.PasswordHasherBusy):
+            auth.verify_password('a', 'b')
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+    assert auth.password_pool_stats()['rejected'] == 1
+
+
+def test_unbounded(bcrypt_limits):
+    bcrypt_limits(concurrency=0, max_pending=0, workers=4)
+    assert auth.verify_password('secret', auth.hash_password('secret'))
@@ -0,0 +1,75 @@
+"""
+Analyse vectorisée du CSV des coordonnées (_iter_csv_batches) comparée à la
+lecture ligne à ligne par csv.reader qu'elle remplace.
+"""
+import csv
+
+import pytest
+
+import import_assessments as ia
+
+HEADER = 'id,code_mun,annee,code_utilisation,nb_logements,matricule,longitude,latitude\n'
+
+LINES = [
+    '1,66023,2026,1000,1,660230000100000000,"-73,567812","45,501234"\n',
+    '2,66023,2026,1000,1,660230000200000000,-73.5,45.5\n',
+    '3,66023,2026,"1000,2",1,660230000300000000,"-73,6","45,6"\n',        # virgule entre guillemets
+    '4,66023,2026,1000,1,660230000400000000,"","45,5"\n',                 # décimale vide
+    '5,66023,2026,1000,1,660230000500000000,,\n',
+    '6,66023,2026,1000,1,660230000100000000,"-73,1","45,1"\n',            # matricule en double
+    '7,66023,2026,1000,1,660230000700000000,"-12,0","45,0"\n',            # hors du Québec
+    '8,66023,2026,1000,1,660230000800000000\n',                           # ligne incomplète
+    '9,66023,2026,1000,1,660230000900000000," -73,25","45,25"\n',         # espace
+    '10,66023,2026,1000,1,660230001000000000,-7.35e1,4.5e1\n',            # exposants
+    '11,66023,2026,1000,1,660230001100000000,-73.123456789012345678901234,45.5\n',
+    '12,66023,2026,1000,1,6602300012,"-73,3","45,3"\n',                   # matricule court
+    '13,"66023",2026,1000,1,"660230001300000000","-73,4","45,4"\n',
+    '14,66023,2026,1000,1,660230001400000000,"-73,x","45,4"\n',
+    '15,66023,2026,1000,1,660230001500000000,"-73,5,1","45,4"\n',
+    '16,66023,2026,1000,1,660230001600000000,"+-73","45,4"\n',
+    '17,66023,2026,1000,1,660230001700000000,-73.,.5e2\n',
+    '18,66023,2026,1000,1,660230001800000000,"-73,9","45,9",extra\n',
+    '19,66023,2026,1000,1,660230000200000000,"-73,2","45,2"\r\n',         # CRLF, double de 2
+]
+ODD_QUOTES = '20,66023,2026,"a ""b""",1,660230002000000000,"-73,7","45,7"\n'  # repli csv.reader
+
+
+def _reference(path):
+    with open(path, encoding='utf-8') as f:
+        f.readline()
+        return [row for row in map(ia._csv_row_coordinates, csv.reader(f)) if row is not None]
+
+
+@pytest.fixture(params=[None, 61, 200], ids=['one-block', 'tiny-blocks', 'small-blocks'])
+def chunk_bytes(request, monkeypatch):
+    if request.param:
+        monkeypatch.setattr(ia, 'CSV_CHUNK_BYTES', request.param)
+
+
+@pytest.mark.parametrize('lines', [LINES, LINES + [ODD_QUOTES] + LINES[:3]], ids=['vectorized', 'fallback'])
+def test_points_match_csv_reader(lines, chunk_bytes, tmp_path, monkeypatch):
+    path = tmp_path / 'coords.csv'
+    path.write_text(HEADER + ''.join(lines), encoding='utf-8', newline='')
+    expected = _reference(path)
+    assert len(expected) > 10
+    if ODD_QUOTES not in lines:
+        # Aucun bloc ne doit passer par csv.reader
+        monkeypatch.setattr(ia.csv, 'reader', None)
+
+    assert list(ia.iter_csv_points(str(path))) == expected
+    assert list(ia.iter_csv_rows(str(path))) == [
+        (mat, None, None, mun) + (None,) * 7 + (lon, lat) for mat, mun, lon, lat in expected]
+
+
+def test_coordinate_index_keeps_last_duplicate(chunk_bytes, tmp_path):
+    path = tmp_path / 'coords.csv'
+    path.write_text(HEADER + ''.join(LINES), encoding='utf-8', newline='')
+    expected = {mat: (lon, lat) for mat, _, lon, lat in _reference(path)}
+
+    coords = ia.parse_csv_coordinates(str(path))
+    assert len(coords) == len(expected)
+    for mat, point in expected.items():
+        assert coords.get(mat) == point
+    assert coords.get('660230000100000000') == (-73.1, 45.1)
+    assert coords.get('660230000200000000') == (-73.2, 45.2)
+    assert coords.get('660230000400000000') is None
@@ -0,0 +1,162 @@
+"""
+Historique des analyses : partitions créées à l'insertion, maintenance
+(--maintain) et pagination par curseur de list_history.
+"""
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import pytest
+
+import history
+
+
+def _user(cur, email):
+    cur.execute(
+        "INSERT INTO users (email, name, password_hash) VALUES (%s, 'Test', 'x') RETURNING id",
+        (email,)
+    )
+    return cur.fetchone()[0]
+
+
+def _partitions(cur):
+    cur.execute(
+        '''SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'analysis_history'::regclass ORDER BY 1'''
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def _section_count(cur):
+    cur.execute('SELECT COUNT(*) FROM analysis_result_sections')
+    return cur.fetchone()[0]
+
+
+def test_insert_creates_only_its_partition(app_conn, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_RETENTION_MONTHS', 1)
+    created_at = datetime(2020, 3, 15, tzinfo=timezone.utc)
+    with app_conn, app_conn.cursor() as cur:
+        user_id = _user(cur, 'a@example.com')
+        before = _partitions(cur)
+        history.save_analyses(cur, [(user_id, '1 rue A', 10, {'address': {'q': 1}}, created_at)])
+        # Ni rétention ni autre mois : seulement la partition manquante
+        assert _partitions(cur) == sorted(before + ['analysis_history_2020_03'])
+
+
+def test_maintain_applies_retention_and_collects_orphans(app_conn, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_RETENTION_MONTHS', 2)
+    now = datetime.now(timezone.utc)
+    with app_conn, app_conn.cursor() as cur:
+        kept_user = _user(cur, 'kept@example.com')
+        gone_user = _user(cur, 'gone@example.com')
+        history.save_analyses(cur, [
+            (kept_user, 'ancienne', 1, {'flood_zones': 'old'}, datetime(2020, 1, 10, tzinfo=timezone.utc)),
+            (kept_user, 'récente', 2, {'flood_zones': 'shared', 'crime': 'kept'}, now),
+            (gone_user, 'supprimée', 3, {'flood_zones': 'shared', 'crime': 'gone'}, now),
+        ])
+        cur.execute('DELETE FROM users WHERE id = %s', (gone_user,))
+        assert _section_count(cur) == 4
+
+        created, dropped, collected = history.maintain_partitions(cur)
+
+        next_month = (now.replace(day=1) + timedelta(days=32)).strftime('analysis_history_%Y_%m')
+        assert next_month in _partitions(cur)
+        assert 'analysis_history_2020_01' not in _partitions(cur)
+        assert (dropped, collected) == (1, 2)   # 'old' et 'gone'
+        cur.execute('SELECT result_sections FROM analysis_history')
+        (result_sections,), = cur.fetchall()
+        assert history.load_result(cur, None, result_sections) == {'flood_zones': 'shared', 'crime': 'kept'}
+
+
+def test_collect_keeps_sections_referenced_during_scan(app_conn, pg_dsn):
+    now = datetime.now(timezone.utc)
+    with app_conn, app_conn.cursor() as cur:
+        user_id = _user(cur, 'c@example.com')
+        kept_id, gone_id = history.save_analyses(cur, [
+            (user_id, 'gardée', 1, {'crime': 'kept', 'air_quality': 'old'}, now),
+            (user_id, 'supprimée', 2, {'crime': 'inserted', 'air_quality': 'refreshed', 'seismic': 'gone'}, now),
+        ])
+        cur.execute('DELETE FROM analysis_history WHERE id = %s', (gone_id,))
+
+    class ConcurrentWrites:
+        """Curseur qui enregistre deux analyses juste après la recherche des orphelines."""
+        def __init__(self, cur):
+            self.cur = cur
+            self.connection = cur.connection
+
+        def execute(self, query, params=None):
+            self.cur.execute(query, params)
+            if 'CREATE TEMP TABLE' in query:
+                writer = psycopg2.connect(pg_dsn)
+                with writer, writer.cursor() as other:
+                    history.save_analyses(other, [(user_id, 'nouvelle', 3, {'crime': 'inserted'}, None)])
+                    history.save_refreshed_sections(other, kept_id, now, {'crime': 'kept', 'air_quality': 'refreshed'},
+                                                    ['air_quality'], now)
+                writer.close()
+
+        def __getattr__(self, name):
+            return getattr(self.cur, name)
+
+    with app_conn, app_conn.cursor() as cur:
+        assert history.collect_sections(ConcurrentWrites(cur)) == 1   # 'gone'
+        cur.execute('SELECT result_sections FROM analysis_history ORDER BY id')
+        assert [history.load_result(cur, None, sections) for sections, in cur.fetchall()] == [
+            {'crime': 'kept', 'air_quality': 'refreshed'}, {'crime': 'inserted'}]
+        # Encore référencée lors de la recherche : supprimée au passage suivant
+        assert history.collect_sections(cur) == 1   # 'old'
+        assert _section_count(cur) == 3
+
+
+def test_list_history_keyset_pages(app_conn):
+    created_at = datetime.now(timezone.utc).replace(microsecond=0)
+    with app_conn, app_conn.cursor() as cur:
+        user_id = _user(cur, 'p@example.com')
+        other_id = _user(cur, 'o@example.com')
+        # Trois analyses à la même seconde : l'id départage
+        ids = history.save_analyses(cur, [
+            (user_id, f'adresse {n}', n, {'n': n}, created_at - timedelta(minutes=n // 3))
+            for n in range(7)
+        ])
+        history.save_analyses(cur, [(other_id, 'autre', 0, {'n': 0}, created_at)])
+
+        pages, cursor = [], None
+        while True:
+            rows, cursor = history.list_history(cur, user_id, 3, cursor)
+            pages.append([row[0] for row in rows])
+            if cursor is None:
+                break
+        expected = [row_id for _, row_id in sorted(
+            ((created_at - timedelta(minutes=n // 3), row_id) for n, row_id in enumerate(ids)),
+            reverse=True)]
+        assert pages == [expected[:3], expected[3:6], expected[6:]]
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    assert history.decode_cursor(history.encode_cursor(created_at, 42)) == (created_at, 42)
+    with pytest.raises(ValueError):
+        history.decode_cursor('pas-un-curseur')
+
+
+def test_refreshed_sections_are_saved(app_conn):
+    created_at = datetime.now(timezone.utc) - timedelta(days=2)
+    now = datetime.now(timezone.utc)
+    with app_conn, app_conn.cursor() as cur:
+        user_id = _user(cur, 'r@example.com')
+        result = {'address': {'q': 'x'}, 'air_quality': {'aqi': 1}, 'seismic': {'zone': 'B'}}
+        history_id, = history.save_analyses(cur, [(user_id, 'x', 1, result, created_at)])
+        assert history.stale_sections(result, created_at, now) == ['air_quality']
+
+        result['air_quality'] = {'aqi': 2}
+        result_sections = history.save_refreshed_sections(
+            cur, history_id, created_at, result, ['air_quality'], now)
+
+        cur.execute(
+            'SELECT result_sections, sections_refreshed_at FROM analysis_history WHERE id = %s',
+            (history_id,)
+        )
+        stored, refreshed_at = cur.fetchone()
+        assert stored == result_sections == history.section_digests(result)
+        assert history.load_result(cur, None, stored) == result
+        # Daté du rafraîchissement et non plus de l'analyse
+        assert history.stale_sections(result, created_at, now + timedelta(minutes=30), refreshed_at) == []
+        assert history.stale_sections(result, created_at, now + timedelta(hours=2), refreshed_at) == ['air_quality']
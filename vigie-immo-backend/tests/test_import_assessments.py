@@ -0,0 +1,283 @@
+"""Tests de import_assessments : table de travail et bascule, import incrémental, reprise."""
+import zipfile
+
+import pytest
+
+import import_assessments as ia
+
+
+def _insert(cur, table, *matricules):
+    for matricule in matricules:
+        cur.execute(f'INSERT INTO {table} (matricule, municipality) VALUES (%s, %s) RETURNING id',
+                    (matricule, '66023'))
+    return cur.fetchone()[0]
+
+
+def test_new_table_has_its_own_sequence(assessments_conn):
+    conn = assessments_conn
+    with conn.cursor() as cur:
+        _insert(cur, 'property_assessments', 'A', 'B', 'C')
+        ia._prepare_new_table(cur)
+        assert _insert(cur, 'property_assessments_new', 'X', 'Y') == 2
+        # La table en service continue sa numérotation pendant le chargement
+        assert _insert(cur, 'property_assessments', 'D') == 4
+    conn.commit()
+
+    ia._publish_new_table(conn)
+
+    with conn.cursor() as cur:
+        cur.execute('SELECT matricule FROM property_assessments ORDER BY id')
+        assert [row[0] for row in cur.fetchall()] == ['X', 'Y']
+        assert _insert(cur, 'property_assessments', 'Z') == 3
+        cur.execute("SELECT pg_get_serial_sequence('property_assessments', 'id')")
+        assert cur.fetchone()[0].endswith('.property_assessments_id_seq')
+        cur.execute("SELECT to_regclass('property_assessments_new_id_seq')")
+        assert cur.fetchone()[0] is None
+
+
+def test_dependent_view_blocks_reload(assessments_conn):
+    conn = assessments_conn
+    with conn.cursor() as cur:
+        _insert(cur, 'property_assessments', 'A')
+        cur.execute('CREATE VIEW assessments_by_city AS '
+                    'SELECT municipality, COUNT(*) FROM property_assessments GROUP BY 1')
+    conn.commit()
+    with conn.cursor() as cur:
+        with pytest.raises(RuntimeError, match='assessments_by_city'):
+            ia._prepare_new_table(cur)
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM property_assessments')
+        assert cur.fetchone()[0] == 1
+
+
+# ---------------------------------------------------------------------------
+# Import incrémental
+# ---------------------------------------------------------------------------
+
+CSV_HEADER = 'id,code_mun,annee,code_utilisation,nb_logements,matricule,longitude,latitude\n'
+
+
+def _matricule(n: int) -> str:
+    return f'{n:04d}00{n:04d}0'.ljust(18, '0')
+
+
+def _unit_xml(n: int, land: int) -> str:
+    m = _matricule(n)
+    return (f'<RLUEx><RL0104><RL0104A>{m[:4]}</RL0104A><RL0104B>{m[4:6]}</RL0104B>'
+            f'<RL0104C>{m[6:10]}</RL0104C><RL0104D>{m[10:11]}</RL0104D></RL0104>'
+            f'<RL0101><RL0101x><RL0101Ax>{n}</RL0101Ax><RL0101Gx>Rue {n}</RL0101Gx></RL0101x></RL0101>'
+            f'<RL0402A>{land}</RL0402A><RL0403A>1000</RL0403A><RL0404A>{land + 1000}</RL0404A></RLUEx>')
+
+
+def _write_zip(path, members: dict) -> str:
+    """members : {nom: (code municipal, {unité: valeur du terrain}) ou XML brut}."""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, member in members.items():
+            if isinstance(member, str):
+                zf.writestr(name, member)
+                continue
+            mun_code, units = member
+            zf.writestr(name, f'<?xml version="1.0" encoding="UTF-8"?>\n<RL><RLM01A>{mun_code}</RLM01A>'
+                              + ''.join(_unit_xml(n, land) for n, land in units.items()) + '</RL>\n')
+    return str(path)
+
+
+def _write_coords(path, coords: dict) -> ia.CoordIndex:
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(CSV_HEADER)
+        for n, (lon, lat) in coords.items():
+            f.write(f'{n},11111,2026,1000,1,{_matricule(n)},"{str(lon).replace(".", ",")}",'
+                    f'"{str(lat).replace(".", ",")}"\n')
+    return ia.parse_csv_coordinates(str(path))
+
+
+def _table(conn) -> dict:
+    with conn.cursor() as cur:
+        cur.execute('SELECT matricule, id, municipality, land_value, ST_X(geom), ST_Y(geom) '
+                    'FROM property_assessments')
+        rows = {row[0]: row[1:] for row in cur.fetchall()}
+    conn.commit()
+    return rows
+
+
+def test_incremental_import_applies_only_changes(assessments_conn, pg_dsn, tmp_path):
+    conn = assessments_conn
+    coords = _write_coords(tmp_path / 'coords.csv', {1: (-73.5, 45.5), 2: (-73.6, 45.6), 3: (-71.2, 46.8)})
+    zip_path = _write_zip(tmp_path / 'roles.zip', {
+        'RL11111.xml': ('11111', {1: 100, 2: 200}),
+        'RL22222.xml': ('22222', {3: 300}),
+    })
+    assert ia.incremental_xml_load(zip_path, coords, pg_dsn) == 3
+    first = _table(conn)
+    assert first[_matricule(1)][1:] == ('11111', 100, -73.5, 45.5)
+    assert first[_matricule(3)][1:] == ('22222', 300, -71.2, 46.8)
+
+    # Rien de changé : aucun fichier retraité, lignes intactes
+    assert ia.incremental_xml_load(zip_path, coords, pg_dsn) == 0
+    assert _table(conn) == first
+
+    # Unité 1 modifiée, 2 disparue, 4 ajoutée ; RL22222 inchangé
+    zip_path = _write_zip(tmp_path / 'roles.zip', {
+        'RL11111.xml': ('11111', {1: 150, 4: 400}),
+        'RL22222.xml': ('22222', {3: 300}),
+    })
+    assert ia.incremental_xml_load(zip_path, coords, pg_dsn) == 2
+    second = _table(conn)
+    assert set(second) == {_matricule(1), _matricule(3), _matricule(4)}
+    assert second[_matricule(1)][0] == first[_matricule(1)][0]   # mis à jour en place
+    assert second[_matricule(1)][2] == 150
+    assert second[_matricule(4)][3] is None                     # sans coordonnées
+    assert second[_matricule(3)] == first[_matricule(3)]
+
+
+def test_incremental_import_follows_coordinates_and_removed_members(assessments_conn, pg_dsn, tmp_path):
+    conn = assessments_conn
+    members = {'RL11111.xml': ('11111', {1: 100}), 'RL22222.xml': ('22222', {3: 300})}
+    zip_path = _write_zip(tmp_path / 'roles.zip', members)
+    coords = _write_coords(tmp_path / 'coords.csv', {1: (-73.5, 45.5), 3: (-71.2, 46.8)})
+    ia.incremental_xml_load(zip_path, coords, pg_dsn)
+
+    # XML inchangé mais coordonnée modifiée dans le CSV : seule la municipalité concernée est retraitée
+    coords = _write_coords(tmp_path / 'coords.csv', {1: (-73.5, 45.5), 3: (-71.3, 46.9)})
+    assert ia.incremental_xml_load(zip_path, coords, pg_dsn) == 1
+    assert _table(conn)[_matricule(3)][3:] == (-71.3, 46.9)
+
+    # Fichier retiré du ZIP : ses unités disparaissent
+    zip_path = _write_zip(tmp_path / 'roles.zip', {'RL11111.xml': members['RL11111.xml']})
+    ia.incremental_xml_load(zip_path, coords, pg_dsn)
+    assert set(_table(conn)) == {_matricule(1)}
+    with conn.cursor() as cur:
+        cur.execute('SELECT member FROM assessment_import_members')
+        assert [row[0] for row in cur.fetchall()] == ['RL11111.xml']
+
+
+def test_incremental_import_keeps_data_of_broken_member(assessments_conn, pg_dsn, tmp_path):
+    conn = assessments_conn
+    coords = _write_coords(tmp_path / 'coords.csv', {1: (-73.5, 45.5)})
+    ia.incremental_xml_load(_write_zip(tmp_path / 'roles.zip', {'RL11111.xml': ('11111', {1: 100})}),
+                            coords, pg_dsn)
+    before = _table(conn)
+
+    broken = _write_zip(tmp_path / 'roles.zip', {'RL11111.xml': '<RL><RLM01A>11111</RLM01A><RLUEx>'})
+    assert ia.incremental_xml_load(broken, coords, pg_dsn) == 0
+    assert _table(conn) == before
+    with conn.cursor() as cur:
+        cur.execute('SELECT fingerprint FROM assessment_import_members')
+        # Empreinte de l'ancien fichier : le fichier sera retenté au prochain import
+        assert cur.fetchone()[0] != ia._member_fingerprint(zipfile.ZipFile(broken).getinfo('RL11111.xml'))
+
+
+# ---------------------------------------------------------------------------
+# Points de reprise (--resume)
+# ---------------------------------------------------------------------------
+
+_member_rows = ia._timed_member_rows
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _members_parsed(monkeypatch, fail_after=None) -> list:
+    """Fichiers XML lus par le chargeur ; interruption au-delà de `fail_after` fichiers."""
+    parsed = []
+
+    def member_rows(zf, name, coords, stats=None):
+        if fail_after is not None and len(parsed) >= fail_after:
+            raise Interrupted(name)
+        parsed.append(name)
+        return _member_rows(zf, name, coords, stats)
+    monkeypatch.setattr(ia, '_timed_member_rows', member_rows)
+    return parsed
+
+
+def _three_members(tmp_path):
+    csv_path = tmp_path / 'coords.csv'
+    coords = _write_coords(csv_path, {1: (-73.5, 45.5), 3: (-71.2, 46.8), 5: (-72.5, 46.3)})
+    zip_path = _write_zip(tmp_path / 'roles.zip', {
+        'RL11111.xml': ('11111', {1: 100, 2: 200}),
+        'RL22222.xml': ('22222', {3: 300}),
+        'RL33333.xml': ('33333', {5: 500, 6: 600}),
+    })
+    return zip_path, coords, str(csv_path)
+
+
+@pytest.mark.parametrize('loader', [ia.parse_xml_and_insert, ia.copy_xml_load])
+def test_xml_load_resumes_after_interruption(loader, assessments_conn, pg_dsn, tmp_path, monkeypatch):
+    zip_path, coords, csv_path = _three_members(tmp_path)
+    _members_parsed(monkeypatch, fail_after=2)
+    with pytest.raises(Interrupted):
+        loader(zip_path, coords, pg_dsn, resume=True, csv_path=csv_path)
+    assert set(_table(assessments_conn)) == set()   # table en service intacte
+
+    parsed = _members_parsed(monkeypatch)
+    assert loader(zip_path, coords, pg_dsn, resume=True, csv_path=csv_path) == 5
+    assert parsed == ['RL33333.xml']
+    rows = _table(assessments_conn)
+    assert len(rows) == 5 and rows[_matricule(5)][1:] == ('33333', 500, -72.5, 46.3)
+    with assessments_conn.cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM assessment_import_checkpoints')
+        assert cur.fetchone()[0] == 0
+        cur.execute('SELECT member FROM assessment_import_members ORDER BY 1')
+        assert [row[0] for row in cur.fetchall()] == ['RL11111.xml', 'RL22222.xml', 'RL33333.xml']
+
+
+@pytest.mark.parametrize('load', [
+    ia.parse_xml_and_insert,
+    ia.copy_xml_load,
+    lambda *args, **kwargs: ia.parallel_xml_load(*args, jobs=2, **kwargs),
+])
+def test_xml_load_drops_malformed_member(load, assessments_conn, pg_dsn, tmp_path):
+    csv_path = tmp_path / 'coords.csv'
+    coords = _write_coords(csv_path, {1: (-73.5, 45.5), 3: (-71.2, 46.8)})
+    zip_path = _write_zip(tmp_path / 'roles.zip', {
+        'RL11111.xml': ('11111', {1: 100}),
+        # Unités complètes avant l'erreur : ignorées avec le reste du fichier
+        'RL22222.xml': '<RL><RLM01A>22222</RLM01A>' + _unit_xml(3, 300) + _unit_xml(4, 400) + '<RLUEx>',
+    })
+    assert load(zip_path, coords, pg_dsn, resume=True, csv_path=str(csv_path)) == 1
+    assert set(_table(assessments_conn)) == {_matricule(1)}
+    with assessments_conn.cursor() as cur:
+        cur.execute('SELECT member FROM assessment_import_members ORDER BY 1')
+        assert [row[0] for row in cur.fetchall()] == ['RL11111.xml']
+
+
+def test_resume_restarts_when_sources_changed(assessments_conn, pg_dsn, tmp_path, monkeypatch):
+    zip_path, coords, csv_path = _three_members(tmp_path)
+    _members_parsed(monkeypatch, fail_after=2)
+    with pytest.raises(Interrupted):
+        ia.copy_xml_load(zip_path, coords, pg_dsn, resume=True, csv_path=csv_path)
+
+    # Le CSV (coordonnées jointes) a changé depuis l'interruption
+    coords = _write_coords(tmp_path / 'coords.csv', {1: (-73.4, 45.5), 3: (-71.2, 46.8), 5: (-72.5, 46.3)})
+    parsed = _members_parsed(monkeypatch)
+    assert ia.copy_xml_load(zip_path, coords, pg_dsn, resume=True, csv_path=csv_path) == 5
+    assert len(parsed) == 3
+    assert _table(assessments_conn)[_matricule(1)][3] == -73.4
+
+
+def test_csv_load_resumes_from_last_slice(assessments_conn, pg_dsn, tmp_path, monkeypatch):
+    csv_path = tmp_path / 'coords.csv'
+    _write_coords(csv_path, {n: (-73.0 - n / 100, 45.5) for n in range(1, 8)})
+    monkeypatch.setattr(ia, 'CSV_CHECKPOINT_ROWS', 2)
+    real = ia._copy_into_staging
+    calls = []
+
+    def copy_into_staging(cur, rows, fmt, table=ia.STAGING_TABLE):
+        calls.append(table)
+        if len(calls) == 3:
+            raise Interrupted()
+        return real(cur, rows, fmt, table)
+    monkeypatch.setattr(ia, '_copy_into_staging', copy_into_staging)
+    with pytest.raises(Interrupted):
+        ia.copy_csv_load(str(csv_path), pg_dsn, resume=True)
+    with assessments_conn.cursor() as cur:
+        cur.execute('SELECT row_count FROM assessment_import_checkpoints')
+        assert cur.fetchone()[0] == 4
+    assessments_conn.commit()
+
+    monkeypatch.setattr(ia, '_copy_into_staging', real)
+    assert ia.copy_csv_load(str(csv_path), pg_dsn, resume=True) == 7
+    rows = _table(assessments_conn)
+    assert sorted(rows) == sorted(_matricule(n) for n in range(1, 8))
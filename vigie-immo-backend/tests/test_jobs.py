@@ -0,0 +1,62 @@
+"""
+File des analyses : limite ANALYZE_JOB_MAX_PENDING par utilisateur.
+"""
+import threading
+
+import psycopg2
+
+import jobs
+
+
+def test_concurrent_submissions_respect_the_limit(app_conn, pg_dsn, monkeypatch):
+    monkeypatch.setattr(jobs, 'ANALYZE_JOB_MAX_PENDING', 1)
+    with app_conn, app_conn.cursor() as cur:
+        cur.execute("INSERT INTO users (email, name, password_hash) VALUES ('j@example.com', 'J', 'x') RETURNING id")
+        user_id = cur.fetchone()[0]
+
+    other = psycopg2.connect(pg_dsn)
+    try:
+        first = app_conn.cursor()
+        jobs.submit_job(first, user_id, '1 rue A')   # transaction laissée ouverte
+
+        outcome = []
+
+        def submit_second():
+            try:
+                with other, other.cursor() as cur:
+                    outcome.append(jobs.submit_job(cur, user_id, '2 rue B'))
+            except jobs.JobQueueFull as e:
+                outcome.append(e)
+
+        thread = threading.Thread(target=submit_second)
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive()   # attend le commit de la première soumission
+        app_conn.commit()
+        thread.join(5)
+        assert len(outcome) == 1 and isinstance(outcome[0], jobs.JobQueueFull)
+    finally:
+        other.close()
+
+    with app_conn.cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM analysis_jobs WHERE user_id = %s', (user_id,))
+        assert cur.fetchone()[0] == 1
+
+
+def test_other_users_are_not_blocked(app_conn, pg_dsn):
+    with app_conn, app_conn.cursor() as cur:
+        cur.execute(
+            '''INSERT INTO users (email, name, password_hash)
+               VALUES ('a@example.com', 'A', 'x'), ('b@example.com', 'B', 'x') RETURNING id'''
+        )
+        user_a, user_b = (row[0] for row in cur.fetchall())
+
+    other = psycopg2.connect(pg_dsn)
+    other.cursor().execute('SET lock_timeout = 1000')
+    try:
+        jobs.submit_job(app_conn.cursor(), user_a, '1 rue A')
+        with other, other.cursor() as cur:
+            assert jobs.submit_job(cur, user_b, '2 rue B')
+    finally:
+        app_conn.rollback()
+        other.close()
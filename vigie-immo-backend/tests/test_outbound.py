@@ -0,0 +1,159 @@
+"""
+Seau à jetons des appels externes : seau local (_reserve_local), règle de la
+voie batch (seau au moins à moitié plein) et échéance de lane('batch').
+"""
+import pytest
+
+import outbound
+
+HOST = 'api.example.org'
+
+
+class FakeClock:
+    """Remplace le module time d'outbound : sleep() avance monotonic()."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        seconds = max(seconds, 0)
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(outbound, 'time', clock)
+    monkeypatch.setattr(outbound, '_local_tat', {})
+    monkeypatch.setattr(outbound, '_stats', {})
+    # Seau local seulement : pas de PostgreSQL
+    monkeypatch.setattr(outbound, '_reserve', outbound._reserve_local)
+    monkeypatch.setitem(outbound.UPSTREAM_LIMITS, HOST, (8.0, 5))   # 8 req/s, rafale de 5
+    return clock
+
+
+def test_reserve_local_burst_then_spacing(clock):
+    interval, tolerance = 0.125, 0.5
+    waits = [outbound._reserve_local(HOST, interval, tolerance, tolerance + 1) for _ in range(7)]
+    # Rafale de 5 sans attente, puis un créneau toutes les 125 ms
+    assert all(wait <= 0 for wait in waits[:5])
+    assert waits[5:] == [0.125, 0.25]
+
+
+def test_reserve_local_refuses_beyond_limit(clock):
+    interval, tolerance = 0.125, 0.5
+    for _ in range(5):
+        assert outbound._reserve_local(HOST, interval, tolerance, tolerance) is not None
+    assert outbound._reserve_local(HOST, interval, tolerance, tolerance) is None
+    clock.now += interval   # un jeton rendu
+    assert outbound._reserve_local(HOST, interval, tolerance, tolerance) is not None
+
+
+def test_batch_keeps_half_the_burst(clock):
+    with outbound.lane('batch'):
+        for _ in range(3):
+            assert outbound.acquire(HOST) == 0
+        # Seau à moitié vide : le créneau suivant attend qu'un jeton revienne
+        assert outbound.acquire(HOST) == 0.125
+    # La voie interactive dispose encore de la moitié de la rafale
+    assert outbound.acquire(HOST) == 0
+    assert outbound.acquire(HOST) == 0
+
+
+def test_interactive_busy_beyond_max_wait(clock, monkeypatch):
+    monkeypatch.setattr(outbound, 'OUTBOUND_MAX_WAIT', 0.25)
+    outbound._local_tat[HOST] = clock.now + 0.875   # créneau libre dans 0.375 s
+    with pytest.raises(outbound.UpstreamBusy):
+        outbound.acquire(HOST)
+    outbound._local_tat[HOST] = clock.now + 0.75    # rafale (0.5 s) + 0.25 s
+    assert outbound.acquire(HOST) == 0.25
+
+
+def test_batch_wait_bounded_by_lane_deadline(clock):
+    outbound._local_tat[HOST] = clock.now + 3600   # hôte saturé pour une heure
+    with outbound.lane('batch', deadline=clock.now + 5):
+        with pytest.raises(outbound.UpstreamBusy):
+            outbound.acquire(HOST)
+    assert clock.slept == pytest.approx(5)
+    # Échéance passée : plus aucune attente, même par appel
+    with outbound.lane('batch', deadline=clock.now - 1):
+        with pytest.raises(outbound.UpstreamBusy):
+            outbound.acquire(HOST)
+    assert clock.slept == pytest.approx(5)
+
+
+def test_latency_keyed_by_logical_source(clock, monkeypatch):
+    calls = []
+
+    def fake_request(method, url, timeout, **kwargs):
+        calls.append(timeout)
+        response = outbound.requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(outbound.requests, 'request', fake_request)
+    monkeypatch.setattr(outbound, '_latency', {})
+    url = f'https://{HOST}/api/3/action/datastore_search_sql'
+    for seconds in (4.0,) * outbound.OUTBOUND_LATENCY_MIN_SAMPLES:
+        outbound._observe(f'{HOST}:crime_mtl', seconds)
+
+    outbound.get(url, timeout=15, source='hydrants_mtl')
+    outbound.get(url, timeout=15, source='crime_mtl')
+    outbound.get(url, timeout=15)
+    # Même point d'accès : seules les mesures de crime_mtl fixent son délai
+    assert calls == [15, 12.0, 15]
+    assert set(outbound.latency_stats()) == {
+        f'{HOST}:crime_mtl', f'{HOST}:hydrants_mtl', f'{HOST}/api/3/action/datastore_search_sql'}
+
+
+def test_host_down_after_consecutive_failures(clock, monkeypatch):
+    attempts = []
+
+    def unreachable(method, url, timeout, **kwargs):
+        attempts.append(url)
+        raise outbound.requests.ConnectionError('injoignable')
+
+    monkeypatch.setattr(outbound.requests, 'request', unreachable)
+    monkeypatch.setattr(outbound, '_health', {})
+    monkeypatch.setattr(outbound, 'OUTBOUND_FAILURE_THRESHOLD', 2)
+    monkeypatch.setattr(outbound, 'OUTBOUND_NEGATIVE_TTL', 30)
+    url = f'https://{HOST}/query'
+
+    for _ in range(2):
+        with pytest.raises(outbound.requests.ConnectionError):
+            outbound.get(url, source='a')
+    # Hors service pour toutes ses sources, sans nouvel appel
+    with pytest.raises(outbound.UpstreamUnavailable):
+        outbound.get(url, source='b')
+    assert len(attempts) == 2
+    assert outbound.stats()[HOST]['interactive']['unavailable'] == 1
+
+    # Délai écoulé : un essai ; toujours en échec, de nouveau hors service
+    clock.now += 31
+    with pytest.raises(outbound.requests.ConnectionError):
+        outbound.get(url, source='a')
+    with pytest.raises(outbound.UpstreamUnavailable):
+        outbound.get(url, source='a')
+    assert len(attempts) == 3
+
+
+def test_success_resets_failures(clock, monkeypatch):
+    statuses = iter([502, 200, 502, 404])
+
+    def respond(method, url, timeout, **kwargs):
+        response = outbound.requests.Response()
+        response.status_code = next(statuses)
+        return response
+
+    monkeypatch.setattr(outbound.requests, 'request', respond)
+    monkeypatch.setattr(outbound, '_health', {})
+    monkeypatch.setattr(outbound, 'OUTBOUND_FAILURE_THRESHOLD', 2)
+    url = f'https://{HOST}/query'
+    # 502, 200, 502 : jamais deux échecs de suite ; 404 n'est pas une panne
+    assert [outbound.get(url).status_code for _ in range(4)] == [502, 200, 502, 404]
+    assert outbound._health == {}